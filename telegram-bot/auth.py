@@ -2,7 +2,7 @@
 Модуль аутентификации пользователей
 """
 import bcrypt
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from firebase_client import firebase
 
 def verify_password(password: str, hashed: str) -> bool:
@@ -86,7 +86,7 @@ def check_user_active(user_id: str) -> bool:
         True если активен, False если архивирован или не найден
     """
     try:
-        user = firebase.get_by_id('users', user_id)
+        user = firebase.get_by_id('users', user_id, fields=['isArchived'])
         if not user:
             return False
         return not user.get('isArchived', False)
@@ -94,6 +94,28 @@ def check_user_active(user_id: str) -> bool:
         print(f"Error checking user active: {e}")
         return False
 
+def check_users_active(user_ids: List[str]) -> Dict[str, bool]:
+    """
+    Проверить активность нескольких пользователей одним запросом
+    
+    Args:
+        user_ids: ID пользователей
+    
+    Returns:
+        Словарь ID -> активен ли (не найденные и архивированные - False)
+    """
+    try:
+        users = firebase.get_many('users', user_ids, fields=['isArchived'])
+        if user_ids and not users:
+            # Клиент возвращает {} и при ошибке запроса - не разлогиниваем всех сразу
+            print(f"Error checking users active: no users returned for {len(user_ids)} IDs")
+            return {user_id: True for user_id in user_ids}
+        return {user_id: user_id in users and not users[user_id].get('isArchived', False) for user_id in user_ids}
+    except Exception as e:
+        print(f"Error checking users active: {e}")
+        # При ошибке чтения не разлогиниваем пользователей
+        return {user_id: True for user_id in user_ids}
+
 def update_user_password(user_id: str, old_password: str, new_password: str) -> bool:
     """
     Обновить пароль пользователя
@@ -107,7 +129,8 @@ def update_user_password(user_id: str, old_password: str, new_password: str) ->
         True если успешно, False если неверный старый пароль
     """
     try:
-        user = firebase.get_by_id('users', user_id)
+        # Запоминаем время изменения, чтобы не перезаписать пароль, смененный параллельно
+        user, update_time = firebase.get_with_update_time('users', user_id, fields=['password'])
         if not user:
             return False
         
@@ -129,11 +152,10 @@ def update_user_password(user_id: str, old_password: str, new_password: str) ->
         hashed = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
         
         # Обновляем пароль
-        user['password'] = hashed
-        user['mustChangePassword'] = False
-        firebase.save('users', user)
-        
-        return True
+        return firebase.update('users', user_id, {
+            'password': hashed,
+            'mustChangePassword': False
+        }, update_time=update_time)
     except Exception as e:
         print(f"Error updating password: {e}")
         return False
@@ -150,14 +172,7 @@ def update_user_avatar(user_id: str, avatar_url: str) -> bool:
         True если успешно
     """
     try:
-        user = firebase.get_by_id('users', user_id)
-        if not user:
-            return False
-        
-        user['avatar'] = avatar_url
-        firebase.save('users', user)
-        
-        return True
+        return firebase.update('users', user_id, {'avatar': avatar_url})
     except Exception as e:
         print(f"Error updating avatar: {e}")
         return False
@@ -175,18 +190,16 @@ def update_user_contacts(user_id: str, phone: Optional[str] = None, email: Optio
         True если успешно
     """
     try:
-        user = firebase.get_by_id('users', user_id)
-        if not user:
-            return False
-        
+        fields = {}
         if phone is not None:
-            user['phone'] = phone
+            fields['phone'] = phone
         if email is not None:
-            user['email'] = email
-        
-        firebase.save('users', user)
+            fields['email'] = email
+        if not fields:
+            # Нечего менять - проверяем только, что пользователь существует
+            return firebase.get_by_id('users', user_id, fields=['isArchived']) is not None
         
-        return True
+        return firebase.update('users', user_id, fields)
     except Exception as e:
         print(f"Error updating contacts: {e}")
         return False
@@ -0,0 +1,193 @@
+"""
+Микро-бенчмарк преобразования значений Firestore
+
+Сравнивает прежние реализации (цепочка if/isinstance в firebase_client_rest и
+hasattr/str(type) в firebase_client_admin) с табличными из firestore_codec
+на синтетической странице из 10 000 документов, похожих на задачи.
+Декодирование REST в firestore_codec - та же цепочка if, для него проверяется
+только совпадение результата.
+
+Запуск (из каталога telegram-bot):
+    python benchmarks/bench_firestore_codec.py [--docs 10000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import firestore_codec  # noqa: E402
+
+# ---------------------------------------------------------------------------
+# Прежние реализации (до firestore_codec) - для сравнения
+# ---------------------------------------------------------------------------
+
+def legacy_convert_firestore_value(value):
+    if isinstance(value, dict):
+        if 'stringValue' in value:
+            return value['stringValue']
+        elif 'integerValue' in value:
+            return int(value['integerValue'])
+        elif 'doubleValue' in value:
+            return float(value['doubleValue'])
+        elif 'booleanValue' in value:
+            return value['booleanValue']
+        elif 'timestampValue' in value:
+            return value['timestampValue']
+        elif 'arrayValue' in value:
+            return [legacy_convert_firestore_value(v) for v in value['arrayValue'].get('values', [])]
+        elif 'mapValue' in value:
+            return {k: legacy_convert_firestore_value(v) for k, v in value['mapValue'].get('fields', {}).items()}
+        elif 'nullValue' in value:
+            return None
+    return value
+
+def legacy_convert_to_firestore_value(value):
+    if value is None:
+        return {'nullValue': None}
+    elif isinstance(value, bool):
+        return {'booleanValue': value}
+    elif isinstance(value, int):
+        return {'integerValue': str(value)}
+    elif isinstance(value, float):
+        return {'doubleValue': value}
+    elif isinstance(value, str):
+        return {'stringValue': value}
+    elif isinstance(value, list):
+        return {'arrayValue': {'values': [legacy_convert_to_firestore_value(v) for v in value]}}
+    elif isinstance(value, dict):
+        return {'mapValue': {'fields': {k: legacy_convert_to_firestore_value(v) for k, v in value.items()}}}
+    else:
+        return {'stringValue': str(value)}
+
+def legacy_prepare_data_from_firestore(doc_data):
+    result = {}
+    for key, value in doc_data.items():
+        if (hasattr(value, 'seconds') and hasattr(value, 'nanoseconds')) or \
+           (hasattr(value, 'isoformat') and 'Timestamp' in str(type(value))):
+            try:
+                result[key] = value.isoformat()
+            except:
+                result[key] = str(value)
+        elif isinstance(value, dict):
+            result[key] = legacy_prepare_data_from_firestore(value)
+        elif isinstance(value, list):
+            result[key] = [legacy_prepare_data_from_firestore(item) if isinstance(item, dict) else item for item in value]
+        else:
+            result[key] = value
+    return result
+
+# ---------------------------------------------------------------------------
+# Синтетические данные
+# ---------------------------------------------------------------------------
+
+class Timestamp(datetime):
+    """Аналог Timestamp Admin SDK (тип с 'Timestamp' в имени и isoformat)"""
+
+class DatetimeWithNanoseconds(datetime):
+    """Аналог google.api_core DatetimeWithNanoseconds (прежний код возвращал его как есть)"""
+
+STATUSES = ['Не начато', 'В работе', 'На проверке', 'Выполнено']
+PRIORITIES = ['Низкий', 'Средний', 'Высокий']
+
+def make_task(i: int, rng: random.Random) -> dict:
+    created = datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=rng.randint(0, 500000))
+    return {
+        'title': f"Задача {i}: подготовить отчет по проекту {rng.randint(1, 50)}",
+        'description': 'Описание задачи ' * rng.randint(1, 8),
+        'status': rng.choice(STATUSES),
+        'priority': rng.choice(PRIORITIES),
+        'assigneeId': f"user{rng.randint(1, 40)}",
+        'assigneeIds': [f"user{rng.randint(1, 40)}" for _ in range(rng.randint(0, 3))],
+        'createdByUserId': f"user{rng.randint(1, 40)}",
+        'projectId': f"project{rng.randint(1, 20)}",
+        'endDate': (created + timedelta(days=rng.randint(1, 30))).date().isoformat(),
+        'createdAt': created.isoformat().replace('+00:00', 'Z'),
+        'isArchived': rng.random() < 0.1,
+        'entityType': 'task',
+        'estimate': rng.random() * 10,
+        'order': i,
+        'parentId': None,
+        'comments': [
+            {'userId': f"user{rng.randint(1, 40)}", 'text': 'Комментарий', 'createdAt': created.isoformat()}
+            for _ in range(rng.randint(0, 3))
+        ],
+    }
+
+def make_rest_page(docs: int) -> bytes:
+    rng = random.Random(42)
+    documents = []
+    for i in range(docs):
+        fields = {k: legacy_convert_to_firestore_value(v) for k, v in make_task(i, rng).items()}
+        fields['createdAt'] = {'timestampValue': fields['createdAt']['stringValue']}
+        documents.append({'name': f"projects/p/databases/(default)/documents/tasks/t{i}", 'fields': fields})
+    return json.dumps({'documents': documents}, ensure_ascii=False).encode('utf-8')
+
+def make_sdk_page(docs: int) -> list:
+    rng = random.Random(42)
+    page = []
+    for i in range(docs):
+        task = make_task(i, rng)
+        created = datetime.fromisoformat(task['createdAt'].replace('Z', '+00:00'))
+        task['createdAt'] = Timestamp.fromtimestamp(created.timestamp(), tz=timezone.utc)
+        task['updatedAt'] = DatetimeWithNanoseconds.fromtimestamp(created.timestamp(), tz=timezone.utc)
+        task['reminders'] = [task['createdAt'], {'at': task['createdAt'], 'sent': False}]
+        page.append(task)
+    return page
+
+# ---------------------------------------------------------------------------
+
+def bench(name: str, func, repeat: int) -> float:
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print(f"  {name:<42} {best * 1000:9.1f} ms")
+    return best
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    raw = make_rest_page(args.docs)
+    parsed = json.loads(raw)
+    rest_docs = [doc['fields'] for doc in parsed['documents']]
+    decoded = [firestore_codec.decode_fields(fields) for fields in rest_docs]
+    sdk_docs = make_sdk_page(args.docs)
+
+    # Результаты должны совпадать со старой реализацией
+    assert decoded == [{k: legacy_convert_firestore_value(v) for k, v in f.items()} for f in rest_docs]
+    assert [firestore_codec.encode_fields(d) for d in decoded] == \
+        [{k: legacy_convert_to_firestore_value(v) for k, v in d.items()} for d in decoded]
+    assert [firestore_codec.normalize_sdk_fields(d) for d in sdk_docs] == \
+        [legacy_prepare_data_from_firestore(d) for d in sdk_docs]
+
+    print(f"Page: {args.docs} documents, {len(raw) / 1024 / 1024:.1f} MiB JSON, best of {args.repeat}")
+
+    print("JSON parsing:")
+    json_time = bench('json.loads', lambda: json.loads(raw), args.repeat)
+    if firestore_codec.orjson is not None:
+        orjson_time = bench('orjson.loads', lambda: firestore_codec.orjson.loads(raw), args.repeat)
+        print(f"  speedup: {json_time / orjson_time:.1f}x")
+    else:
+        print("  orjson is not installed, skipped")
+
+    print("REST encode (dict -> fields):")
+    old = bench('if-chain (_convert_to_firestore_value)',
+                lambda: [{k: legacy_convert_to_firestore_value(v) for k, v in d.items()} for d in decoded], args.repeat)
+    new = bench('dispatch dict (encode_fields)',
+                lambda: [firestore_codec.encode_fields(d) for d in decoded], args.repeat)
+    print(f"  speedup: {old / new:.1f}x")
+
+    print("Admin SDK normalize (Timestamp -> ISO):")
+    old = bench('hasattr probes (prepare_data_from_firestore)',
+                lambda: [legacy_prepare_data_from_firestore(d) for d in sdk_docs], args.repeat)
+    new = bench('type table (normalize_sdk_fields)',
+                lambda: [firestore_codec.normalize_sdk_fields(d) for d in sdk_docs], args.repeat)
+    print(f"  speedup: {old / new:.1f}x")
+
+if __name__ == '__main__':
+    main()
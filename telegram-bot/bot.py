@@ -9,6 +9,7 @@ import logging
 import sys
 import os
 import subprocess
+import time
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -21,33 +22,25 @@ from telegram.ext import (
     ContextTypes
 )
 import config
-from auth import authenticate_user, check_user_active, update_user_password, update_user_avatar
-from firebase_client import firebase
+import data
+from firebase_client import USE_ADMIN_SDK, async_firebase, cache, flights, mirror, sqlite_mirror
+from firebase_metrics import metrics, attribute, start_metrics_server
 from keyboards import (
     get_main_menu, get_tasks_menu, get_deals_menu, get_deal_menu, get_task_menu,
     get_settings_menu, get_profile_menu, get_statuses_keyboard, get_stages_keyboard,
     get_funnels_keyboard, get_clients_keyboard, get_users_keyboard, get_confirm_keyboard,
     get_back_button, get_tasks_list_keyboard
 )
-from messages import format_task_message, format_deal_message, format_meeting_message, format_document_message
-from tasks import (
-    get_user_tasks, get_today_tasks, get_overdue_tasks, get_task_by_id,
-    update_task_status, create_task, get_statuses
-)
-from deals import (
-    get_all_deals, get_user_deals, get_deal_by_id, create_deal, update_deal,
-    update_deal_stage, delete_deal, search_deals, get_sales_funnels, get_funnel_stages,
-    get_won_deals_today
-)
-from clients import get_all_clients, get_client_by_id, create_client, search_clients
-from profile import get_user_profile, format_profile_message
-from notifications import (
-    check_new_tasks, check_new_deals, check_upcoming_meetings,
-    get_successful_deal_message
-)
-from notification_queue import (
-    get_pending_notifications, mark_notification_sent, cleanup_old_notifications
+from messages import (
+    format_task_message, format_deal_message, format_meeting_message, format_document_message,
+    format_firestore_stats, format_queue_stats
 )
+from profile import format_profile_message
+from notification_queue import mark_notification_sent, mark_notification_failed, release_notification, get_queue_backlog
+from notification_dispatcher import dispatcher, is_permanent_error, DeadlineExceeded, DigestHeld
+from notification_watcher import NotificationQueueWatcher
+from notification_metrics import queue_metrics
+from notifications import NewTaskIndex
 from scheduler import TaskScheduler
 from utils import get_today_date, is_overdue
 
@@ -109,7 +102,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         # Проверяем, авторизован ли пользователь
         if telegram_user_id in user_sessions:
             user_id = user_sessions[telegram_user_id]['user_id']
-            if check_user_active(user_id):
+            if await data.check_user_active(user_id):
                 logger.info(f"[START] User {telegram_user_id} already authorized")
                 await update.message.reply_text(
                     "Вы уже авторизованы! Используйте меню для навигации.",
@@ -159,7 +152,7 @@ async def password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         logger.info(f"[PASSWORD] User {update.effective_user.id} attempting login: {login_text}")
         
         # Аутентификация
-        user = authenticate_user(login_text, password_text)
+        user = await data.authenticate_user(login_text, password_text)
         
         if user:
             telegram_user_id = update.effective_user.id
@@ -170,7 +163,7 @@ async def password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             
             # Сохраняем telegram_user_id в профиле пользователя
             user['telegramUserId'] = str(telegram_user_id)
-            firebase.save('users', user)
+            await async_firebase.update('users', user['id'], {'telegramUserId': user['telegramUserId']})
             
             logger.info(f"[PASSWORD] User {telegram_user_id} authenticated successfully as {user.get('name', 'Unknown')}")
             await update.message.reply_text(
@@ -226,7 +219,7 @@ def require_auth(func):
             return
         
         user_id = user_sessions[telegram_user_id]['user_id']
-        if not check_user_active(user_id):
+        if not await data.check_user_active(user_id):
             del user_sessions[telegram_user_id]
             await update.callback_query.answer("❌ Ваш аккаунт был деактивирован. Используйте /start")
             return
@@ -257,7 +250,7 @@ async def tasks_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_user_id = update.effective_user.id
     user_id = user_sessions[telegram_user_id]['user_id']
     
-    all_user_tasks = get_user_tasks(user_id)
+    all_user_tasks = await data.get_user_tasks(user_id)
     
     if not all_user_tasks:
         await query.edit_message_text(
@@ -279,19 +272,19 @@ async def tasks_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user_sessions[telegram_user_id]['user_id']
     
     # Парсим callback_data: tasks_filter_{filter_type}_{page}
-    data = query.data.split('_')
-    filter_type = data[2]  # all, today, overdue
-    page = int(data[3]) if len(data) > 3 else 0
+    parts = query.data.split('_')
+    filter_type = parts[2]  # all, today, overdue
+    page = int(parts[3]) if len(parts) > 3 else 0
     
     # Получаем все задачи
-    all_user_tasks = get_user_tasks(user_id)
+    all_user_tasks = await data.get_user_tasks(user_id)
     
     # Применяем фильтр
     filtered_tasks = []
     if filter_type == 'today':
-        filtered_tasks = get_today_tasks(user_id)
+        filtered_tasks = await data.get_today_tasks(user_id)
     elif filter_type == 'overdue':
-        filtered_tasks = get_overdue_tasks(user_id)
+        filtered_tasks = await data.get_overdue_tasks(user_id)
     else:  # all
         filtered_tasks = all_user_tasks
     
@@ -307,19 +300,19 @@ async def tasks_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user_sessions[telegram_user_id]['user_id']
     
     # Парсим callback_data: tasks_page_{filter_type}_{page}
-    data = query.data.split('_')
-    filter_type = data[2]  # all, today, overdue
-    page = int(data[3]) if len(data) > 3 else 0
+    parts = query.data.split('_')
+    filter_type = parts[2]  # all, today, overdue
+    page = int(parts[3]) if len(parts) > 3 else 0
     
     # Получаем все задачи
-    all_user_tasks = get_user_tasks(user_id)
+    all_user_tasks = await data.get_user_tasks(user_id)
     
     # Применяем фильтр
     filtered_tasks = []
     if filter_type == 'today':
-        filtered_tasks = get_today_tasks(user_id)
+        filtered_tasks = await data.get_today_tasks(user_id)
     elif filter_type == 'overdue':
-        filtered_tasks = get_overdue_tasks(user_id)
+        filtered_tasks = await data.get_overdue_tasks(user_id)
     else:  # all
         filtered_tasks = all_user_tasks
     
@@ -408,15 +401,15 @@ async def task_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     task_id = query.data.split('_')[1]
-    task = get_task_by_id(task_id)
+    task = await data.get_task_by_id(task_id)
     
     if not task:
         await query.edit_message_text("❌ Задача не найдена", reply_markup=get_tasks_menu())
         return
     
-    users = firebase.get_all('users')
-    projects = firebase.get_all('projects')
-    message = format_task_message(task, users, projects)
+    users = await async_firebase.get_many('users', [task.get('assigneeId'), task.get('createdByUserId')])
+    projects = await async_firebase.get_many('projects', [task.get('projectId')])
+    message = format_task_message(task, list(users.values()), list(projects.values()))
     
     await query.edit_message_text(message, reply_markup=get_task_menu(task_id))
 
@@ -431,25 +424,21 @@ async def task_set_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_status = parts[4] if len(parts) > 4 else None
     
     if new_status:
-        # Устанавливаем статус
-        task = get_task_by_id(task_id)
-        if task:
-            statuses = get_statuses()
-            status_obj = next((s for s in statuses if s.get('id') == new_status or s.get('name') == new_status), None)
-            if status_obj:
-                status_name = status_obj.get('name', new_status)
-                update_task_status(task_id, status_name)
-                await query.edit_message_text(
-                    f"✅ Статус задачи изменен на: {status_name}",
-                    reply_markup=get_task_menu(task_id)
-                )
-            else:
-                await query.answer("❌ Статус не найден")
+        # Устанавливаем статус (одна запись; если задачи нет - обновление не пройдет)
+        statuses = await data.get_statuses()
+        status_obj = next((s for s in statuses if s.get('id') == new_status or s.get('name') == new_status), None)
+        if not status_obj:
+            await query.answer("❌ Статус не найден")
+        elif await data.update_task_status(task_id, status_obj.get('name', new_status)):
+            await query.edit_message_text(
+                f"✅ Статус задачи изменен на: {status_obj.get('name', new_status)}",
+                reply_markup=get_task_menu(task_id)
+            )
         else:
             await query.answer("❌ Задача не найдена")
     else:
         # Показываем список статусов
-        statuses = get_statuses()
+        statuses = await data.get_statuses()
         if not statuses:
             await query.answer("❌ Статусы не найдены")
             return
@@ -473,8 +462,8 @@ async def deals_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     # Получаем только активные сделки (не архивные)
-    deals = get_all_deals(include_archived=False)
-    funnels = get_sales_funnels()
+    deals = await data.get_all_deals(include_archived=False)
+    funnels = await data.get_sales_funnels()
     
     if not deals:
         await query.edit_message_text(
@@ -512,9 +501,7 @@ async def deals_all_show(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    deals = get_all_deals(include_archived=False)
-    clients = firebase.get_all('clients')
-    users = firebase.get_all('users')
+    deals = await data.get_all_deals(include_archived=False)
     
     if not deals:
         await query.edit_message_text(
@@ -554,14 +541,14 @@ async def deals_funnel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("❌ Воронка не указана")
         return
     
-    funnel = firebase.get_by_id('salesFunnels', funnel_id)
+    funnel = await async_firebase.get_by_id('salesFunnels', funnel_id)
     
     if not funnel:
         await query.answer("❌ Воронка не найдена")
         return
     
     # Получаем стадии воронки
-    stages = get_funnel_stages(funnel_id)
+    stages = await data.get_funnel_stages(funnel_id)
     
     if not stages:
         await query.edit_message_text(
@@ -603,23 +590,21 @@ async def deals_funnel_stage(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.answer("❌ Воронка не указана")
         return
     
-    funnel = firebase.get_by_id('salesFunnels', funnel_id)
+    funnel = await async_firebase.get_by_id('salesFunnels', funnel_id)
     
     if not funnel:
         await query.answer("❌ Воронка не найдена")
         return
     
-    deals = get_all_deals(include_archived=False)
-    
-    # Фильтруем сделки по воронке и этапу
+    # Фильтруем сделки по воронке и этапу (запросом на стороне Firestore)
     if stage_id == 'all':
         # Все сделки воронки
-        funnel_deals = [d for d in deals if d.get('funnelId') == funnel_id]
+        funnel_deals = await data.get_funnel_deals(funnel_id)
         stage_name = "Все этапы"
     else:
         # Сделки конкретного этапа
-        funnel_deals = [d for d in deals if d.get('funnelId') == funnel_id and d.get('stage') == stage_id]
-        stages = get_funnel_stages(funnel_id)
+        funnel_deals = await data.get_funnel_deals(funnel_id, stage_id)
+        stages = await data.get_funnel_stages(funnel_id)
         stage = next((s for s in stages if s.get('id') == stage_id), None)
         stage_name = stage.get('name', stage_id) if stage else stage_id
     
@@ -654,7 +639,7 @@ async def deals_new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    deals = get_all_deals(include_archived=False)
+    deals = await data.get_all_deals(include_archived=False)
     
     # Фильтруем сделки на этапе "НОВАЯ ЗАЯВКА"
     # Ищем по stage = "НОВАЯ ЗАЯВКА" или похожим значениям
@@ -698,9 +683,7 @@ async def deals_mine(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_user_id = update.effective_user.id
     user_id = user_sessions[telegram_user_id]['user_id']
     
-    deals = get_user_deals(user_id, include_archived=False)
-    clients = firebase.get_all('clients')
-    users = firebase.get_all('users')
+    deals = await data.get_user_deals(user_id, include_archived=False)
     
     if not deals:
         await query.edit_message_text(
@@ -743,7 +726,7 @@ async def deal_create(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     
     # Показываем выбор воронки
-    funnels = get_sales_funnels()
+    funnels = await data.get_sales_funnels()
     if funnels:
         await query.edit_message_text(
             "➕ Создание новой заявки\n\nВыберите воронку:",
@@ -775,8 +758,8 @@ async def deal_create_funnel(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_states[telegram_user_id]['data']['funnelId'] = funnel_id
     
     # Получаем этапы воронки
-    stages = get_funnel_stages(funnel_id)
-    funnel = firebase.get_by_id('salesFunnels', funnel_id)
+    stages = await data.get_funnel_stages(funnel_id)
+    funnel = await async_firebase.get_by_id('salesFunnels', funnel_id)
     funnel_name = funnel.get('name', '') if funnel else ''
     
     if stages and len(stages) > 0:
@@ -828,11 +811,11 @@ async def deal_create_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_states[telegram_user_id]['state'] = 'creating_deal_title'
     
     # Получаем название этапа
-    stages = get_funnel_stages(funnel_id)
+    stages = await data.get_funnel_stages(funnel_id)
     stage = next((s for s in stages if s.get('id') == stage_id), None)
     stage_name = stage.get('name', '') if stage else ''
     
-    funnel = firebase.get_by_id('salesFunnels', funnel_id)
+    funnel = await async_firebase.get_by_id('salesFunnels', funnel_id)
     funnel_name = funnel.get('name', '') if funnel else ''
     
     await query.edit_message_text(
@@ -847,16 +830,16 @@ async def deal_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     deal_id = query.data.split('_')[1]
-    deal = get_deal_by_id(deal_id)
+    deal = await data.get_deal_by_id(deal_id)
     
     if not deal:
         await query.edit_message_text("❌ Сделка не найдена", reply_markup=get_deals_menu())
         return
     
-    clients = firebase.get_all('clients')
-    users = firebase.get_all('users')
-    funnels = get_sales_funnels()
-    message = format_deal_message(deal, clients, users, funnels)
+    clients = await async_firebase.get_many('clients', [deal.get('clientId')])
+    users = await async_firebase.get_many('users', [deal.get('assigneeId')])
+    funnels = await data.get_sales_funnels()
+    message = format_deal_message(deal, list(clients.values()), list(users.values()), funnels)
     
     await query.edit_message_text(message, reply_markup=get_deal_menu(deal_id))
 
@@ -871,21 +854,18 @@ async def deal_set_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_stage = parts[4] if len(parts) > 4 else None
     
     if new_stage:
-        # Устанавливаем стадию
-        deal = get_deal_by_id(deal_id)
-        if deal:
-            update_deal_stage(deal_id, new_stage)
-            
+        # Устанавливаем стадию (одна запись; если сделки нет - обновление не пройдет)
+        if await data.update_deal_stage(deal_id, new_stage):
             # Проверяем, не перешла ли сделка в стадию "won"
             if new_stage == 'won':
                 # Отправляем уведомление в групповой чат
-                notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+                notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
                 telegram_chat_id = notification_prefs.get('telegramGroupChatId') if notification_prefs else None
                 
                 if telegram_chat_id:
-                    clients = firebase.get_all('clients')
-                    users = firebase.get_all('users')
-                    message = get_successful_deal_message(deal, clients, users)
+                    # Сделка нужна только для текста поздравления
+                    deal = await data.get_deal_by_id(deal_id)
+                    message = await data.get_successful_deal_message(deal) if deal else None
                     if message:
                         try:
                             await context.bot.send_message(
@@ -907,7 +887,7 @@ async def deal_set_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("❌ Сделка не найдена")
     else:
         # Показываем список стадий
-        deal = get_deal_by_id(deal_id)
+        deal = await data.get_deal_by_id(deal_id)
         if not deal:
             await query.answer("❌ Сделка не найдена")
             return
@@ -917,7 +897,7 @@ async def deal_set_stage(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.answer("❌ У сделки не указана воронка")
             return
         
-        stages = get_funnel_stages(funnel_id)
+        stages = await data.get_funnel_stages(funnel_id)
         if not stages:
             await query.answer("❌ Стадии не найдены")
             return
@@ -940,7 +920,7 @@ async def deal_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("❌ Сделка не указана")
         return
     
-    deal = get_deal_by_id(deal_id)
+    deal = await data.get_deal_by_id(deal_id)
     if not deal:
         await query.answer("❌ Сделка не найдена")
         return
@@ -955,7 +935,7 @@ async def deal_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Удаляем в архив
-    if delete_deal(deal_id):
+    if await data.delete_deal(deal_id):
         await query.edit_message_text(
             "✅ Сделка удалена в архив",
             reply_markup=get_deals_menu()
@@ -963,6 +943,50 @@ async def deal_delete(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await query.answer("❌ Ошибка при удалении сделки")
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - метрики запросов к Firestore (только для администраторов)"""
+    try:
+        telegram_user_id = update.effective_user.id
+        if telegram_user_id not in user_sessions:
+            await update.message.reply_text("❌ Вы не авторизованы. Используйте /start")
+            return
+        
+        user_id = user_sessions[telegram_user_id]['user_id']
+        user = await async_firebase.get_by_id('users', user_id, fields=['role'])
+        if not user or user.get('role') != 'ADMIN':
+            await update.message.reply_text("❌ Доступно только администраторам")
+            return
+        
+        await update.message.reply_text(format_firestore_stats(metrics.snapshot()), parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Error in stats_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ Произошла ошибка при получении статистики.")
+        except:
+            pass
+
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /queue - состояние очереди уведомлений (только для администраторов)"""
+    try:
+        telegram_user_id = update.effective_user.id
+        if telegram_user_id not in user_sessions:
+            await update.message.reply_text("❌ Вы не авторизованы. Используйте /start")
+            return
+        
+        user_id = user_sessions[telegram_user_id]['user_id']
+        user = await async_firebase.get_by_id('users', user_id, fields=['role'])
+        if not user or user.get('role') != 'ADMIN':
+            await update.message.reply_text("❌ Доступно только администраторам")
+            return
+        
+        await update.message.reply_text(format_queue_stats(await data.get_queue_metrics()), parse_mode='HTML')
+    except Exception as e:
+        logger.error(f"Error in queue_command: {e}", exc_info=True)
+        try:
+            await update.message.reply_text("❌ Произошла ошибка при получении состояния очереди.")
+        except:
+            pass
+
 @require_auth
 async def group_id_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /group_id - показать ID группового чата"""
@@ -1003,7 +1027,7 @@ async def menu_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_user_id = update.effective_user.id
     user_id = user_sessions[telegram_user_id]['user_id']
     
-    user = get_user_profile(user_id)
+    user = await data.get_user_profile(user_id)
     if user:
         message = format_profile_message(user)
         await query.edit_message_text(message, reply_markup=get_profile_menu())
@@ -1024,7 +1048,7 @@ async def settings_notifications(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer()
     
     # Получаем настройки уведомлений
-    notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+    notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
     
     if not notification_prefs:
         # Создаем дефолтные настройки (все включены по умолчанию)
@@ -1050,7 +1074,7 @@ async def settings_notifications(update: Update, context: ContextTypes.DEFAULT_T
             'groupDailySummary': {'telegramGroup': True},
             'groupSuccessfulDeals': {'telegramGroup': True},
         }
-        firebase.save('notificationPrefs', notification_prefs)
+        await async_firebase.save('notificationPrefs', notification_prefs)
     
     message = "🔔 Настройки уведомлений\n\nВыберите категорию для настройки:"
     
@@ -1075,7 +1099,7 @@ async def settings_notif_tasks(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     
-    notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+    notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
     if not notification_prefs:
         notification_prefs = {'id': 'default'}
     
@@ -1117,7 +1141,7 @@ async def settings_notif_crm(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
     
-    notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+    notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
     if not notification_prefs:
         notification_prefs = {'id': 'default'}
     
@@ -1164,7 +1188,7 @@ async def settings_notif_docs(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     
-    notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+    notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
     if not notification_prefs:
         notification_prefs = {'id': 'default'}
     
@@ -1205,7 +1229,7 @@ async def settings_notif_meetings(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.answer()
     
-    notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+    notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
     if not notification_prefs:
         notification_prefs = {'id': 'default'}
     
@@ -1246,7 +1270,7 @@ async def settings_notif_finance(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
     
-    notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+    notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
     if not notification_prefs:
         notification_prefs = {'id': 'default'}
     
@@ -1294,7 +1318,7 @@ async def settings_notif_group(update: Update, context: ContextTypes.DEFAULT_TYP
         return
     
     user_id = user_sessions[telegram_user_id]['user_id']
-    user = firebase.get_by_id('users', user_id)
+    user = await async_firebase.get_by_id('users', user_id)
     
     if not user or user.get('role') != 'ADMIN':
         await query.answer("❌ Доступно только администраторам")
@@ -1304,7 +1328,7 @@ async def settings_notif_group(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return
     
-    notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+    notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
     if not notification_prefs:
         notification_prefs = {'id': 'default'}
     
@@ -1369,12 +1393,12 @@ async def settings_group_set_chat_id_input(update: Update, context: ContextTypes
             return SETTING_GROUP_CHAT_ID
         
         # Сохраняем ID
-        notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+        notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
         if not notification_prefs:
             notification_prefs = {'id': 'default'}
         
         notification_prefs['telegramGroupChatId'] = chat_id
-        firebase.save('notificationPrefs', notification_prefs)
+        await async_firebase.save('notificationPrefs', notification_prefs)
         
         await update.message.reply_text(
             f"✅ ID группового чата сохранен: {chat_id}",
@@ -1402,7 +1426,7 @@ async def settings_toggle_notification(update: Update, context: ContextTypes.DEF
             await query.answer("❌ Ошибка: название настройки не указано")
             return
         
-        notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+        notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
         if not notification_prefs:
             notification_prefs = {'id': 'default'}
         
@@ -1424,7 +1448,7 @@ async def settings_toggle_notification(update: Update, context: ContextTypes.DEF
         # Обновляем настройки
         notification_prefs[setting_name] = current_setting
         notification_prefs['id'] = 'default'
-        firebase.save('notificationPrefs', notification_prefs)
+        await async_firebase.save('notificationPrefs', notification_prefs)
         
         # Определяем, в какую категорию вернуться
         category = "settings_notifications"
@@ -1504,7 +1528,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         return  # Игнорируем сообщения, если пользователь не в процессе создания
     
     state = user_states[telegram_user_id].get('state')
-    data = user_states[telegram_user_id].get('data', {})
+    state_data = user_states[telegram_user_id].get('data', {})
     text = update.message.text.strip()
     
     try:
@@ -1520,7 +1544,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
                 'entityType': 'task'
             }
             
-            task_id = create_task(task_data)
+            task_id = await data.create_task(task_data)
             if task_id:
                 await update.message.reply_text(
                     f"✅ Задача '{text}' создана!",
@@ -1533,7 +1557,7 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             
         elif state == 'creating_deal_title':
             # Сохраняем название и запрашиваем описание
-            data['title'] = text
+            state_data['title'] = text
             user_states[telegram_user_id]['state'] = 'creating_deal_description'
             await update.message.reply_text(
                 "Введите описание заявки (или отправьте '-' чтобы пропустить):",
@@ -1543,12 +1567,12 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         elif state == 'creating_deal_description':
             # Создаем сделку
             if text != '-':
-                data['description'] = text
+                state_data['description'] = text
             
-            deal_id = create_deal(data)
+            deal_id = await data.create_deal(state_data)
             if deal_id:
                 await update.message.reply_text(
-                    f"✅ Заявка '{data.get('title', '')}' создана!",
+                    f"✅ Заявка '{state_data.get('title', '')}' создана!",
                     reply_markup=get_deals_menu()
                 )
             else:
@@ -1676,7 +1700,7 @@ async def task_from_message_date(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data['task_end_date'] = end_date
         
         # Получаем список пользователей для выбора исполнителя
-        users = firebase.get_all('users')
+        users = await async_firebase.get_all('users')
         active_users = [u for u in users if not u.get('isArchived')]
         
         if not active_users:
@@ -1746,12 +1770,11 @@ async def task_from_message_assignee_callback(update: Update, context: ContextTy
                 'endDate': task_end_date
             }
             
-            task_id = create_task(task_data)
+            task_id = await data.create_task(task_data)
             
             if task_id:
                 # Получаем имя исполнителя
-                users = firebase.get_all('users')
-                assignee = next((u for u in users if u.get('id') == assignee_id), None)
+                assignee = await async_firebase.get_by_id('users', assignee_id, fields=['name'])
                 assignee_name = assignee.get('name', 'Неизвестно') if assignee else 'Неизвестно'
                 
                 await query.edit_message_text(
@@ -1799,11 +1822,12 @@ async def show_task_in_group(update: Update, context: ContextTypes.DEFAULT_TYPE)
         search_query = ' '.join(context.args).strip()
         
         # Сначала пытаемся найти по ID
-        task = get_task_by_id(search_query)
+        task = await data.get_task_by_id(search_query)
         
         # Если не найдено по ID, ищем по названию
         if not task:
-            all_tasks = firebase.get_all('tasks')
+            # Для поиска по названию достаточно заголовков, полную задачу читаем после выбора
+            all_tasks = await async_firebase.get_all('tasks', fields=['title', 'isArchived'])
             matching_tasks = []
             search_lower = search_query.lower()
             
@@ -1818,7 +1842,7 @@ async def show_task_in_group(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 await update.message.reply_text(f"❌ Задача с ID или названием '{search_query}' не найдена.")
                 return
             elif len(matching_tasks) == 1:
-                task = matching_tasks[0]
+                task = await data.get_task_by_id(matching_tasks[0]['id'])
             else:
                 # Показываем список найденных задач
                 message = f"🔍 Найдено несколько задач ({len(matching_tasks)}):\n\n"
@@ -1831,11 +1855,11 @@ async def show_task_in_group(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 return
         
         # Получаем данные для форматирования
-        users = firebase.get_all('users')
-        projects = firebase.get_all('projects')
+        users = await async_firebase.get_many('users', [task.get('assigneeId'), task.get('createdByUserId')])
+        projects = await async_firebase.get_many('projects', [task.get('projectId')])
         
         # Форматируем сообщение
-        message = format_task_message(task, users, projects)
+        message = format_task_message(task, list(users.values()), list(projects.values()))
         
         await update.message.reply_text(message, parse_mode='HTML')
         
@@ -1862,11 +1886,11 @@ async def show_deal_in_group(update: Update, context: ContextTypes.DEFAULT_TYPE)
         search_query = ' '.join(context.args).strip()
         
         # Сначала пытаемся найти по ID
-        deal = get_deal_by_id(search_query)
+        deal = await data.get_deal_by_id(search_query)
         
         # Если не найдено по ID, ищем по названию
         if not deal:
-            all_deals = get_all_deals(include_archived=False)
+            all_deals = await data.get_all_deals(include_archived=False)
             matching_deals = []
             search_lower = search_query.lower()
             
@@ -1893,12 +1917,12 @@ async def show_deal_in_group(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 return
         
         # Получаем данные для форматирования
-        clients = firebase.get_all('clients')
-        users = firebase.get_all('users')
-        funnels = get_sales_funnels()
+        clients = await async_firebase.get_many('clients', [deal.get('clientId')])
+        users = await async_firebase.get_many('users', [deal.get('assigneeId')])
+        funnels = await data.get_sales_funnels()
         
         # Форматируем сообщение
-        message = format_deal_message(deal, clients, users, funnels)
+        message = format_deal_message(deal, list(clients.values()), list(users.values()), funnels)
         
         await update.message.reply_text(message, parse_mode='HTML')
         
@@ -1925,11 +1949,11 @@ async def show_meeting_in_group(update: Update, context: ContextTypes.DEFAULT_TY
         search_query = ' '.join(context.args).strip()
         
         # Сначала пытаемся найти по ID
-        meeting = firebase.get_by_id('meetings', search_query)
+        meeting = await async_firebase.get_by_id('meetings', search_query)
         
         # Если не найдено по ID, ищем по названию
         if not meeting:
-            all_meetings = firebase.get_all('meetings')
+            all_meetings = await async_firebase.get_all('meetings', fields=['title', 'isArchived'])
             matching_meetings = []
             search_lower = search_query.lower()
             
@@ -1944,7 +1968,7 @@ async def show_meeting_in_group(update: Update, context: ContextTypes.DEFAULT_TY
                 await update.message.reply_text(f"❌ Встреча с ID или названием '{search_query}' не найдена.")
                 return
             elif len(matching_meetings) == 1:
-                meeting = matching_meetings[0]
+                meeting = await async_firebase.get_by_id('meetings', matching_meetings[0]['id'])
             else:
                 # Показываем список найденных встреч
                 message = f"🔍 Найдено несколько встреч ({len(matching_meetings)}):\n\n"
@@ -1957,10 +1981,10 @@ async def show_meeting_in_group(update: Update, context: ContextTypes.DEFAULT_TY
                 return
         
         # Получаем данные для форматирования
-        users = firebase.get_all('users')
+        users = await async_firebase.get_many('users', meeting.get('participantIds') or [])
         
         # Форматируем сообщение
-        message = format_meeting_message(meeting, users)
+        message = format_meeting_message(meeting, list(users.values()))
         
         await update.message.reply_text(message, parse_mode='HTML')
         
@@ -1987,11 +2011,12 @@ async def show_document_in_group(update: Update, context: ContextTypes.DEFAULT_T
         search_query = ' '.join(context.args).strip()
         
         # Сначала пытаемся найти по ID
-        document = firebase.get_by_id('docs', search_query)
+        document = await async_firebase.get_by_id('docs', search_query)
         
         # Если не найдено по ID, ищем по названию
         if not document:
-            all_docs = firebase.get_all('docs')
+            # Не загружаем содержимое (content) всех документов ради поиска по названию
+            all_docs = await async_firebase.get_all('docs', fields=['title', 'isArchived'])
             matching_docs = []
             search_lower = search_query.lower()
             
@@ -2006,7 +2031,7 @@ async def show_document_in_group(update: Update, context: ContextTypes.DEFAULT_T
                 await update.message.reply_text(f"❌ Документ с ID или названием '{search_query}' не найден.")
                 return
             elif len(matching_docs) == 1:
-                document = matching_docs[0]
+                document = await async_firebase.get_by_id('docs', matching_docs[0]['id'])
             else:
                 # Показываем список найденных документов
                 message = f"🔍 Найдено несколько документов ({len(matching_docs)}):\n\n"
@@ -2019,10 +2044,10 @@ async def show_document_in_group(update: Update, context: ContextTypes.DEFAULT_T
                 return
         
         # Получаем данные для форматирования
-        users = firebase.get_all('users')
+        users = await async_firebase.get_many('users', [document.get('createdByUserId')])
         
         # Форматируем сообщение
-        message = format_document_message(document, users)
+        message = format_document_message(document, list(users.values()))
         
         await update.message.reply_text(message, parse_mode='HTML')
         
@@ -2033,59 +2058,181 @@ async def show_document_in_group(update: Update, context: ContextTypes.DEFAULT_T
         except:
             pass
 
+async def sqlite_sync(context: ContextTypes.DEFAULT_TYPE):
+    """Синхронизация SQLite зеркала с Firestore (в отдельном потоке, чтобы не блокировать бота)"""
+    try:
+        with attribute('sqlite_sync'):
+            await asyncio.to_thread(sqlite_mirror.sync)
+    except Exception as e:
+        logger.error(f"[SQLITE] Error in sqlite_sync: {e}", exc_info=True)
+
+async def queue_backlog_refresh(context: ContextTypes.DEFAULT_TYPE):
+    """Обновить размер очереди для /metrics (сам /metrics Firestore не читает)"""
+    try:
+        await data.refresh_queue_backlog()
+    except Exception as e:
+        logger.error(f"[QUEUE] Error in queue_backlog_refresh: {e}", exc_info=True)
+
+async def mirror_watchdog(context: ContextTypes.DEFAULT_TYPE):
+    """Переподписка зеркал коллекций, listener которых оборвался или замолчал"""
+    try:
+        await asyncio.to_thread(mirror.ensure_started)
+    except Exception as e:
+        logger.error(f"[MIRROR] Error in mirror_watchdog: {e}", exc_info=True)
+
+# Обработка очереди уведомлений: сразу по событию listener'а (Admin SDK) и опросом
+queue_watcher = (NotificationQueueWatcher()
+                 if USE_ADMIN_SDK and config.NOTIFICATION_QUEUE_LISTENER_ENABLED else None)
+notification_queue_lock = asyncio.Lock()
+notification_queue_rerun = False
+notification_queue_last_run = 0.0
+# Секунды (time.time()), на которые уже запланирована обработка отложенных сводок
+notification_queue_wakeups = set()
+
+NOTIFICATION_QUEUE_BATCH = 20
+
+async def send_queued_notifications(bot) -> int:
+    """Захватить и отправить пачку уведомлений из очереди; возвращает размер пачки"""
+    # Захватываем уведомления: другие процессы бота их не отправят, пока не истечет аренда.
+    # Отправка заканчивается раньше аренды (с запасом на запрос и отметки), иначе
+    # уведомление захватит и отправит повторно другой процесс
+    deadline = time.monotonic() + config.NOTIFICATION_LEASE_SECONDS - config.NOTIFICATION_LEASE_MARGIN
+    pending_notifications = await data.claim_pending_notifications(limit=NOTIFICATION_QUEUE_BATCH)
+    logger.info(f"[QUEUE] Claimed {len(pending_notifications)} pending notifications from queue")
+    if not pending_notifications:
+        return 0
+    # Только ID и тип: текст уведомлений и chatId в лог не пишем
+    logger.debug(f"[QUEUE] Claimed notifications: "
+                 f"{[(n.get('id'), n.get('type')) for n in pending_notifications]}")
+    
+    # Отправляем параллельно с учетом лимитов Telegram; отметки об отправке - одним commit
+    results = await dispatcher.dispatch(bot, pending_notifications, deadline=deadline)
+    marks = []
+    held_until = set()
+    for notification_task, error in results:
+        task_id = notification_task.get('id')
+        chat_id = notification_task.get('chatId')
+        notification_type = notification_task.get('type', 'unknown')
+        user_id = notification_task.get('userId', 'unknown')
+        
+        # Записи каждого уведомления - отдельно: если общий commit не пройдет, они пишутся по одному
+        mark = async_firebase.batch()
+        if isinstance(error, DigestHeld):
+            # Идет серия уведомлений в чат - ждем конца окна сводки, попытку не тратим
+            release_notification(notification_task, batch=mark, delay=error.until - time.time())
+            held_until.add(error.until)
+            logger.info(f"[QUEUE] Notification {task_id} ({notification_type}) held for digest")
+        elif isinstance(error, DeadlineExceeded):
+            # Не отправлялось - освобождаем для следующего тика без траты попытки
+            release_notification(notification_task, batch=mark)
+            logger.warning(f"[QUEUE] Notification {task_id} ({notification_type}) deferred: lease deadline reached")
+        elif error is None:
+            mark_notification_sent(task_id, success=True, batch=mark)
+            logger.info(f"[QUEUE] ✅ Successfully sent notification {task_id} ({notification_type}, userId={user_id}) to chat {chat_id}")
+        else:
+            # Временная ошибка - повтор с задержкой, постоянная - в notificationDeadLetter
+            mark_notification_failed(notification_task, str(error),
+                                     permanent=is_permanent_error(error), batch=mark)
+            logger.error(f"[QUEUE] ❌ Error sending notification {task_id} ({notification_type}, userId={user_id}) to {chat_id}: {error}")
+        marks.append((task_id, mark.writes))
+    
+    unmarked = await data.commit_notification_marks(marks)
+    if unmarked:
+        logger.error(f"[QUEUE] Could not mark {len(unmarked)} notifications: {', '.join(unmarked)}")
+    for until in held_until:
+        schedule_notification_queue(bot, until)
+    return len(pending_notifications)
+
+def schedule_notification_queue(bot, at: float) -> None:
+    """Запустить обработку очереди после at (time.time()), когда отложенные сводки можно захватить"""
+    # Сводки чатов одной серии откладываются до близких моментов - одна обработка на секунду
+    second = int(at) + 1
+    if second in notification_queue_wakeups:
+        return
+    notification_queue_wakeups.add(second)
+    def wake():
+        notification_queue_wakeups.discard(second)
+        asyncio.ensure_future(process_notification_queue(bot))
+    asyncio.get_running_loop().call_later(max(0.0, second - time.time()), wake)
+
+async def process_notification_queue(bot) -> None:
+    """
+    Отправить ожидающие уведомления
+    
+    Вызовы во время обработки не запускают вторую обработку параллельно, а
+    объединяются в один повтор после текущей. Полная пачка - сразу следующая.
+    """
+    global notification_queue_rerun, notification_queue_last_run
+    if notification_queue_lock.locked():
+        notification_queue_rerun = True
+        return
+    async with notification_queue_lock:
+        notification_queue_rerun = True
+        while notification_queue_rerun:
+            notification_queue_rerun = False
+            notification_queue_last_run = time.monotonic()
+            try:
+                if await send_queued_notifications(bot) >= NOTIFICATION_QUEUE_BATCH:
+                    notification_queue_rerun = True
+            except Exception as e:
+                logger.error(f"[QUEUE] Error processing notification queue: {e}", exc_info=True)
+
+async def notification_queue_poll(context: ContextTypes.DEFAULT_TYPE):
+    """Опрос очереди: часто без listener'а, редко (повторы, истекшие аренды) - при работающем listener'е"""
+    if queue_watcher is not None:
+        queue_watcher.ensure_started()
+        if (queue_watcher.active
+                and time.monotonic() - notification_queue_last_run < config.NOTIFICATION_QUEUE_FALLBACK_INTERVAL):
+            return
+    await process_notification_queue(context.bot)
+
+async def notification_cleanup(context: ContextTypes.DEFAULT_TYPE):
+    """Удаление старых отправленных уведомлений из очереди (отдельно от тиков отправки)"""
+    try:
+        deleted = await data.cleanup_old_notifications(days=config.NOTIFICATION_RETENTION_DAYS)
+        if deleted >= config.NOTIFICATION_CLEANUP_LIMIT:
+            # Удалены не все - продолжаем через минуту, не дожидаясь следующего часа
+            context.job_queue.run_once(notification_cleanup, 60)
+    except Exception as e:
+        logger.error(f"[QUEUE] Error in notification_cleanup: {e}", exc_info=True)
+
 async def periodic_check(context: ContextTypes.DEFAULT_TYPE):
-    """Периодическая проверка новых задач, заявок и обработка очереди уведомлений"""
+    """Периодическая проверка новых задач и заявок"""
     try:
         now = datetime.now()
         
-        # Обрабатываем очередь уведомлений из Firebase (от веб-приложения)
+        # Задачи, измененные с прошлого тика (один запрос на всех пользователей)
         try:
-            pending_notifications = get_pending_notifications(limit=20)
-            logger.info(f"[PERIODIC] ===== PROCESSING NOTIFICATION QUEUE =====")
-            logger.info(f"[PERIODIC] Found {len(pending_notifications)} pending notifications from queue")
-            
-            if pending_notifications:
-                logger.info(f"[PERIODIC] First notification sample: {pending_notifications[0]}")
-            
-            for notification_task in pending_notifications:
-                task_id = notification_task.get('id')
-                chat_id = notification_task.get('chatId')
-                message = notification_task.get('message')
-                notification_type = notification_task.get('type', 'unknown')
-                user_id = notification_task.get('userId', 'unknown')
-                
-                logger.info(f"[PERIODIC] Processing notification {task_id}: type={notification_type}, userId={user_id}, chatId={chat_id}")
-                
-                if not chat_id or not message:
-                    logger.warning(f"[PERIODIC] ❌ Invalid notification task {task_id}: missing chatId ({chat_id}) or message ({bool(message)})")
-                    mark_notification_sent(task_id, success=False, error="Missing chatId or message")
-                    continue
-                
-                try:
-                    await context.bot.send_message(
-                        chat_id=chat_id,
-                        text=message,
-                        parse_mode='HTML'
-                    )
-                    mark_notification_sent(task_id, success=True)
-                    logger.info(f"[PERIODIC] ✅ Successfully sent notification {task_id} to chat {chat_id}")
-                except Exception as e:
-                    error_msg = str(e)
-                    mark_notification_sent(task_id, success=False, error=error_msg)
-                    logger.error(f"[PERIODIC] ❌ Error sending notification {task_id} to {chat_id}: {e}", exc_info=True)
-                    logger.error(f"[PERIODIC] Error details: {error_msg}")
-            
-            # Очищаем старые уведомления (раз в час, проверяем случайно)
-            import random
-            if random.random() < 0.1:  # 10% вероятность
-                cleanup_old_notifications(days=7)
+            changed_tasks = await data.poll_task_changes()
         except Exception as e:
-            logger.error(f"[PERIODIC] Error processing notification queue: {e}", exc_info=True)
+            # Watermark не сдвинулся - изменения будут получены в следующем тике
+            logger.error(f"[PERIODIC] Error polling task changes: {e}", exc_info=True)
+            changed_tasks = []
         
-        # Проверяем активность пользователей
-        for telegram_user_id, session in list(user_sessions.items()):
+        # Настройки уведомлений общие для всех пользователей - читаем один раз за тик
+        notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
+        
+        # ВСЕ УВЕДОМЛЕНИЯ БАЗОВО АКТИВНЫ - если настройка не существует, считаем что она включена
+        new_task_setting = {'telegramPersonal': True, 'telegramGroup': False}
+        if notification_prefs:
+            new_task_setting = notification_prefs.get('newTask', new_task_setting)
+            # Если настройка существует но не является словарем, используем дефолтную
+            if not isinstance(new_task_setting, dict):
+                new_task_setting = {'telegramPersonal': True, 'telegramGroup': False}
+        notify_new_tasks = new_task_setting.get('telegramPersonal', True)
+        
+        # Один проход по измененным задачам: пользователь -> его новые задачи
+        task_index = NewTaskIndex(changed_tasks or [])
+        
+        # Активность всех пользователей с сессиями - одним запросом
+        sessions = list(user_sessions.items())
+        active_users = await data.check_users_active([session['user_id'] for _, session in sessions])
+        
+        # Уведомления для всех сессий: (chat_id, задача, задача назначена на пользователя)
+        routed = []
+        for telegram_user_id, session in sessions:
             user_id = session['user_id']
-            if not check_user_active(user_id):
+            if not active_users.get(user_id, False):
                 del user_sessions[telegram_user_id]
                 if telegram_user_id in user_states:
                     del user_states[telegram_user_id]
@@ -2098,129 +2245,83 @@ async def periodic_check(context: ContextTypes.DEFAULT_TYPE):
                     pass
                 continue
             
-            # Проверяем новые задачи
             last_check = session.get('last_check', now)
-            
-            # Получаем настройки уведомлений
-            notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
-            # ВСЕ УВЕДОМЛЕНИЯ БАЗОВО АКТИВНЫ - если настройка не существует, считаем что она включена
-            if notification_prefs:
-                new_task_setting = notification_prefs.get('newTask', {'telegramPersonal': True, 'telegramGroup': False})
-                # Если настройка существует но не является словарем, создаем дефолтную
-                if not isinstance(new_task_setting, dict):
-                    new_task_setting = {'telegramPersonal': True, 'telegramGroup': False}
-            else:
-                # Если настроек вообще нет, все уведомления включены по умолчанию
-                new_task_setting = {'telegramPersonal': True, 'telegramGroup': False}
+            # Обновляем время последней проверки
+            session['last_check'] = now
             
             # Проверяем, включены ли уведомления о новых задачах (по умолчанию True)
-            if new_task_setting.get('telegramPersonal', True):
-                new_tasks = check_new_tasks(user_id, last_check)
+            if not notify_new_tasks:
+                continue
+            new_tasks = task_index.for_user(user_id, last_check)
+            if new_tasks:
                 logger.info(f"[PERIODIC] Found {len(new_tasks)} new tasks for user {user_id}")
-                
-                for task in new_tasks:
-                    # Проверяем, назначена ли задача на пользователя или создана пользователем
-                    assignee_id = task.get('assigneeId')
-                    assignee_ids = task.get('assigneeIds', [])
-                    created_by = task.get('createdByUserId')
-                    
-                    is_assigned = (assignee_id and str(assignee_id) == str(user_id)) or \
-                                 (isinstance(assignee_ids, list) and user_id in [str(uid) for uid in assignee_ids if uid])
-                    is_created_by = created_by and str(created_by) == str(user_id)
-                    
-                    # Отправляем уведомление если задача назначена на пользователя
-                    if is_assigned:
-                        users = firebase.get_all('users')
-                        projects = firebase.get_all('projects')
-                        assignee_user = next((u for u in users if u.get('id') == assignee_id), None)
-                        assignee_name = assignee_user.get('name', 'Неизвестно') if assignee_user else 'Не назначено'
-                        
-                        # Форматируем сообщение о новой задаче
-                        message = f"🆕 <b>Новая задача</b>\n\n"
-                        message += f"📝 <b>Задача:</b> {task.get('title', 'Без названия')}\n"
-                        message += f"👤 <b>Ответственный:</b> {assignee_name}\n"
-                        if task.get('endDate'):
-                            # Форматируем дату
-                            try:
-                                from datetime import datetime
-                                end_date = task.get('endDate')
-                                if 'T' in end_date:
-                                    end_date = end_date.split('T')[0]
-                                elif ' ' in end_date:
-                                    end_date = end_date.split(' ')[0]
-                                date_obj = datetime.strptime(end_date, '%Y-%m-%d')
-                                message += f"📅 <b>Срок:</b> {date_obj.strftime('%d.%m.%Y')}\n"
-                            except:
-                                message += f"📅 <b>Срок:</b> {task.get('endDate')}\n"
-                        if task.get('priority'):
-                            message += f"⚡ <b>Приоритет:</b> {task.get('priority')}\n"
-                        
-                        keyboard = get_task_menu(task.get('id'))
-                        try:
-                            await context.bot.send_message(
-                                chat_id=telegram_user_id,
-                                text=message,
-                                reply_markup=keyboard,
-                                parse_mode='HTML'
-                            )
-                            logger.info(f"[PERIODIC] Sent new task notification to {telegram_user_id} for task {task.get('id')}")
-                        except Exception as e:
-                            logger.error(f"Error sending task notification: {e}", exc_info=True)
-                    
-                    # Также отправляем уведомление создателю, если он не является исполнителем
-                    elif is_created_by and assignee_id and str(assignee_id) != str(user_id):
-                        users = firebase.get_all('users')
-                        assignee_user = next((u for u in users if u.get('id') == assignee_id), None)
-                        assignee_name = assignee_user.get('name', 'Неизвестно') if assignee_user else 'Не назначено'
-                        
-                        message = f"🆕 <b>Вы создали задачу</b>\n\n"
-                        message += f"📝 <b>Задача:</b> {task.get('title', 'Без названия')}\n"
-                        message += f"👤 <b>Ответственный:</b> {assignee_name}\n"
-                        if task.get('endDate'):
-                            try:
-                                from datetime import datetime
-                                end_date = task.get('endDate')
-                                if 'T' in end_date:
-                                    end_date = end_date.split('T')[0]
-                                elif ' ' in end_date:
-                                    end_date = end_date.split(' ')[0]
-                                date_obj = datetime.strptime(end_date, '%Y-%m-%d')
-                                message += f"📅 <b>Срок:</b> {date_obj.strftime('%d.%m.%Y')}\n"
-                            except:
-                                message += f"📅 <b>Срок:</b> {task.get('endDate')}\n"
-                        
-                        keyboard = get_task_menu(task.get('id'))
-                        try:
-                            await context.bot.send_message(
-                                chat_id=telegram_user_id,
-                                text=message,
-                                reply_markup=keyboard,
-                                parse_mode='HTML'
-                            )
-                            logger.info(f"[PERIODIC] Sent task created notification to {telegram_user_id} for task {task.get('id')}")
-                        except Exception as e:
-                            logger.error(f"Error sending task created notification: {e}", exc_info=True)
+            
+            for task in new_tasks:
+                # Задача назначена на пользователя или создана им
+                assignee_id = task.get('assigneeId')
+                assignee_ids = task.get('assigneeIds', [])
+                is_assigned = (assignee_id and str(assignee_id) == str(user_id)) or \
+                             (isinstance(assignee_ids, list) and str(user_id) in [str(uid) for uid in assignee_ids if uid])
+                # Создателю уведомление - только если исполнитель другой
+                if is_assigned or (assignee_id and str(assignee_id) != str(user_id)):
+                    routed.append((telegram_user_id, task, is_assigned))
+        
+        # Имена исполнителей всех задач тика - одним запросом
+        assignee_names = {}
+        if routed:
+            assignees = await async_firebase.get_many(
+                'users', [task.get('assigneeId') for _, task, _ in routed], fields=['name'])
+            assignee_names = {user_id: user.get('name', 'Неизвестно') for user_id, user in assignees.items()}
+        
+        for telegram_user_id, task, is_assigned in routed:
+            assignee_name = assignee_names.get(task.get('assigneeId'), 'Не назначено')
+            if is_assigned:
+                message = f"🆕 <b>Новая задача</b>\n\n"
             else:
-                logger.debug(f"[PERIODIC] New task notifications disabled for user {user_id}")
+                message = f"🆕 <b>Вы создали задачу</b>\n\n"
+            message += f"📝 <b>Задача:</b> {task.get('title', 'Без названия')}\n"
+            message += f"👤 <b>Ответственный:</b> {assignee_name}\n"
+            if task.get('endDate'):
+                # Форматируем дату
+                try:
+                    end_date = task.get('endDate')
+                    if 'T' in end_date:
+                        end_date = end_date.split('T')[0]
+                    elif ' ' in end_date:
+                        end_date = end_date.split(' ')[0]
+                    date_obj = datetime.strptime(end_date, '%Y-%m-%d')
+                    message += f"📅 <b>Срок:</b> {date_obj.strftime('%d.%m.%Y')}\n"
+                except:
+                    message += f"📅 <b>Срок:</b> {task.get('endDate')}\n"
+            if is_assigned and task.get('priority'):
+                message += f"⚡ <b>Приоритет:</b> {task.get('priority')}\n"
             
-            # Обновляем время последней проверки
-            session['last_check'] = now
+            keyboard = get_task_menu(task.get('id'))
+            try:
+                await context.bot.send_message(
+                    chat_id=telegram_user_id,
+                    text=message,
+                    reply_markup=keyboard,
+                    parse_mode='HTML'
+                )
+                logger.info(f"[PERIODIC] Sent new task notification to {telegram_user_id} for task {task.get('id')}")
+            except Exception as e:
+                logger.error(f"Error sending task notification: {e}", exc_info=True)
         
-        # Проверяем успешные сделки для групповых уведомлений
-        notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+        # Проверяем успешные сделки для групповых уведомлений.
+        # Ленту опрашиваем всегда, чтобы при включении уведомлений не отправить накопленные сделки;
+        # берем только сделки, перешедшие в 'won' с прошлого тика, а не все выигранные сегодня
+        won_deals = await data.get_newly_won_deals()
         if notification_prefs:
             # Проверяем, включены ли уведомления об успешных сделках
             group_successful_deals = notification_prefs.get('groupSuccessfulDeals', {'telegramGroup': True})
             if group_successful_deals.get('telegramGroup', True):
-                won_deals = get_won_deals_today()
                 if won_deals:
                     telegram_chat_id = notification_prefs.get('telegramGroupChatId')
                     
                     if telegram_chat_id:
-                        clients = firebase.get_all('clients')
-                        users = firebase.get_all('users')
                         for deal in won_deals:
-                            message = get_successful_deal_message(deal, clients, users)
+                            message = await data.get_successful_deal_message(deal)
                             if message:
                                 try:
                                     await context.bot.send_message(
@@ -2365,6 +2466,8 @@ def main():
     application.add_handler(CommandHandler('logout', logout))
     application.add_handler(CommandHandler('help', help_command))
     application.add_handler(CommandHandler('group_id', group_id_command))
+    application.add_handler(CommandHandler('stats', stats_command))
+    application.add_handler(CommandHandler('queue', queue_command))
     
     # Команды для работы в группах (показывают сущности)
     application.add_handler(CommandHandler('task', show_task_in_group))
@@ -2438,6 +2541,14 @@ def main():
     # Периодическая проверка (каждые 10 секунд для быстрой доставки уведомлений)
     job_queue = application.job_queue
     job_queue.run_repeating(periodic_check, interval=10, first=5)
+    job_queue.run_repeating(notification_queue_poll, interval=config.NOTIFICATION_QUEUE_POLL_INTERVAL, first=5)
+    job_queue.run_repeating(notification_cleanup, interval=config.NOTIFICATION_CLEANUP_INTERVAL, first=60)
+    job_queue.run_repeating(queue_backlog_refresh, interval=config.NOTIFICATION_QUEUE_HEALTH_TTL, first=15)
+    if sqlite_mirror is not None:
+        job_queue.run_repeating(sqlite_sync, interval=config.FIREBASE_SQLITE_SYNC_INTERVAL, first=1)
+    if mirror is not None and config.FIREBASE_MIRROR_CHECK_INTERVAL > 0:
+        job_queue.run_repeating(mirror_watchdog, interval=config.FIREBASE_MIRROR_CHECK_INTERVAL,
+                                first=config.FIREBASE_MIRROR_CHECK_INTERVAL)
     
     # Запускаем планировщик задач
     scheduler = TaskScheduler(application.bot)
@@ -2457,10 +2568,47 @@ def main():
     async def post_init(application: Application) -> None:
         """Вызывается после инициализации приложения"""
         logger.info("[BOT] Application initialized, polling will start")
+        if mirror is not None:
+            # Подписываемся на коллекции; пока первые снимки не пришли, чтение идет из Firestore
+            mirror.start()
+        if queue_watcher is not None:
+            # Событие listener'а приходит в его потоке - обработку запускаем в event loop бота
+            loop = asyncio.get_running_loop()
+            def on_pending():
+                loop.call_soon_threadsafe(lambda: application.create_task(process_notification_queue(application.bot)))
+            try:
+                queue_watcher.start(on_pending)
+            except Exception as e:
+                logger.error(f"[BOT] Error subscribing to notification queue: {e}", exc_info=True)
+        
+        # Статистика остальных слоев доступа к данным - в /stats и /metrics.json
+        metrics.add_source('executor', data.executor.stats)
+        metrics.add_source('dispatcher', dispatcher.stats)
+        # Размер очереди: из listener'а, если он работает, иначе запросом к Firestore
+        queue_metrics.set_backlog_source(
+            lambda: queue_watcher.backlog() if queue_watcher is not None and queue_watcher.ready
+            else get_queue_backlog())
+        # В /stats - без запросов к Firestore (команда выполняется в event loop)
+        metrics.add_source('notification_queue', lambda: queue_metrics.snapshot(refresh_backlog=False))
+        metrics.add_prometheus_source(queue_metrics.prometheus)
+        for name, source in (('cache', cache), ('single_flight', flights), ('sqlite', sqlite_mirror), ('mirror', mirror),
+                             ('queue_watcher', queue_watcher)):
+            if source is not None:
+                metrics.add_source(name, source.stats)
+        if config.METRICS_PORT:
+            start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
     
     async def post_shutdown(application: Application) -> None:
         """Вызывается при остановке приложения"""
         logger.info("[BOT] Application shutting down")
+        if mirror is not None:
+            mirror.stop()
+        if queue_watcher is not None:
+            queue_watcher.stop()
+        if sqlite_mirror is not None:
+            sqlite_mirror.close()
+        data.executor.shutdown()
+        await async_firebase.aclose()
     
     application.post_init = post_init
     application.post_shutdown = post_shutdown
@@ -0,0 +1,95 @@
+"""
+Инкрементальная лента изменений коллекции по водяному знаку updatedAt
+
+ChangeFeed.poll() возвращает только документы, измененные после предыдущего
+вызова, и сдвигает курсор на (updatedAt, id) последнего из них. Документы идут
+по возрастанию (updatedAt, id), поэтому изменения с одинаковым updatedAt на
+границе страницы не теряются. Стоимость опроса пропорциональна числу изменений,
+а не размеру коллекции.
+
+Курсор (watermark и watermarkId) хранится в Firestore (коллекция botState), поэтому после перезапуска
+бот продолжает с того же места, а не пересылает уведомления заново.
+"""
+import logging
+from typing import List, Dict, Any, Optional
+from firebase_client import firebase
+from firebase_common import CHANGE_FEED_FIELD
+from utils import get_utc_timestamp
+
+logger = logging.getLogger(__name__)
+
+CHANGE_FEED_STATE_COLLECTION = 'botState'
+
+# Документов за один запрос к ленте
+CHANGE_FEED_PAGE_SIZE = 500
+
+class ChangeFeed:
+    """
+    Лента изменений одной коллекции
+
+    Args:
+        collection_name: Название коллекции
+        name: Имя ленты (ключ сохраненного watermark), по умолчанию - название коллекции
+        field: Поле времени изменения (ISO строка)
+        fields: Возвращаемые поля (None - все поля)
+    """
+
+    def __init__(self, collection_name: str, name: Optional[str] = None,
+                 field: str = CHANGE_FEED_FIELD, fields: Optional[List[str]] = None):
+        self.collection_name = collection_name
+        self.name = name or collection_name
+        self.field = field
+        self.fields = fields
+        self.watermark: Optional[str] = None
+        # ID последнего полученного документа с updatedAt == watermark (None - курсор только по watermark)
+        self.watermark_id: Optional[str] = None
+        self._loaded = False
+
+    @property
+    def state_id(self) -> str:
+        return f"changeFeed_{self.name}"
+
+    def _load(self) -> None:
+        """Прочитать сохраненный watermark; при первом запуске лента начинается с текущего момента"""
+        state = firebase.get_by_id(CHANGE_FEED_STATE_COLLECTION, self.state_id)
+        if state and state.get('watermark'):
+            self.watermark = state['watermark']
+            self.watermark_id = state.get('watermarkId')
+        else:
+            # Формат как у updatedAt веб-приложения (UTC, Z), иначе строки сравниваются со сдвигом пояса
+            self.watermark = get_utc_timestamp()
+            self._save()
+        self._loaded = True
+        logger.info(f"[CHANGE_FEED] {self.name}: starting from watermark {self.watermark}")
+
+    def _save(self) -> None:
+        firebase.save(CHANGE_FEED_STATE_COLLECTION, {
+            'id': self.state_id,
+            'collection': self.collection_name,
+            'field': self.field,
+            'watermark': self.watermark,
+            'watermarkId': self.watermark_id,
+            'updatedAt': get_utc_timestamp()
+        })
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """Документы, измененные с прошлого опроса (по возрастанию field, затем id)"""
+        if not self._loaded:
+            self._load()
+
+        changes = []
+        watermark, watermark_id = self.watermark, self.watermark_id
+        while True:
+            page = firebase.get_changed_since(self.collection_name, watermark, field=self.field,
+                                              limit=CHANGE_FEED_PAGE_SIZE, fields=self.fields,
+                                              after_id=watermark_id)
+            changes.extend(page)
+            if page:
+                watermark, watermark_id = page[-1].get(self.field, watermark), page[-1]['id']
+            if len(page) < CHANGE_FEED_PAGE_SIZE:
+                break
+
+        if (watermark, watermark_id) != (self.watermark, self.watermark_id):
+            self.watermark, self.watermark_id = watermark, watermark_id
+            self._save()
+        return changes
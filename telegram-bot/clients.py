@@ -4,6 +4,7 @@
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 from firebase_client import firebase
+from utils import get_utc_timestamp
 
 def get_all_clients(include_archived: bool = False) -> List[Dict[str, Any]]:
     """Получить всех клиентов"""
@@ -23,7 +24,7 @@ def get_client_by_id(client_id: str) -> Optional[Dict[str, Any]]:
 def create_client(client_data: Dict[str, Any]) -> Optional[str]:
     """Создать нового клиента"""
     try:
-        now = datetime.now().isoformat()
+        now = get_utc_timestamp()
         client_data['createdAt'] = client_data.get('createdAt', now)
         client_data['updatedAt'] = now
         client_data['isArchived'] = False
@@ -16,6 +16,98 @@ FIREBASE_PROJECT_ID = os.getenv('FIREBASE_PROJECT_ID', 'tipa-task-manager')
 FIREBASE_CREDENTIALS_PATH = os.getenv('FIREBASE_CREDENTIALS_PATH', '')
 FIREBASE_API_KEY = os.getenv('FIREBASE_API_KEY', '')
 
+# Размер пула keep-alive соединений к Firestore REST API
+FIREBASE_HTTP_POOL_SIZE = int(os.getenv('FIREBASE_HTTP_POOL_SIZE', '20'))
+
+# Метрики запросов к Firestore (firebase_metrics.py) и HTTP endpoint /metrics (порт 0 - без endpoint)
+FIREBASE_METRICS_ENABLED = os.getenv('FIREBASE_METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+
+# Объединение одновременных одинаковых запросов чтения (single-flight)
+FIREBASE_SINGLE_FLIGHT_ENABLED = os.getenv('FIREBASE_SINGLE_FLIGHT_ENABLED', 'true').lower() == 'true'
+
+# Кэш справочных коллекций Firestore (in-memory, read-through)
+FIREBASE_CACHE_ENABLED = os.getenv('FIREBASE_CACHE_ENABLED', 'true').lower() == 'true'
+FIREBASE_CACHE_MAX_ENTRIES = int(os.getenv('FIREBASE_CACHE_MAX_ENTRIES', '1000'))
+# Время жизни записей кэша по коллекциям (секунды); коллекции не из списка не кэшируются
+FIREBASE_CACHE_TTLS = {
+    'users': 60,
+    'clients': 120,
+    'projects': 300,
+    'statuses': 300,
+    'salesFunnels': 300,
+    'notificationPrefs': 30,
+}
+
+# Локальное зеркало коллекций через snapshot listener'ы (только с Admin SDK)
+FIREBASE_MIRROR_ENABLED = os.getenv('FIREBASE_MIRROR_ENABLED', 'true').lower() == 'true'
+FIREBASE_MIRROR_COLLECTIONS = ['tasks', 'deals', 'users', 'meetings', 'notificationPrefs']
+# Подписка без снимков и ответов сервера дольше MAX_SILENCE секунд считается зависшей:
+# чтение идет в Firestore, а проверка раз в CHECK_INTERVAL секунд переподписывается (0 - не проверять)
+FIREBASE_MIRROR_MAX_SILENCE = int(os.getenv('FIREBASE_MIRROR_MAX_SILENCE', '900'))
+FIREBASE_MIRROR_CHECK_INTERVAL = int(os.getenv('FIREBASE_MIRROR_CHECK_INTERVAL', '30'))
+
+# Постоянное зеркало коллекций в SQLite (быстрый старт с данными, чтение при недоступном Firestore)
+FIREBASE_SQLITE_ENABLED = os.getenv('FIREBASE_SQLITE_ENABLED', 'true').lower() == 'true'
+FIREBASE_SQLITE_PATH = os.getenv('FIREBASE_SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'firestore_mirror.sqlite3'))
+# Только коллекции, где веб-приложение ставит updatedAt при каждой записи: изменения остальных
+# инкрементальная синхронизация не видит, их читаем через кэш и зеркало в памяти
+FIREBASE_SQLITE_COLLECTIONS = ['tasks', 'deals']
+# Поля с индексами json_extract
+FIREBASE_SQLITE_INDEXED_FIELDS = ['assigneeId', 'endDate', 'status', 'funnelId', 'stage']
+# Период инкрементальной синхронизации (документы после курсора (updatedAt, id)) и полной пересинхронизации, секунды
+FIREBASE_SQLITE_SYNC_INTERVAL = int(os.getenv('FIREBASE_SQLITE_SYNC_INTERVAL', '10'))
+FIREBASE_SQLITE_FULL_SYNC_INTERVAL = int(os.getenv('FIREBASE_SQLITE_FULL_SYNC_INTERVAL', '3600'))
+# Период сверки списка ID с Firestore (удаленные документы), секунды
+FIREBASE_SQLITE_RECONCILE_INTERVAL = int(os.getenv('FIREBASE_SQLITE_RECONCILE_INTERVAL', '300'))
+
+# Пул потоков для блокирующих вызовов из обработчиков бота (Firestore, bcrypt), см. data.py
+DATA_EXECUTOR_WORKERS = int(os.getenv('DATA_EXECUTOR_WORKERS', '16'))
+# Ожидание свободного потока дольше этого (секунды) - предупреждение о перегрузке пула
+DATA_EXECUTOR_WAIT_WARNING = float(os.getenv('DATA_EXECUTOR_WAIT_WARNING', '1.0'))
+
+# Очередь уведомлений: listener на новые уведомления (только Admin SDK) и опрос.
+# Без listener'а (REST API или подписка оборвалась) очередь опрашивается каждые
+# POLL_INTERVAL секунд, с listener'ом - раз в FALLBACK_INTERVAL (повторы, истекшие аренды)
+NOTIFICATION_QUEUE_LISTENER_ENABLED = os.getenv('NOTIFICATION_QUEUE_LISTENER_ENABLED', 'true').lower() == 'true'
+NOTIFICATION_QUEUE_POLL_INTERVAL = int(os.getenv('NOTIFICATION_QUEUE_POLL_INTERVAL', '10'))
+NOTIFICATION_QUEUE_FALLBACK_INTERVAL = int(os.getenv('NOTIFICATION_QUEUE_FALLBACK_INTERVAL', '60'))
+
+# Очистка очереди от отправленных уведомлений старше RETENTION_DAYS: отдельная задача
+# раз в CLEANUP_INTERVAL секунд, не больше CLEANUP_LIMIT удалений за запуск
+# (если удалено столько, следующий запуск - через минуту)
+NOTIFICATION_RETENTION_DAYS = int(os.getenv('NOTIFICATION_RETENTION_DAYS', '7'))
+NOTIFICATION_CLEANUP_INTERVAL = int(os.getenv('NOTIFICATION_CLEANUP_INTERVAL', '3600'))
+NOTIFICATION_CLEANUP_LIMIT = int(os.getenv('NOTIFICATION_CLEANUP_LIMIT', '5000'))
+
+# Метрики очереди (notification_metrics.py): как долго хранить размер очереди (секунды)
+# и сколько неотправленных уведомлений читать для него без listener'а
+NOTIFICATION_QUEUE_HEALTH_TTL = int(os.getenv('NOTIFICATION_QUEUE_HEALTH_TTL', '60'))
+NOTIFICATION_QUEUE_HEALTH_MAX_SCAN = int(os.getenv('NOTIFICATION_QUEUE_HEALTH_MAX_SCAN', '1000'))
+
+# Отправка уведомлений из очереди (notification_dispatcher.py): лимиты Telegram
+NOTIFICATION_GLOBAL_RATE = float(os.getenv('NOTIFICATION_GLOBAL_RATE', '25'))  # сообщений в секунду
+NOTIFICATION_CHAT_INTERVAL = float(os.getenv('NOTIFICATION_CHAT_INTERVAL', '1.0'))  # секунд между сообщениями в чат
+NOTIFICATION_GROUP_INTERVAL = float(os.getenv('NOTIFICATION_GROUP_INTERVAL', '3.0'))  # то же для групп
+NOTIFICATION_DISPATCH_CONCURRENCY = int(os.getenv('NOTIFICATION_DISPATCH_CONCURRENCY', '8'))
+# Сколько раз повторять сообщение после RetryAfter, прежде чем считать отправку неудачной
+NOTIFICATION_RETRY_AFTER_RETRIES = int(os.getenv('NOTIFICATION_RETRY_AFTER_RETRIES', '3'))
+# Уведомления в один чат, созданные в пределах окна (секунды), отправляются одной сводкой (0 - без сводок)
+# Во время серии (в чат уже писали в пределах окна) сводка ждет конца окна от первого уведомления
+NOTIFICATION_DIGEST_WINDOW = float(os.getenv('NOTIFICATION_DIGEST_WINDOW', '60'))
+# Срок аренды захваченного уведомления (секунды): после него уведомление упавшего
+# обработчика снова доступно для отправки
+NOTIFICATION_LEASE_SECONDS = int(os.getenv('NOTIFICATION_LEASE_SECONDS', '120'))
+# Отправка пачки прекращается за столько секунд до конца аренды (запас на запрос к Telegram
+# и запись отметок); неотправленные уведомления освобождаются для следующего тика
+NOTIFICATION_LEASE_MARGIN = int(os.getenv('NOTIFICATION_LEASE_MARGIN', '30'))
+# Повторы после временных ошибок: задержка BASE * 2^(попытка-1), не больше MAX (секунды);
+# после MAX_ATTEMPTS попыток уведомление переносится в notificationDeadLetter
+NOTIFICATION_RETRY_BASE_DELAY = float(os.getenv('NOTIFICATION_RETRY_BASE_DELAY', '30'))
+NOTIFICATION_RETRY_MAX_DELAY = float(os.getenv('NOTIFICATION_RETRY_MAX_DELAY', '3600'))
+NOTIFICATION_MAX_ATTEMPTS = int(os.getenv('NOTIFICATION_MAX_ATTEMPTS', '8'))
+
 # Часовой пояс по умолчанию
 DEFAULT_TIMEZONE = os.getenv('DEFAULT_TIMEZONE', 'Asia/Tashkent')
 
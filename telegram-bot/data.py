@@ -0,0 +1,204 @@
+"""
+Асинхронный доступ к данным для обработчиков bot.py
+
+Функции tasks.py, deals.py, clients.py, auth.py, notification_queue.py и
+notifications.py синхронные: запросы к Firestore и bcrypt выполняются прямо
+в вызывающем потоке. Вызванные из обработчика, они блокируют event loop, и
+пока один пользователь ждет ответа Firestore, остальные ждут его.
+
+Здесь те же функции выполняются в отдельном пуле потоков ограниченного размера
+(config.DATA_EXECUTOR_WORKERS) и вызываются через await:
+
+    import data
+    tasks = await data.get_user_tasks(user_id)
+
+В этом же пуле выполняются вызовы AsyncFirebaseClient из firebase_client_admin,
+поэтому config.DATA_EXECUTOR_WORKERS ограничивает все блокирующие запросы бота.
+
+Метрики пула (data.executor.stats()): очередь задач, ожидающих свободного потока,
+занятые потоки и время ожидания/выполнения (p50/p95/max по последним вызовам).
+Если задача ждет свободного потока дольше config.DATA_EXECUTOR_WAIT_WARNING секунд,
+в лог пишется предупреждение - пул не справляется с нагрузкой.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, TypeVar
+import config
+import auth
+import clients
+import deals
+import notification_queue
+import notifications
+import profile
+import tasks
+from firebase_metrics import attribute, current_caller
+from notification_metrics import queue_metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Сколько последних вызовов учитывается в перцентилях времени
+EXECUTOR_STATS_WINDOW = 1000
+
+# Не чаще одного предупреждения о перегрузке пула за столько секунд
+EXECUTOR_WARNING_INTERVAL = 60
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+    values = sorted(values)
+    return {
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+class BlockingExecutor:
+    """Пул потоков для блокирующих вызовов с метриками очереди"""
+
+    def __init__(self, max_workers: int, wait_warning: float = 1.0, name: str = 'data'):
+        self.max_workers = max_workers
+        self.wait_warning = wait_warning
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        self._max_queued = 0
+        self._completed = 0
+        self._failed = 0
+        self._wait_times: deque = deque(maxlen=EXECUTOR_STATS_WINDOW)
+        self._run_times: deque = deque(maxlen=EXECUTOR_STATS_WINDOW)
+        self._last_warning = 0.0
+
+    def _call(self, submitted: float, func: Callable[..., T], args: tuple, kwargs: dict) -> T:
+        started = time.monotonic()
+        wait = started - submitted
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._wait_times.append(wait)
+            queued = self._queued
+            warn = wait >= self.wait_warning and started - self._last_warning >= EXECUTOR_WARNING_INTERVAL
+            if warn:
+                self._last_warning = started
+        if warn:
+            logger.warning(f"[EXECUTOR] {func.__name__} waited {wait:.2f}s for a worker "
+                           f"({self.max_workers} workers busy, {queued} queued)")
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                if failed:
+                    self._failed += 1
+                self._run_times.append(time.monotonic() - started)
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Выполнить func(*args, **kwargs) в пуле и дождаться результата"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._queued += 1
+            self._max_queued = max(self._max_queued, self._queued)
+        # Контекст (источник вызова для метрик Firestore) передается в поток пула
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self._pool, functools.partial(context.run, self._call, time.monotonic(), func, args, kwargs)
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'queued': self._queued,
+                'running': self._running,
+                'max_queued': self._max_queued,
+                'completed': self._completed,
+                'failed': self._failed,
+                'wait_time': _percentiles(list(self._wait_times)),
+                'run_time': _percentiles(list(self._run_times)),
+            }
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False)
+
+executor = BlockingExecutor(config.DATA_EXECUTOR_WORKERS, wait_warning=config.DATA_EXECUTOR_WAIT_WARNING)
+
+def offload(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """Асинхронная обертка: вызов func в пуле executor"""
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> T:
+        # В потоке пула стека обработчика нет - источник определяем здесь
+        with attribute(current_caller()):
+            return await executor.run(func, *args, **kwargs)
+    return wrapper
+
+# Задачи
+get_user_tasks = offload(tasks.get_user_tasks)
+get_today_tasks = offload(tasks.get_today_tasks)
+get_overdue_tasks = offload(tasks.get_overdue_tasks)
+get_task_by_id = offload(tasks.get_task_by_id)
+update_task_status = offload(tasks.update_task_status)
+create_task = offload(tasks.create_task)
+get_statuses = offload(tasks.get_statuses)
+
+# Сделки
+get_all_deals = offload(deals.get_all_deals)
+get_user_deals = offload(deals.get_user_deals)
+get_funnel_deals = offload(deals.get_funnel_deals)
+get_deal_by_id = offload(deals.get_deal_by_id)
+create_deal = offload(deals.create_deal)
+update_deal = offload(deals.update_deal)
+update_deal_stage = offload(deals.update_deal_stage)
+delete_deal = offload(deals.delete_deal)
+search_deals = offload(deals.search_deals)
+get_sales_funnels = offload(deals.get_sales_funnels)
+get_funnel_stages = offload(deals.get_funnel_stages)
+get_newly_won_deals = offload(deals.get_newly_won_deals)
+
+# Клиенты
+get_all_clients = offload(clients.get_all_clients)
+get_client_by_id = offload(clients.get_client_by_id)
+create_client = offload(clients.create_client)
+search_clients = offload(clients.search_clients)
+
+# Пользователи (bcrypt отпускает GIL - проверки паролей идут параллельно)
+authenticate_user = offload(auth.authenticate_user)
+check_user_active = offload(auth.check_user_active)
+check_users_active = offload(auth.check_users_active)
+update_user_password = offload(auth.update_user_password)
+update_user_avatar = offload(auth.update_user_avatar)
+update_user_contacts = offload(auth.update_user_contacts)
+get_user_profile = offload(profile.get_user_profile)
+
+# Уведомления
+check_new_tasks = offload(notifications.check_new_tasks)
+check_new_deals = offload(notifications.check_new_deals)
+check_upcoming_meetings = offload(notifications.check_upcoming_meetings)
+get_successful_deal_message = offload(notifications.get_successful_deal_message)
+get_daily_reminder_message = offload(notifications.get_daily_reminder_message)
+get_weekly_report_message = offload(notifications.get_weekly_report_message)
+get_group_daily_summary = offload(notifications.get_group_daily_summary)
+poll_task_changes = offload(notifications.task_changes.poll)
+
+# Очередь уведомлений
+add_notification_task = offload(notification_queue.add_notification_task)
+add_notification_tasks = offload(notification_queue.add_notification_tasks)
+get_pending_notifications = offload(notification_queue.get_pending_notifications)
+claim_pending_notifications = offload(notification_queue.claim_pending_notifications)
+mark_notification_sent = offload(notification_queue.mark_notification_sent)
+commit_notification_marks = offload(notification_queue.commit_marks)
+cleanup_old_notifications = offload(notification_queue.cleanup_old_notifications)
+# Метрики очереди (размер очереди может потребовать запроса к Firestore)
+get_queue_metrics = offload(queue_metrics.snapshot)
+refresh_queue_backlog = offload(queue_metrics.refresh_backlog)
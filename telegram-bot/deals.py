@@ -1,17 +1,76 @@
 """
 Модуль работы со сделками (полное управление)
 """
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Set
 from datetime import datetime
 from firebase_client import firebase
+from change_feed import ChangeFeed, CHANGE_FEED_STATE_COLLECTION
+from utils import get_utc_timestamp
+
+# Лента изменений сделок для групповых уведомлений о выигранных сделках
+won_deal_changes = ChangeFeed('deals', name='wonDeals')
+
+class WonDealAnnouncements:
+    """
+    Сделки, о выигрыше которых уже сообщено в группу
+
+    Лента возвращает сделку при любом изменении, в том числе при правке заметки
+    или суммы уже выигранной сделки. Сообщать нужно только о переходе в 'won',
+    поэтому ID объявленных сделок хранятся в botState: сделка объявляется, если ее
+    нет в списке, и удаляется из списка, когда уходит из стадии 'won' (следующий
+    переход в 'won' будет объявлен снова). При первом запуске в список заносятся
+    все уже выигранные сделки.
+    """
+
+    def __init__(self, state_id: str = 'wonDealsAnnounced'):
+        self.state_id = state_id
+        self.deal_ids: Optional[Set[str]] = None
+
+    def _load(self) -> None:
+        state = firebase.get_by_id(CHANGE_FEED_STATE_COLLECTION, self.state_id)
+        if state is not None:
+            self.deal_ids = set(state.get('dealIds') or [])
+            return
+        won = firebase.query('deals', [('stage', '==', 'won')], fields=['stage'])
+        self.deal_ids = {deal['id'] for deal in won}
+        self._save()
+
+    def _save(self) -> None:
+        firebase.save(CHANGE_FEED_STATE_COLLECTION, {
+            'id': self.state_id,
+            'dealIds': sorted(self.deal_ids),
+            'updatedAt': get_utc_timestamp()
+        })
+
+    def newly_won(self, changed_deals: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Сделки из changed_deals, перешедшие в 'won' (каждая объявляется один раз)"""
+        if self.deal_ids is None:
+            self._load()
+        result = []
+        changed = False
+        for deal in changed_deals:
+            deal_id = deal['id']
+            if deal.get('stage') == 'won':
+                if deal_id not in self.deal_ids:
+                    self.deal_ids.add(deal_id)
+                    changed = True
+                    if not deal.get('isArchived', False):
+                        result.append(deal)
+            elif deal_id in self.deal_ids:
+                self.deal_ids.discard(deal_id)
+                changed = True
+        if changed:
+            self._save()
+        return result
+
+won_deal_announcements = WonDealAnnouncements()
 
 def get_all_deals(include_archived: bool = False) -> List[Dict[str, Any]]:
     """Получить все сделки"""
     try:
-        all_deals = firebase.get_all('deals')
         if include_archived:
-            return all_deals
-        return [d for d in all_deals if not d.get('isArchived', False)]
+            return firebase.get_all('deals')
+        return [d for d in firebase.iter_all('deals') if not d.get('isArchived', False)]
     except Exception as e:
         print(f"Error getting all deals: {e}")
         return []
@@ -25,6 +84,21 @@ def get_user_deals(user_id: str, include_archived: bool = False) -> List[Dict[st
         print(f"Error getting user deals: {e}")
         return []
 
+def get_funnel_deals(funnel_id: str, stage_id: Optional[str] = None, include_archived: bool = False) -> List[Dict[str, Any]]:
+    """Получить сделки воронки (и этапа, если указан) запросом на стороне Firestore"""
+    try:
+        filters = [('funnelId', '==', funnel_id)]
+        if stage_id:
+            filters.append(('stage', '==', stage_id))
+        deals = firebase.query('deals', filters)
+        if include_archived:
+            return deals
+        # isArchived может отсутствовать в документе, поэтому фильтруем локально
+        return [d for d in deals if not d.get('isArchived', False)]
+    except Exception as e:
+        print(f"Error getting funnel deals: {e}")
+        return []
+
 def get_deal_by_id(deal_id: str) -> Optional[Dict[str, Any]]:
     """Получить сделку по ID"""
     return firebase.get_by_id('deals', deal_id)
@@ -32,7 +106,7 @@ def get_deal_by_id(deal_id: str) -> Optional[Dict[str, Any]]:
 def create_deal(deal_data: Dict[str, Any]) -> Optional[str]:
     """Создать новую сделку"""
     try:
-        now = datetime.now().isoformat()
+        now = get_utc_timestamp()
         deal_data['createdAt'] = deal_data.get('createdAt', now)
         deal_data['updatedAt'] = now
         deal_data['isArchived'] = False
@@ -50,17 +124,10 @@ def create_deal(deal_data: Dict[str, Any]) -> Optional[str]:
 def update_deal(deal_id: str, updates: Dict[str, Any]) -> bool:
     """Обновить сделку"""
     try:
-        deal = firebase.get_by_id('deals', deal_id)
-        if not deal:
-            return False
-        
-        # Обновляем поля
-        for key, value in updates.items():
-            deal[key] = value
-        
-        deal['updatedAt'] = datetime.now().isoformat()
-        firebase.save('deals', deal)
-        return True
+        # Отправляем только изменившиеся поля (документ должен существовать)
+        fields = {k: v for k, v in updates.items() if k != 'id'}
+        fields['updatedAt'] = get_utc_timestamp()
+        return firebase.update('deals', deal_id, fields)
     except Exception as e:
         print(f"Error updating deal: {e}")
         return False
@@ -72,14 +139,10 @@ def update_deal_stage(deal_id: str, new_stage: str) -> bool:
 def delete_deal(deal_id: str) -> bool:
     """Удалить сделку (мягкое удаление)"""
     try:
-        deal = firebase.get_by_id('deals', deal_id)
-        if not deal:
-            return False
-        
-        deal['isArchived'] = True
-        deal['updatedAt'] = datetime.now().isoformat()
-        firebase.save('deals', deal)
-        return True
+        return firebase.update('deals', deal_id, {
+            'isArchived': True,
+            'updatedAt': get_utc_timestamp()
+        })
     except Exception as e:
         print(f"Error deleting deal: {e}")
         return False
@@ -122,6 +185,14 @@ def get_funnel_stages(funnel_id: str) -> List[Dict[str, Any]]:
         print(f"Error getting funnel stages: {e}")
         return []
 
+def get_newly_won_deals() -> List[Dict[str, Any]]:
+    """Сделки, перешедшие в стадию 'won' с прошлого вызова (лента по updatedAt)"""
+    try:
+        return won_deal_announcements.newly_won(won_deal_changes.poll())
+    except Exception as e:
+        print(f"Error getting newly won deals: {e}")
+        return []
+
 def get_won_deals_today() -> List[Dict[str, Any]]:
     """Получить сделки, перешедшие в стадию 'won' сегодня"""
     try:
@@ -0,0 +1,334 @@
+"""
+Read-through кэш для клиентов Firestore
+
+Справочные коллекции (users, clients, projects, statuses, salesFunnels,
+notificationPrefs) читаются почти на каждое нажатие кнопки и каждый тик
+periodic_check, а меняются редко. CachingFirebaseClient и AsyncCachingFirebaseClient
+оборачивают клиентов из firebase_client_rest / firebase_client_admin:
+
+- результаты чтения коллекций из ttls хранятся в памяти ttls[коллекция] секунд;
+- размер кэша ограничен max_entries, лишние записи вытесняются по LRU;
+- любая запись через обертку (save, update, delete, commit, batch) сбрасывает
+  кэш затронутой коллекции;
+- счетчики попаданий/промахов доступны через FirebaseCache.stats().
+
+Оба клиента используют общий FirebaseCache, поэтому запись через синхронный
+клиент сбрасывает кэш и для асинхронного.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Iterable, Tuple
+from firebase_common import Batch, AsyncBatch, Write
+
+# Маркер отсутствия значения в кэше (None - допустимое значение для get_by_id)
+_MISSING = object()
+
+class FirebaseCache:
+    """Потокобезопасное хранилище с TTL по коллекциям и LRU вытеснением"""
+
+    def __init__(self, ttls: Dict[str, float], max_entries: int = 1000):
+        self.ttls = dict(ttls)
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits: Dict[str, int] = {}
+        self._misses: Dict[str, int] = {}
+        self._evictions = 0
+        self._invalidations: Dict[str, int] = {}
+
+    def is_cached(self, collection_name: str) -> bool:
+        """Кэшируется ли коллекция"""
+        return self.ttls.get(collection_name, 0) > 0
+
+    def get(self, key: Tuple) -> Any:
+        """Значение по ключу (копия) или _MISSING; key[0] - название коллекции"""
+        collection_name = key[0]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._hits[collection_name] = self._hits.get(collection_name, 0) + 1
+                value = entry[1]
+            else:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses[collection_name] = self._misses.get(collection_name, 0) + 1
+                return _MISSING
+        # Копируем вне блокировки: вызывающий код может менять полученные словари
+        return copy.deepcopy(value)
+
+    def put(self, key: Tuple, value: Any) -> None:
+        """Сохранить значение (копию) на время TTL коллекции key[0]"""
+        ttl = self.ttls.get(key[0], 0)
+        if ttl <= 0:
+            return
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, collection_name: Optional[str] = None) -> None:
+        """Сбросить кэш коллекции (None - весь кэш)"""
+        with self._lock:
+            if collection_name is None:
+                self._entries.clear()
+                return
+            if not self.is_cached(collection_name):
+                return
+            for key in [k for k in self._entries if k[0] == collection_name]:
+                del self._entries[key]
+            self._invalidations[collection_name] = self._invalidations.get(collection_name, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики кэша: размер, вытеснения и hits/misses/invalidations по коллекциям"""
+        with self._lock:
+            collections = {}
+            for name in set(self._hits) | set(self._misses) | set(self._invalidations):
+                hits = self._hits.get(name, 0)
+                misses = self._misses.get(name, 0)
+                collections[name] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_rate': round(hits / (hits + misses), 3) if hits + misses else 0.0,
+                    'invalidations': self._invalidations.get(name, 0),
+                }
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'evictions': self._evictions,
+                'collections': collections,
+            }
+
+def _fields_key(fields: Optional[List[str]]) -> Optional[Tuple[str, ...]]:
+    return tuple(fields) if fields is not None else None
+
+def _query_key(collection_name: str, filters: List[tuple], order_by: Any, limit: Optional[int],
+               fields: Optional[List[str]], start_after: Optional[list] = None) -> Tuple:
+    # Значения фильтров могут быть списками (in, array-contains-any) - берем repr
+    return (collection_name, 'query', repr((list(filters), order_by, limit, start_after)), _fields_key(fields))
+
+def _written_collections(writes: List[Write]) -> List[str]:
+    return list(dict.fromkeys(write[1] for write in writes))
+
+class CachingFirebaseClient:
+    """
+    Кэширующая обертка над синхронным FirebaseClient
+
+    Кэшируются get_all, iter_all, get_by_id, get_many и query для коллекций из
+    cache.ttls; остальные коллекции и методы передаются клиенту без изменений.
+    """
+
+    def __init__(self, client, cache: FirebaseCache):
+        self._client = client
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return self._client.get_all(collection_name, fields=fields)
+        key = (collection_name, 'all', _fields_key(fields))
+        items = self.cache.get(key)
+        if items is _MISSING:
+            items = self._client.get_all(collection_name, fields=fields)
+            # Пустой список может означать ошибку запроса - не кэшируем
+            if items:
+                self.cache.put(key, items)
+        return items
+
+    def iter_all(self, collection_name: str, page_size: Optional[int] = None,
+                 fields: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        if self.cache.is_cached(collection_name):
+            return iter(self.get_all(collection_name, fields=fields))
+        if page_size is None:
+            return self._client.iter_all(collection_name, fields=fields)
+        return self._client.iter_all(collection_name, page_size=page_size, fields=fields)
+
+    def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return self._client.get_by_id(collection_name, doc_id, fields=fields)
+        key = (collection_name, 'doc', doc_id, _fields_key(fields))
+        item = self.cache.get(key)
+        if item is _MISSING:
+            item = self._client.get_by_id(collection_name, doc_id, fields=fields)
+            if item is not None:
+                self.cache.put(key, item)
+        return item
+
+    def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                 fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return self._client.get_many(collection_name, doc_ids, fields=fields)
+        # Документы берутся из кэша по одному, недостающие дочитываются одним запросом
+        result = {}
+        missing = []
+        for doc_id in dict.fromkeys(doc_id for doc_id in doc_ids if doc_id):
+            item = self.cache.get((collection_name, 'doc', doc_id, _fields_key(fields)))
+            if item is _MISSING:
+                missing.append(doc_id)
+            elif item is not None:
+                result[doc_id] = item
+        if missing:
+            fetched = self._client.get_many(collection_name, missing, fields=fields)
+            for doc_id, item in fetched.items():
+                self.cache.put((collection_name, 'doc', doc_id, _fields_key(fields)), item)
+            result.update(fetched)
+        return result
+
+    def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+              limit: Optional[int] = None, fields: Optional[List[str]] = None,
+              start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return self._client.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                      start_after=start_after)
+        key = _query_key(collection_name, filters, order_by, limit, fields, start_after)
+        items = self.cache.get(key)
+        if items is _MISSING:
+            items = self._client.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                       start_after=start_after)
+            if items:
+                self.cache.put(key, items)
+        return items
+
+    def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        try:
+            return self._client.save(collection_name, item)
+        finally:
+            self.cache.invalidate(collection_name)
+
+    def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+               update_time: Optional[str] = None) -> bool:
+        try:
+            return self._client.update(collection_name, doc_id, fields, update_time=update_time)
+        finally:
+            self.cache.invalidate(collection_name)
+
+    def delete(self, collection_name: str, doc_id: str) -> bool:
+        try:
+            return self._client.delete(collection_name, doc_id)
+        finally:
+            self.cache.invalidate(collection_name)
+
+    def commit(self, writes: List[Write]) -> bool:
+        try:
+            return self._client.commit(writes)
+        finally:
+            for collection_name in _written_collections(writes):
+                self.cache.invalidate(collection_name)
+
+    def batch(self) -> Batch:
+        return Batch(self)
+
+class AsyncCachingFirebaseClient:
+    """Кэширующая обертка над AsyncFirebaseClient (тот же кэш, методы через await)"""
+
+    def __init__(self, client, cache: FirebaseCache):
+        self._client = client
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return await self._client.get_all(collection_name, fields=fields)
+        key = (collection_name, 'all', _fields_key(fields))
+        items = self.cache.get(key)
+        if items is _MISSING:
+            items = await self._client.get_all(collection_name, fields=fields)
+            if items:
+                self.cache.put(key, items)
+        return items
+
+    async def iter_all(self, collection_name: str, page_size: Optional[int] = None,
+                       fields: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        if self.cache.is_cached(collection_name):
+            for item in await self.get_all(collection_name, fields=fields):
+                yield item
+            return
+        if page_size is None:
+            pages = self._client.iter_all(collection_name, fields=fields)
+        else:
+            pages = self._client.iter_all(collection_name, page_size=page_size, fields=fields)
+        async for item in pages:
+            yield item
+
+    async def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return await self._client.get_by_id(collection_name, doc_id, fields=fields)
+        key = (collection_name, 'doc', doc_id, _fields_key(fields))
+        item = self.cache.get(key)
+        if item is _MISSING:
+            item = await self._client.get_by_id(collection_name, doc_id, fields=fields)
+            if item is not None:
+                self.cache.put(key, item)
+        return item
+
+    async def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                       fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return await self._client.get_many(collection_name, doc_ids, fields=fields)
+        result = {}
+        missing = []
+        for doc_id in dict.fromkeys(doc_id for doc_id in doc_ids if doc_id):
+            item = self.cache.get((collection_name, 'doc', doc_id, _fields_key(fields)))
+            if item is _MISSING:
+                missing.append(doc_id)
+            elif item is not None:
+                result[doc_id] = item
+        if missing:
+            fetched = await self._client.get_many(collection_name, missing, fields=fields)
+            for doc_id, item in fetched.items():
+                self.cache.put((collection_name, 'doc', doc_id, _fields_key(fields)), item)
+            result.update(fetched)
+        return result
+
+    async def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+                    limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                    start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        if not self.cache.is_cached(collection_name):
+            return await self._client.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                            start_after=start_after)
+        key = _query_key(collection_name, filters, order_by, limit, fields, start_after)
+        items = self.cache.get(key)
+        if items is _MISSING:
+            items = await self._client.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                             start_after=start_after)
+            if items:
+                self.cache.put(key, items)
+        return items
+
+    async def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        try:
+            return await self._client.save(collection_name, item)
+        finally:
+            self.cache.invalidate(collection_name)
+
+    async def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+                     update_time: Optional[str] = None) -> bool:
+        try:
+            return await self._client.update(collection_name, doc_id, fields, update_time=update_time)
+        finally:
+            self.cache.invalidate(collection_name)
+
+    async def delete(self, collection_name: str, doc_id: str) -> bool:
+        try:
+            return await self._client.delete(collection_name, doc_id)
+        finally:
+            self.cache.invalidate(collection_name)
+
+    async def commit(self, writes: List[Write]) -> bool:
+        try:
+            return await self._client.commit(writes)
+        finally:
+            for collection_name in _written_collections(writes):
+                self.cache.invalidate(collection_name)
+
+    def batch(self) -> AsyncBatch:
+        return AsyncBatch(self)
@@ -10,12 +10,64 @@ USE_ADMIN_SDK = config.FIREBASE_CREDENTIALS_PATH and os.path.exists(config.FIREB
 
 if USE_ADMIN_SDK:
     # Используем Admin SDK
-    from firebase_client_admin import FirebaseClient, firebase
+    from firebase_client_admin import FirebaseClient, AsyncFirebaseClient, firebase, async_firebase
     print("[Firebase] Using Admin SDK with service account")
 else:
     # Используем REST API
-    from firebase_client_rest import FirebaseClient, firebase
+    from firebase_client_rest import FirebaseClient, AsyncFirebaseClient, firebase, async_firebase
     print("[Firebase] Using REST API (no credentials file)")
 
+# Метрики каждого запроса к Firestore (самый нижний слой: считаются только реальные запросы)
+if config.FIREBASE_METRICS_ENABLED:
+    from firebase_metrics import InstrumentedFirebaseClient, AsyncInstrumentedFirebaseClient
+    firebase = InstrumentedFirebaseClient(firebase)
+    async_firebase = AsyncInstrumentedFirebaseClient(async_firebase)
+
+# Клиент без кэша и зеркал - источник данных для синхронизации SQLite зеркала
+backend_firebase = firebase
+
+# Одновременные одинаковые чтения - один запрос к Firestore (ниже кэша: промахи кэша тоже объединяются)
+flights = None
+if config.FIREBASE_SINGLE_FLIGHT_ENABLED:
+    from firebase_singleflight import SingleFlight, SingleFlightFirebaseClient, AsyncSingleFlightFirebaseClient
+    flights = SingleFlight()
+    firebase = SingleFlightFirebaseClient(firebase, flights)
+    async_firebase = AsyncSingleFlightFirebaseClient(async_firebase, flights)
+
+# Read-through кэш справочных коллекций (общий для sync и async клиента)
+cache = None
+if config.FIREBASE_CACHE_ENABLED:
+    from firebase_cache import FirebaseCache, CachingFirebaseClient, AsyncCachingFirebaseClient
+    cache = FirebaseCache(config.FIREBASE_CACHE_TTLS, max_entries=config.FIREBASE_CACHE_MAX_ENTRIES)
+    firebase = CachingFirebaseClient(firebase, cache)
+    async_firebase = AsyncCachingFirebaseClient(async_firebase, cache)
+
+# Постоянное зеркало коллекций в SQLite. Пока коллекция ни разу не загружена,
+# чтение идет через кэш в Firestore; синхронизация - sqlite_mirror.sync() в фоне
+sqlite_mirror = None
+if config.FIREBASE_SQLITE_ENABLED:
+    from firebase_sqlite import SqliteMirror, SqliteMirroredFirebaseClient, AsyncSqliteMirroredFirebaseClient
+    sqlite_mirror = SqliteMirror(config.FIREBASE_SQLITE_PATH, config.FIREBASE_SQLITE_COLLECTIONS, backend_firebase,
+                                 indexed_fields=config.FIREBASE_SQLITE_INDEXED_FIELDS,
+                                 full_sync_interval=config.FIREBASE_SQLITE_FULL_SYNC_INTERVAL,
+                                 reconcile_interval=config.FIREBASE_SQLITE_RECONCILE_INTERVAL)
+    firebase = SqliteMirroredFirebaseClient(firebase, sqlite_mirror)
+    async_firebase = AsyncSqliteMirroredFirebaseClient(async_firebase, sqlite_mirror)
+
+# Зеркало коллекций в памяти (snapshot listener'ы есть только в Admin SDK).
+# Подписка запускается явно: mirror.start() при старте бота
+mirror = None
+if USE_ADMIN_SDK and config.FIREBASE_MIRROR_ENABLED:
+    from firebase_mirror import FirebaseMirror, MirroredFirebaseClient, AsyncMirroredFirebaseClient
+    mirror = FirebaseMirror(config.FIREBASE_MIRROR_COLLECTIONS, max_silence=config.FIREBASE_MIRROR_MAX_SILENCE)
+    firebase = MirroredFirebaseClient(firebase, mirror)
+    async_firebase = AsyncMirroredFirebaseClient(async_firebase, mirror)
+
 # Экспортируем для использования в других модулях
-__all__ = ['FirebaseClient', 'firebase']
+# firebase - синхронный клиент (scheduler.py, tasks.py, deals.py, ...)
+# async_firebase - асинхронный клиент для обработчиков bot.py (через await)
+# flights - SingleFlight (счетчики через flights.stats()) или None если выключено
+# cache - FirebaseCache (счетчики через cache.stats()) или None если кэш выключен
+# sqlite_mirror - SqliteMirror или None если выключено
+# mirror - FirebaseMirror или None (REST API или зеркало выключено)
+__all__ = ['FirebaseClient', 'AsyncFirebaseClient', 'firebase', 'async_firebase', 'flights', 'cache', 'sqlite_mirror', 'mirror']
@@ -4,8 +4,14 @@
 import os
 import firebase_admin
 from firebase_admin import credentials, firestore
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Iterable, Tuple
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
 import config
+from firestore_codec import normalize_sdk_fields
+from firebase_common import (
+    Batch, AsyncBatch, Write, OrderBy, CHANGE_FEED_FIELD, DEFAULT_PAGE_SIZE, DOCUMENT_ID_FIELD,
+    IncompleteReadError, changed_since_args, chunk_writes, normalize_order_by
+)
 
 # Импорт Timestamp из google.cloud.firestore
 try:
@@ -33,57 +39,78 @@ if not firebase_admin._apps:
 db = firestore.client()
 
 def prepare_data_from_firestore(doc_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Подготовить данные из Firestore для использования"""
-    result = {}
-    for key, value in doc_data.items():
-        # Проверка Timestamp - проверяем по наличию атрибутов seconds и nanoseconds
-        # или по наличию метода isoformat и имени типа
-        if (hasattr(value, 'seconds') and hasattr(value, 'nanoseconds')) or \
-           (hasattr(value, 'isoformat') and 'Timestamp' in str(type(value))):
-            # Это Timestamp объект
-            try:
-                result[key] = value.isoformat()
-            except:
-                # Если isoformat не работает, конвертируем в строку
-                result[key] = str(value)
-        elif isinstance(value, dict):
-            result[key] = prepare_data_from_firestore(value)
-        elif isinstance(value, list):
-            result[key] = [prepare_data_from_firestore(item) if isinstance(item, dict) else item for item in value]
-        else:
-            result[key] = value
-    return result
+    """Подготовить данные из Firestore для использования (Timestamp -> ISO строка)"""
+    return normalize_sdk_fields(doc_data)
+
+def _fetch_page(collection_name: str, page_size: int, last_doc: Any = None,
+                fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], Any]:
+    """
+    Получить одну страницу коллекции, упорядоченной по ID документа (fields - проекция полей)
+
+    Returns:
+        (документы страницы, снимок последнего документа или None если страниц больше нет)
+    """
+    query = db.collection(collection_name).order_by(firestore.FieldPath.document_id()).limit(page_size)
+    if fields is not None:
+        query = query.select(fields)
+    if last_doc is not None:
+        query = query.start_after(last_doc)
+
+    snapshots = list(query.stream())
+    items = []
+    for doc in snapshots:
+        item = doc.to_dict() or {}
+        item = prepare_data_from_firestore(item)
+        item['id'] = doc.id
+        items.append(item)
+
+    next_cursor = snapshots[-1] if len(snapshots) == page_size else None
+    return items, next_cursor
 
 class FirebaseClient:
     """Клиент для работы с Firebase Firestore через Admin SDK"""
     
     @staticmethod
-    def get_all(collection_name: str) -> List[Dict[str, Any]]:
-        """Получить все документы из коллекции"""
-        try:
-            collection_ref = db.collection(collection_name)
-            docs = collection_ref.stream()
-            items = []
-            for doc in docs:
-                item = doc.to_dict()
-                item = prepare_data_from_firestore(item)
-                item['id'] = doc.id
-                items.append(item)
-            return items
-        except Exception as e:
-            print(f"Error getting all from {collection_name}: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
+    def iter_all(collection_name: str, page_size: int = DEFAULT_PAGE_SIZE,
+                 fields: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Постранично перебрать документы коллекции
+
+        В памяти одновременно находится не больше одной страницы (page_size документов).
+        Ошибка на первой странице логируется, перебор ничего не возвращает; ошибка
+        на следующих - IncompleteReadError (часть коллекции уже выдана).
+        fields - список полей, которые нужно вернуть (None - все поля).
+        """
+        cursor = None
+        pages = 0
+        while True:
+            try:
+                items, cursor = _fetch_page(collection_name, page_size, cursor, fields)
+            except Exception as e:
+                print(f"Error getting all from {collection_name}: {e}")
+                import traceback
+                traceback.print_exc()
+                if pages:
+                    raise IncompleteReadError(collection_name, pages, e) from e
+                return
+            pages += 1
+            yield from items
+            if cursor is None:
+                return
+    
+    @staticmethod
+    def get_all(collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Получить все документы из коллекции (fields - только указанные поля)"""
+        return list(FirebaseClient.iter_all(collection_name, fields=fields))
     
     @staticmethod
-    def get_by_id(collection_name: str, doc_id: str) -> Optional[Dict[str, Any]]:
-        """Получить документ по ID"""
+    def get_by_id(collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """Получить документ по ID (fields - только указанные поля)"""
         try:
             doc_ref = db.collection(collection_name).document(doc_id)
-            doc = doc_ref.get()
+            doc = doc_ref.get(field_paths=fields)
             if doc.exists:
-                item = doc.to_dict()
+                item = doc.to_dict() or {}
                 item = prepare_data_from_firestore(item)
                 item['id'] = doc.id
                 return item
@@ -94,6 +121,64 @@ class FirebaseClient:
             traceback.print_exc()
             return None
     
+    @staticmethod
+    def get_with_update_time(collection_name: str, doc_id: str,
+                             fields: Optional[List[str]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Получить документ и время его последнего изменения
+
+        Время (RFC 3339) можно передать в update(..., update_time=...), чтобы запись
+        не прошла, если документ изменили после чтения.
+
+        Returns:
+            (документ, updateTime) или (None, None) если документа нет
+        """
+        try:
+            doc = db.collection(collection_name).document(doc_id).get(field_paths=fields)
+            if not doc.exists:
+                return None, None
+            item = doc.to_dict() or {}
+            item = prepare_data_from_firestore(item)
+            item['id'] = doc.id
+            return item, doc.update_time.rfc3339()
+        except Exception as e:
+            print(f"Error getting {doc_id} from {collection_name}: {e}")
+            import traceback
+            traceback.print_exc()
+            return None, None
+    
+    @staticmethod
+    def get_many(collection_name: str, doc_ids: Iterable[Optional[str]],
+                 fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Получить несколько документов по ID одним запросом
+
+        Пустые ID игнорируются, отсутствующие документы не попадают в результат.
+
+        Returns:
+            Словарь id -> документ
+        """
+        ids = list(dict.fromkeys(doc_id for doc_id in doc_ids if doc_id))
+        if not ids:
+            return {}
+        try:
+            collection_ref = db.collection(collection_name)
+            refs = [collection_ref.document(doc_id) for doc_id in ids]
+            result = {}
+            for doc in db.get_all(refs, field_paths=fields):
+                if not doc.exists:
+                    continue
+                item = doc.to_dict() or {}
+                item = prepare_data_from_firestore(item)
+                item['id'] = doc.id
+                result[doc.id] = item
+            return result
+        except Exception as e:
+            print(f"Error batch getting from {collection_name}: {e}")
+            import traceback
+            traceback.print_exc()
+            return {}
+    
     @staticmethod
     def save(collection_name: str, item: Dict[str, Any]) -> bool:
         """Сохранить документ (создать или обновить)"""
@@ -115,6 +200,80 @@ class FirebaseClient:
             traceback.print_exc()
             return False
     
+    @staticmethod
+    def update(collection_name: str, doc_id: str, fields: Dict[str, Any],
+               update_time: Optional[str] = None) -> bool:
+        """
+        Обновить только указанные поля документа одним запросом (без чтения)
+
+        Args:
+            collection_name: Название коллекции
+            doc_id: ID документа
+            fields: Поля верхнего уровня и их новые значения
+            update_time: Предусловие - время изменения документа из get_with_update_time
+                         (None - достаточно, чтобы документ существовал)
+
+        Returns:
+            True если обновлено или обновлять нечего (пустой fields - запрос не отправляется);
+            False если документа нет или предусловие не выполнено
+        """
+        if not fields:
+            # Как в REST клиенте (Admin SDK отклонил бы пустое обновление исключением)
+            return True
+        try:
+            doc_ref = db.collection(collection_name).document(doc_id)
+            # Экранируем имена полей, чтобы точка не трактовалась как вложенный путь
+            data = {firestore.FieldPath(k).to_api_repr(): v for k, v in fields.items()}
+            if update_time:
+                option = db.write_option(last_update_time=DatetimeWithNanoseconds.from_rfc3339(update_time))
+                doc_ref.update(data, option=option)
+            else:
+                doc_ref.update(data)
+            return True
+        except Exception as e:
+            print(f"Error updating {doc_id} in {collection_name}: {e}")
+            import traceback
+            traceback.print_exc()
+            return False
+    
+    @staticmethod
+    def commit(writes: List[Write]) -> bool:
+        """
+        Атомарно выполнить список записей (op, коллекция, id, поля)
+
+        Записи отправляются через WriteBatch по MAX_BATCH_WRITES операций,
+        каждый WriteBatch применяется целиком или не применяется вовсе.
+        При ошибке оставшиеся части не отправляются.
+
+        Returns:
+            True если все записи применены
+        """
+        for chunk in chunk_writes(writes):
+            try:
+                write_batch = db.batch()
+                for op, collection_name, doc_id, data in chunk:
+                    doc_ref = db.collection(collection_name).document(doc_id)
+                    if op == 'set':
+                        write_batch.set(doc_ref, data, merge=True)
+                    elif op == 'update':
+                        write_batch.update(doc_ref, {firestore.FieldPath(k).to_api_repr(): v for k, v in data.items()})
+                    elif op == 'delete':
+                        write_batch.delete(doc_ref)
+                    else:
+                        raise ValueError(f"Unsupported write operation: {op}")
+                write_batch.commit()
+            except Exception as e:
+                print(f"Error committing {len(chunk)} writes: {e}")
+                import traceback
+                traceback.print_exc()
+                return False
+        return True
+    
+    @staticmethod
+    def batch() -> Batch:
+        """Пакет записей: with firebase.batch() as batch: ... (commit при выходе из блока)"""
+        return Batch(FirebaseClient)
+    
     @staticmethod
     def delete(collection_name: str, doc_id: str) -> bool:
         """Удалить документ"""
@@ -128,27 +287,125 @@ class FirebaseClient:
             return False
     
     @staticmethod
-    def query(collection_name: str, filters: List[tuple]) -> List[Dict[str, Any]]:
-        """Выполнить запрос с фильтрами"""
+    def query(collection_name: str, filters: List[tuple], order_by: OrderBy = None,
+              limit: Optional[int] = None, fields: Optional[List[str]] = None,
+              start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        """
+        Выполнить запрос с фильтрами
+
+        Args:
+            collection_name: Название коллекции
+            filters: Список условий (field, op, value), объединяются через AND
+            order_by: Поле или список (поле, 'ASCENDING' | 'DESCENDING'); DOCUMENT_ID_FIELD - ID документа
+            limit: Максимальное количество документов
+            fields: Список возвращаемых полей (None - все поля)
+            start_after: Значения полей order_by документа, после которого начинается выборка
+
+        Raises:
+            google.api_core.exceptions.GoogleAPICallError: Запрос не выполнен (нет составного
+                индекса, нет доступа, ошибка сервера)
+        """
         try:
             collection_ref = db.collection(collection_name)
             query = collection_ref
             for field, operator, value in filters:
                 query = query.where(field, operator, value)
+            orders = normalize_order_by(order_by)
+            for field, direction in orders:
+                query = query.order_by(field, direction=direction)
+            if start_after:
+                # Курсор по ID документа задается ссылкой на документ
+                query = query.start_after([
+                    collection_ref.document(value) if field == DOCUMENT_ID_FIELD else value
+                    for (field, _), value in zip(orders, start_after)
+                ])
+            if limit:
+                query = query.limit(limit)
+            if fields is not None:
+                query = query.select(fields)
             
             docs = query.stream()
             items = []
             for doc in docs:
-                item = doc.to_dict()
+                item = doc.to_dict() or {}
                 item = prepare_data_from_firestore(item)
                 item['id'] = doc.id
                 items.append(item)
             return items
         except Exception as e:
+            # Ошибку обрабатывает вызывающий код (пустой список - только "документов нет")
             print(f"Error querying {collection_name}: {e}")
-            import traceback
-            traceback.print_exc()
-            return []
+            raise
+    
+    @staticmethod
+    def get_changed_since(collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                          limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                          after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Документы, измененные после watermark (field > watermark), по возрастанию (field, id)
+
+        Новый курсор - field и id последнего документа: с after_id выборка начинается
+        после документа (watermark, after_id) и не теряет документы с тем же field
+        на границе страницы. Документы без field в выборку не попадают.
+        """
+        filters, order_by, start_after, fields = changed_since_args(watermark, field, fields, after_id)
+        return FirebaseClient.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                    start_after=start_after)
+
+async def _run_blocking(func, *args, **kwargs):
+    """Выполнить блокирующий вызов SDK в общем пуле data.executor (ограничение потоков и метрики)"""
+    # Импорт при вызове: data импортирует модули, которые импортируют этот клиент
+    import data
+    return await data.executor.run(func, *args, **kwargs)
+
+class AsyncFirebaseClient:
+    """
+    Асинхронная обертка над FirebaseClient для обработчиков бота
+
+    Admin SDK работает через блокирующий gRPC, поэтому вызовы выполняются
+    в пуле потоков data.executor и не блокируют event loop. Интерфейс тот же,
+    что у AsyncFirebaseClient из firebase_client_rest.
+    """
+
+    def __getattr__(self, name):
+        method = getattr(FirebaseClient, name)
+
+        async def wrapper(*args, **kwargs):
+            return await _run_blocking(method, *args, **kwargs)
+
+        wrapper.__name__ = name
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    async def iter_all(self, collection_name: str, page_size: int = DEFAULT_PAGE_SIZE,
+                       fields: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Постранично перебрать документы коллекции (async for), каждая страница читается в пуле потоков"""
+        cursor = None
+        pages = 0
+        while True:
+            try:
+                items, cursor = await _run_blocking(_fetch_page, collection_name, page_size, cursor, fields)
+            except Exception as e:
+                print(f"Error getting all from {collection_name}: {e}")
+                import traceback
+                traceback.print_exc()
+                if pages:
+                    raise IncompleteReadError(collection_name, pages, e) from e
+                return
+            pages += 1
+            for item in items:
+                yield item
+            if cursor is None:
+                return
+
+    def batch(self) -> AsyncBatch:
+        """Пакет записей: async with async_firebase.batch() as batch: ..."""
+        return AsyncBatch(self)
+
+    async def aclose(self) -> None:
+        """Совместимость с REST клиентом: пул соединений Admin SDK закрывать не нужно"""
+        return None
 
-# Создаем экземпляр клиента
+# Создаем экземпляры клиентов
 firebase = FirebaseClient()
+async_firebase = AsyncFirebaseClient()
@@ -1,195 +1,692 @@
 """
 Клиент для работы с Firebase Firestore через REST API (без credentials)
+
+FirebaseClient - синхронный клиент (для scheduler.py и модулей tasks/deals/...)
+AsyncFirebaseClient - асинхронный клиент для обработчиков бота (не блокирует event loop)
+Оба клиента используют пулы keep-alive соединений httpx
 """
-import requests
-from typing import List, Dict, Any, Optional
+import re
+import threading
+import traceback
+import httpx
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Iterable, Tuple
 import config
+from firestore_codec import decode_fields, encode_value, encode_fields, loads
+from firebase_common import (
+    Batch, AsyncBatch, Write, OrderBy, CHANGE_FEED_FIELD, DEFAULT_PAGE_SIZE, DOCUMENT_ID_FIELD,
+    IncompleteReadError, changed_since_args, chunk_writes, new_document_id, normalize_order_by
+)
+from firebase_metrics import record_response_bytes
 
 # Firebase REST API конфигурация
 FIREBASE_API_KEY = config.FIREBASE_API_KEY
 FIREBASE_PROJECT_ID = config.FIREBASE_PROJECT_ID or "tipa-task-manager"
-FIREBASE_DATABASE_URL = f"https://firestore.googleapis.com/v1/projects/{FIREBASE_PROJECT_ID}/databases/(default)/documents"
+FIREBASE_DOCUMENTS_PATH = f"projects/{FIREBASE_PROJECT_ID}/databases/(default)/documents"
+FIREBASE_DATABASE_URL = f"https://firestore.googleapis.com/v1/{FIREBASE_DOCUMENTS_PATH}"
+FIREBASE_RUN_QUERY_URL = f"{FIREBASE_DATABASE_URL}:runQuery"
+FIREBASE_BATCH_GET_URL = f"{FIREBASE_DATABASE_URL}:batchGet"
+FIREBASE_COMMIT_URL = f"{FIREBASE_DATABASE_URL}:commit"
+
+# Параметры HTTP пула
+HTTP_TIMEOUT = 10
+HTTP_LIMITS = httpx.Limits(
+    max_connections=config.FIREBASE_HTTP_POOL_SIZE,
+    max_keepalive_connections=config.FIREBASE_HTTP_POOL_SIZE,
+    keepalive_expiry=30
+)
+
+# Операторы фильтров (как в Admin SDK) -> операторы structuredQuery
+QUERY_OPERATORS = {
+    '==': 'EQUAL',
+    '!=': 'NOT_EQUAL',
+    '<': 'LESS_THAN',
+    '<=': 'LESS_THAN_OR_EQUAL',
+    '>': 'GREATER_THAN',
+    '>=': 'GREATER_THAN_OR_EQUAL',
+    'array-contains': 'ARRAY_CONTAINS',
+    'array-contains-any': 'ARRAY_CONTAINS_ANY',
+    'in': 'IN',
+    'not-in': 'NOT_IN',
+}
+
+# Имя поля, которое можно использовать в fieldPaths без экранирования
+SIMPLE_FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z_0-9]*$')
 
 if not FIREBASE_API_KEY:
     print("[Firebase REST] WARNING: FIREBASE_API_KEY not set in .env file!")
     print("[Firebase REST] Please add FIREBASE_API_KEY to your .env file.")
     print("[Firebase REST] You can find it in Firebase Console -> Project Settings -> General -> Web API Key")
 
-def _convert_firestore_value(value: Any) -> Any:
-    """Конвертировать значение из формата Firestore REST API в обычный Python тип"""
-    if isinstance(value, dict):
-        if 'stringValue' in value:
-            return value['stringValue']
-        elif 'integerValue' in value:
-            return int(value['integerValue'])
-        elif 'doubleValue' in value:
-            return float(value['doubleValue'])
-        elif 'booleanValue' in value:
-            return value['booleanValue']
-        elif 'timestampValue' in value:
-            return value['timestampValue']
-        elif 'arrayValue' in value:
-            return [_convert_firestore_value(v) for v in value['arrayValue'].get('values', [])]
-        elif 'mapValue' in value:
-            return {k: _convert_firestore_value(v) for k, v in value['mapValue'].get('fields', {}).items()}
-        elif 'nullValue' in value:
-            return None
-    return value
-
-def _convert_to_firestore_value(value: Any) -> Dict[str, Any]:
-    """Конвертировать значение в формат Firestore REST API"""
-    if value is None:
-        return {'nullValue': None}
-    elif isinstance(value, bool):
-        return {'booleanValue': value}
-    elif isinstance(value, int):
-        return {'integerValue': str(value)}
-    elif isinstance(value, float):
-        return {'doubleValue': value}
-    elif isinstance(value, str):
-        return {'stringValue': value}
-    elif isinstance(value, list):
-        return {'arrayValue': {'values': [_convert_to_firestore_value(v) for v in value]}}
-    elif isinstance(value, dict):
-        return {'mapValue': {'fields': {k: _convert_to_firestore_value(v) for k, v in value.items()}}}
+# ---------------------------------------------------------------------------
+# Общие функции построения запросов и разбора ответов (для sync и async клиента)
+# ---------------------------------------------------------------------------
+
+def _doc_name(collection_name: str, doc_id: str) -> str:
+    """Полное имя документа (projects/.../documents/коллекция/id)"""
+    return f"{FIREBASE_DOCUMENTS_PATH}/{collection_name}/{doc_id}"
+
+def _doc_url(collection_name: str, doc_id: Optional[str] = None) -> str:
+    """URL коллекции или документа"""
+    if doc_id is None:
+        return f"{FIREBASE_DATABASE_URL}/{collection_name}"
+    return f"{FIREBASE_DATABASE_URL}/{collection_name}/{doc_id}"
+
+def _params(fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Базовые query-параметры запроса (fields - маска возвращаемых полей)"""
+    params = {'key': FIREBASE_API_KEY}
+    if fields is not None:
+        params['mask.fieldPaths'] = list(fields)
+    return params
+
+def _document_to_item(doc: Dict[str, Any], doc_id: Optional[str] = None) -> Dict[str, Any]:
+    """Конвертировать документ Firestore REST API в словарь с полем id"""
+    if doc_id is None:
+        # Извлекаем ID из пути документа
+        doc_path = doc.get('name', '')
+        doc_id = doc_path.split('/')[-1] if '/' in doc_path else doc_path
+
+    item = decode_fields(doc.get('fields', {}))
+    item['id'] = doc_id
+    return item
+
+def _prepare_save(item: Dict[str, Any]) -> tuple:
+    """Подготовить ID и payload для сохранения документа"""
+    doc_id = item.get('id')
+    if not doc_id:
+        # Для создания нового документа нужно использовать POST
+        # Но проще использовать случайный ID
+        doc_id = new_document_id()
+        item['id'] = doc_id
+
+    # Удаляем id из данных перед сохранением
+    data = {k: v for k, v in item.items() if k != 'id'}
+
+    # Конвертируем данные в формат Firestore
+    fields = encode_fields(data)
+    return doc_id, {'fields': fields}
+
+def _page_params(page_size: int, page_token: Optional[str], fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Параметры запроса одной страницы коллекции"""
+    params = _params(fields)
+    params['pageSize'] = page_size
+    if page_token:
+        params['pageToken'] = page_token
+    return params
+
+def _parse_page(collection_name: str, response: httpx.Response) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Разобрать страницу списка документов: (документы, токен следующей страницы)"""
+    if response.status_code != 200:
+        print(f"Error getting all from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        # Исключение, а не пустая страница: iter_all отличает ошибку от конца коллекции
+        raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+    data = loads(response.content)
+    items = [_document_to_item(doc) for doc in data.get('documents', [])]
+    return items, data.get('nextPageToken')
+
+def _build_filter(field: str, op: str, value: Any) -> Dict[str, Any]:
+    """Фильтр structuredQuery для одного условия (field, op, value)"""
+    if value is None and op in ('==', '!='):
+        return {'unaryFilter': {
+            'op': 'IS_NULL' if op == '==' else 'IS_NOT_NULL',
+            'field': {'fieldPath': field},
+        }}
+    if op not in QUERY_OPERATORS:
+        raise ValueError(f"Unsupported query operator: {op}")
+    return {'fieldFilter': {
+        'field': {'fieldPath': field},
+        'op': QUERY_OPERATORS[op],
+        'value': encode_value(value),
+    }}
+
+def _build_run_query(collection_name: str, filters: List[tuple], order_by: OrderBy = None,
+                     limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                     start_after: Optional[list] = None) -> Dict[str, Any]:
+    """Тело запроса :runQuery для фильтров, сортировки, курсора, лимита и проекции полей"""
+    structured_query: Dict[str, Any] = {'from': [{'collectionId': collection_name}]}
+
+    if fields is not None:
+        structured_query['select'] = {'fields': [{'fieldPath': field} for field in fields]}
+
+    where = [_build_filter(field, op, value) for field, op, value in filters]
+    if len(where) == 1:
+        structured_query['where'] = where[0]
+    elif where:
+        structured_query['where'] = {'compositeFilter': {'op': 'AND', 'filters': where}}
+
+    orders = normalize_order_by(order_by)
+    if orders:
+        structured_query['orderBy'] = [
+            {'field': {'fieldPath': field}, 'direction': direction} for field, direction in orders
+        ]
+
+    if start_after:
+        # Курсор - значения полей orderBy; ID документа передается полным именем
+        structured_query['startAt'] = {
+            'values': [
+                {'referenceValue': _doc_name(collection_name, value)} if field == DOCUMENT_ID_FIELD
+                else encode_value(value)
+                for (field, _), value in zip(orders, start_after)
+            ],
+            'before': False,
+        }
+
+    if limit:
+        structured_query['limit'] = limit
+
+    return {'structuredQuery': structured_query}
+
+def _parse_run_query(collection_name: str, response: httpx.Response) -> List[Dict[str, Any]]:
+    """Разобрать ответ :runQuery (массив результатов, часть без документа)"""
+    if response.status_code != 200:
+        print(f"Error querying {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        # Исключение, а не пустой список: без индекса (FAILED_PRECONDITION), без доступа или
+        # при ошибке сервера вызывающий код не должен решить, что документов нет
+        raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request, response=response)
+    return [_document_to_item(entry['document']) for entry in loads(response.content) if 'document' in entry]
+
+def _unique_ids(doc_ids: Iterable[Optional[str]]) -> List[str]:
+    """Уникальные непустые ID в исходном порядке"""
+    return list(dict.fromkeys(doc_id for doc_id in doc_ids if doc_id))
+
+def _build_batch_get(collection_name: str, doc_ids: List[str], fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Тело запроса :batchGet для списка ID одной коллекции"""
+    payload: Dict[str, Any] = {
+        'documents': [_doc_name(collection_name, doc_id) for doc_id in doc_ids]
+    }
+    if fields is not None:
+        payload['mask'] = {'fieldPaths': list(fields)}
+    return payload
+
+def _parse_batch_get(collection_name: str, response: httpx.Response) -> Dict[str, Dict[str, Any]]:
+    """Разобрать ответ :batchGet в словарь id -> документ (отсутствующие документы пропускаются)"""
+    if response.status_code != 200:
+        print(f"Error batch getting from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        return {}
+    result = {}
+    for entry in loads(response.content):
+        if 'found' in entry:
+            item = _document_to_item(entry['found'])
+            result[item['id']] = item
+    return result
+
+def _field_path(name: str) -> str:
+    """Имя поля верхнего уровня для updateMask (нестандартные имена экранируются)"""
+    if SIMPLE_FIELD_NAME.match(name):
+        return name
+    return '`' + name.replace('\\', '\\\\').replace('`', '\\`') + '`'
+
+def _build_write(write: Write) -> Dict[str, Any]:
+    """Операция (op, коллекция, id, поля) -> Write для :commit"""
+    op, collection_name, doc_id, data = write
+    name = _doc_name(collection_name, doc_id)
+    if op == 'delete':
+        return {'delete': name}
+    if op not in ('set', 'update'):
+        raise ValueError(f"Unsupported write operation: {op}")
+    if not data:
+        # Без полей маска пустая и запись заменила бы весь документ пустым (Admin SDK тоже отклоняет)
+        raise ValueError(f"Empty {op} of {collection_name}/{doc_id}")
+    result = {
+        'update': {'name': name, 'fields': encode_fields(data)},
+        # Маска: изменяются только переданные поля, остальные поля документа сохраняются
+        'updateMask': {'fieldPaths': [_field_path(k) for k in data]},
+    }
+    if op == 'update':
+        result['currentDocument'] = {'exists': True}
+    return result
+
+def _parse_commit(response: httpx.Response, count: int) -> bool:
+    if response.status_code != 200:
+        print(f"Error committing {count} writes: HTTP {response.status_code}, Response: {response.text[:200]}")
+        return False
+    return True
+
+def _parse_get_by_id(collection_name: str, doc_id: str, response: httpx.Response) -> Optional[Dict[str, Any]]:
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        print(f"Error getting {doc_id} from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        return None
+    return _document_to_item(loads(response.content), doc_id)
+
+def _parse_get_with_update_time(collection_name: str, doc_id: str,
+                                response: httpx.Response) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    if response.status_code == 404:
+        return None, None
+    if response.status_code != 200:
+        print(f"Error getting {doc_id} from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        return None, None
+    doc = loads(response.content)
+    return _document_to_item(doc, doc_id), doc.get('updateTime')
+
+def _update_params(fields: Dict[str, Any], update_time: Optional[str] = None) -> Dict[str, Any]:
+    """Параметры PATCH частичного обновления: маска полей и предусловие"""
+    params = _params()
+    params['updateMask.fieldPaths'] = [_field_path(k) for k in fields]
+    if update_time:
+        params['currentDocument.updateTime'] = update_time
     else:
-        return {'stringValue': str(value)}
+        params['currentDocument.exists'] = 'true'
+    return params
+
+def _parse_update(collection_name: str, doc_id: str, response: httpx.Response) -> bool:
+    if response.status_code != 200:
+        # 404 - документа нет, 400/409 FAILED_PRECONDITION - документ изменен после чтения
+        print(f"Error updating {doc_id} in {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        return False
+    return True
+
+def _parse_save(collection_name: str, response: httpx.Response) -> bool:
+    if response.status_code not in [200, 201]:
+        print(f"Error saving to {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        return False
+    return True
+
+def _parse_delete(collection_name: str, doc_id: str, response: httpx.Response) -> bool:
+    if response.status_code not in [200, 204]:
+        print(f"Error deleting {doc_id} from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
+        return False
+    return True
+
+# ---------------------------------------------------------------------------
+# HTTP пулы соединений
+# ---------------------------------------------------------------------------
+
+def _record_response_size(response: httpx.Response) -> None:
+    # Тело читается здесь, чтобы узнать размер; повторное чтение в клиенте берет его из памяти
+    response.read()
+    record_response_bytes(response.num_bytes_downloaded or len(response.content))
+
+async def _arecord_response_size(response: httpx.Response) -> None:
+    await response.aread()
+    record_response_bytes(response.num_bytes_downloaded or len(response.content))
+
+_sync_http: Optional[httpx.Client] = None
+_sync_http_lock = threading.Lock()
+
+def _get_sync_http() -> httpx.Client:
+    """Общий синхронный HTTP клиент (создается при первом обращении)"""
+    global _sync_http
+    if _sync_http is None:
+        with _sync_http_lock:
+            if _sync_http is None:
+                _sync_http = httpx.Client(timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS,
+                                          event_hooks={'response': [_record_response_size]})
+    return _sync_http
 
 class FirebaseClient:
-    """Клиент для работы с Firebase Firestore через REST API"""
-    
+    """Клиент для работы с Firebase Firestore через REST API (синхронный)"""
+
     @staticmethod
-    def get_all(collection_name: str) -> List[Dict[str, Any]]:
-        """Получить все документы из коллекции"""
+    def iter_all(collection_name: str, page_size: int = DEFAULT_PAGE_SIZE,
+                 fields: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Постранично перебрать документы коллекции
+
+        В памяти одновременно находится не больше одной страницы (page_size документов).
+        Ошибка на первой странице логируется, перебор ничего не возвращает; ошибка
+        на следующих - IncompleteReadError (часть коллекции уже выдана).
+        fields - список полей, которые нужно вернуть (None - все поля).
+        """
+        page_token = None
+        pages = 0
+        while True:
+            try:
+                response = _get_sync_http().get(_doc_url(collection_name), params=_page_params(page_size, page_token, fields))
+                items, page_token = _parse_page(collection_name, response)
+            except Exception as e:
+                print(f"Error getting all from {collection_name}: {e}")
+                traceback.print_exc()
+                if pages:
+                    raise IncompleteReadError(collection_name, pages, e) from e
+                return
+            pages += 1
+            yield from items
+            if not page_token:
+                return
+
+    @staticmethod
+    def get_all(collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Получить все документы из коллекции (fields - только указанные поля)"""
+        return list(FirebaseClient.iter_all(collection_name, fields=fields))
+
+    @staticmethod
+    def get_by_id(collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """Получить документ по ID (fields - только указанные поля)"""
         try:
-            url = f"{FIREBASE_DATABASE_URL}/{collection_name}"
-            params = {'key': FIREBASE_API_KEY}
-            response = requests.get(url, params=params, timeout=10)
-            
-            if response.status_code != 200:
-                print(f"Error getting all from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
-                return []
-            
-            data = response.json()
-            items = []
-            
-            if 'documents' in data:
-                for doc in data['documents']:
-                    # Извлекаем ID из пути документа
-                    doc_path = doc.get('name', '')
-                    doc_id = doc_path.split('/')[-1] if '/' in doc_path else doc_path
-                    
-                    # Конвертируем поля
-                    fields = doc.get('fields', {})
-                    item = {}
-                    for k, v in fields.items():
-                        item[k] = _convert_firestore_value(v)
-                    item['id'] = doc_id
-                    items.append(item)
-            
-            return items
+            response = _get_sync_http().get(_doc_url(collection_name, doc_id), params=_params(fields))
+            return _parse_get_by_id(collection_name, doc_id, response)
         except Exception as e:
-            print(f"Error getting all from {collection_name}: {e}")
-            import traceback
+            print(f"Error getting {doc_id} from {collection_name}: {e}")
             traceback.print_exc()
-            return []
-    
+            return None
+
     @staticmethod
-    def get_by_id(collection_name: str, doc_id: str) -> Optional[Dict[str, Any]]:
-        """Получить документ по ID"""
+    def get_with_update_time(collection_name: str, doc_id: str,
+                             fields: Optional[List[str]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        Получить документ и время его последнего изменения
+
+        Время (RFC 3339) можно передать в update(..., update_time=...), чтобы запись
+        не прошла, если документ изменили после чтения.
+
+        Returns:
+            (документ, updateTime) или (None, None) если документа нет
+        """
         try:
-            url = f"{FIREBASE_DATABASE_URL}/{collection_name}/{doc_id}"
-            params = {'key': FIREBASE_API_KEY}
-            response = requests.get(url, params=params, timeout=10)
-            
-            if response.status_code == 404:
-                return None
-            
-            if response.status_code != 200:
-                print(f"Error getting {doc_id} from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
-                return None
-            
-            doc = response.json()
-            fields = doc.get('fields', {})
-            item = {}
-            for k, v in fields.items():
-                item[k] = _convert_firestore_value(v)
-            item['id'] = doc_id
-            return item
+            response = _get_sync_http().get(_doc_url(collection_name, doc_id), params=_params(fields))
+            return _parse_get_with_update_time(collection_name, doc_id, response)
         except Exception as e:
             print(f"Error getting {doc_id} from {collection_name}: {e}")
-            import traceback
             traceback.print_exc()
-            return None
-    
+            return None, None
+
+    @staticmethod
+    def get_many(collection_name: str, doc_ids: Iterable[Optional[str]],
+                 fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """
+        Получить несколько документов по ID одним запросом (batchGet)
+
+        Пустые ID игнорируются, отсутствующие документы не попадают в результат.
+
+        Returns:
+            Словарь id -> документ
+        """
+        ids = _unique_ids(doc_ids)
+        if not ids:
+            return {}
+        try:
+            payload = _build_batch_get(collection_name, ids, fields)
+            response = _get_sync_http().post(FIREBASE_BATCH_GET_URL, json=payload, params=_params())
+            return _parse_batch_get(collection_name, response)
+        except Exception as e:
+            print(f"Error batch getting from {collection_name}: {e}")
+            traceback.print_exc()
+            return {}
+
     @staticmethod
     def save(collection_name: str, item: Dict[str, Any]) -> bool:
         """Сохранить документ (создать или обновить)"""
         try:
-            doc_id = item.get('id')
-            if not doc_id:
-                # Для создания нового документа нужно использовать POST
-                # Но проще использовать случайный ID
-                import random
-                import string
-                doc_id = ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-                item['id'] = doc_id
-            
-            # Удаляем id из данных перед сохранением
-            data = {k: v for k, v in item.items() if k != 'id'}
-            
-            # Конвертируем данные в формат Firestore
-            fields = {k: _convert_to_firestore_value(v) for k, v in data.items()}
-            
-            url = f"{FIREBASE_DATABASE_URL}/{collection_name}/{doc_id}"
-            params = {'key': FIREBASE_API_KEY}
-            payload = {'fields': fields}
-            
-            # Используем PATCH для обновления (merge=True)
-            response = requests.patch(url, json=payload, params=params, timeout=10)
-            
-            if response.status_code not in [200, 201]:
-                print(f"Error saving to {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
-                return False
-            
-            return True
+            doc_id, payload = _prepare_save(item)
+            response = _get_sync_http().patch(_doc_url(collection_name, doc_id), json=payload, params=_params())
+            return _parse_save(collection_name, response)
         except Exception as e:
             print(f"Error saving to {collection_name}: {e}")
-            import traceback
             traceback.print_exc()
             return False
-    
+
+    @staticmethod
+    def update(collection_name: str, doc_id: str, fields: Dict[str, Any],
+               update_time: Optional[str] = None) -> bool:
+        """
+        Обновить только указанные поля документа одним запросом (без чтения)
+
+        Args:
+            collection_name: Название коллекции
+            doc_id: ID документа
+            fields: Поля верхнего уровня и их новые значения
+            update_time: Предусловие - время изменения документа из get_with_update_time
+                         (None - достаточно, чтобы документ существовал)
+
+        Returns:
+            True если обновлено или обновлять нечего (пустой fields - запрос не отправляется);
+            False если документа нет или предусловие не выполнено
+        """
+        if not fields:
+            # PATCH без updateMask заменил бы документ пустым
+            return True
+        try:
+            payload = {'fields': encode_fields(fields)}
+            response = _get_sync_http().patch(_doc_url(collection_name, doc_id), json=payload,
+                                              params=_update_params(fields, update_time))
+            return _parse_update(collection_name, doc_id, response)
+        except Exception as e:
+            print(f"Error updating {doc_id} in {collection_name}: {e}")
+            traceback.print_exc()
+            return False
+
+    @staticmethod
+    def commit(writes: List[Write]) -> bool:
+        """
+        Атомарно выполнить список записей (op, коллекция, id, поля)
+
+        Записи отправляются запросами :commit по MAX_BATCH_WRITES операций,
+        каждый запрос применяется целиком или не применяется вовсе.
+        При ошибке оставшиеся части не отправляются.
+
+        Returns:
+            True если все записи применены
+        """
+        for chunk in chunk_writes(writes):
+            try:
+                payload = {'writes': [_build_write(w) for w in chunk]}
+                response = _get_sync_http().post(FIREBASE_COMMIT_URL, json=payload, params=_params())
+                if not _parse_commit(response, len(chunk)):
+                    return False
+            except Exception as e:
+                print(f"Error committing {len(chunk)} writes: {e}")
+                traceback.print_exc()
+                return False
+        return True
+
+    @staticmethod
+    def batch() -> Batch:
+        """Пакет записей: with firebase.batch() as batch: ... (commit при выходе из блока)"""
+        return Batch(FirebaseClient)
+
     @staticmethod
     def delete(collection_name: str, doc_id: str) -> bool:
         """Удалить документ"""
         try:
-            url = f"{FIREBASE_DATABASE_URL}/{collection_name}/{doc_id}"
-            params = {'key': FIREBASE_API_KEY}
-            response = requests.delete(url, params=params, timeout=10)
-            
-            if response.status_code not in [200, 204]:
-                print(f"Error deleting {doc_id} from {collection_name}: HTTP {response.status_code}, Response: {response.text[:200]}")
-                return False
-            
-            return True
+            response = _get_sync_http().delete(_doc_url(collection_name, doc_id), params=_params())
+            return _parse_delete(collection_name, doc_id, response)
         except Exception as e:
             print(f"Error deleting {doc_id} from {collection_name}: {e}")
-            import traceback
             traceback.print_exc()
             return False
-    
+
     @staticmethod
-    def query(collection_name: str, filters: List[tuple]) -> List[Dict[str, Any]]:
-        """Выполнить запрос с фильтрами"""
-        # REST API для запросов сложнее, пока возвращаем все и фильтруем локально
+    def query(collection_name: str, filters: List[tuple], order_by: OrderBy = None,
+              limit: Optional[int] = None, fields: Optional[List[str]] = None,
+              start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        """
+        Выполнить запрос с фильтрами на стороне Firestore (structuredQuery)
+
+        Args:
+            collection_name: Название коллекции
+            filters: Список условий (field, op, value), объединяются через AND
+            order_by: Поле или список (поле, 'ASCENDING' | 'DESCENDING'); DOCUMENT_ID_FIELD - ID документа
+            limit: Максимальное количество документов
+            fields: Список возвращаемых полей (None - все поля)
+            start_after: Значения полей order_by документа, после которого начинается выборка
+
+        Raises:
+            httpx.HTTPError: Запрос не выполнен (нет составного индекса, нет доступа, ошибка сервера)
+        """
         try:
-            all_items = FirebaseClient.get_all(collection_name)
-            return all_items
+            payload = _build_run_query(collection_name, filters, order_by, limit, fields, start_after)
+            response = _get_sync_http().post(FIREBASE_RUN_QUERY_URL, json=payload, params=_params())
+            return _parse_run_query(collection_name, response)
         except Exception as e:
+            # Ошибку обрабатывает вызывающий код (пустой список - только "документов нет")
             print(f"Error querying {collection_name}: {e}")
-            import traceback
+            raise
+
+    @staticmethod
+    def get_changed_since(collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                          limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                          after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Документы, измененные после watermark (field > watermark), по возрастанию (field, id)
+
+        Новый курсор - field и id последнего документа: с after_id выборка начинается
+        после документа (watermark, after_id) и не теряет документы с тем же field
+        на границе страницы. Документы без field в выборку не попадают.
+        """
+        filters, order_by, start_after, fields = changed_since_args(watermark, field, fields, after_id)
+        return FirebaseClient.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                    start_after=start_after)
+
+class AsyncFirebaseClient:
+    """
+    Асинхронный клиент Firestore REST API для обработчиков бота
+
+    Тот же интерфейс, что и у FirebaseClient, но методы нужно вызывать через await.
+    HTTP клиент создается лениво внутри работающего event loop.
+    """
+
+    def __init__(self):
+        self._http: Optional[httpx.AsyncClient] = None
+
+    def _get_http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS,
+                                           event_hooks={'response': [_arecord_response_size]})
+        return self._http
+
+    async def aclose(self) -> None:
+        """Закрыть пул соединений (вызывается при остановке бота)"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def iter_all(self, collection_name: str, page_size: int = DEFAULT_PAGE_SIZE,
+                       fields: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Постранично перебрать документы коллекции (async for; ошибки - как в FirebaseClient.iter_all)"""
+        page_token = None
+        pages = 0
+        while True:
+            try:
+                response = await self._get_http().get(_doc_url(collection_name), params=_page_params(page_size, page_token, fields))
+                items, page_token = _parse_page(collection_name, response)
+            except Exception as e:
+                print(f"Error getting all from {collection_name}: {e}")
+                traceback.print_exc()
+                if pages:
+                    raise IncompleteReadError(collection_name, pages, e) from e
+                return
+            pages += 1
+            for item in items:
+                yield item
+            if not page_token:
+                return
+
+    async def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Получить все документы из коллекции (fields - только указанные поля)"""
+        return [item async for item in self.iter_all(collection_name, fields=fields)]
+
+    async def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        """Получить документ по ID (fields - только указанные поля)"""
+        try:
+            response = await self._get_http().get(_doc_url(collection_name, doc_id), params=_params(fields))
+            return _parse_get_by_id(collection_name, doc_id, response)
+        except Exception as e:
+            print(f"Error getting {doc_id} from {collection_name}: {e}")
+            traceback.print_exc()
+            return None
+
+    async def get_with_update_time(self, collection_name: str, doc_id: str,
+                                   fields: Optional[List[str]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """Получить документ и время его последнего изменения: (документ, updateTime)"""
+        try:
+            response = await self._get_http().get(_doc_url(collection_name, doc_id), params=_params(fields))
+            return _parse_get_with_update_time(collection_name, doc_id, response)
+        except Exception as e:
+            print(f"Error getting {doc_id} from {collection_name}: {e}")
+            traceback.print_exc()
+            return None, None
+
+    async def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                       fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """Получить несколько документов по ID одним запросом (batchGet), id -> документ"""
+        ids = _unique_ids(doc_ids)
+        if not ids:
+            return {}
+        try:
+            payload = _build_batch_get(collection_name, ids, fields)
+            response = await self._get_http().post(FIREBASE_BATCH_GET_URL, json=payload, params=_params())
+            return _parse_batch_get(collection_name, response)
+        except Exception as e:
+            print(f"Error batch getting from {collection_name}: {e}")
+            traceback.print_exc()
+            return {}
+
+    async def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        """Сохранить документ (создать или обновить)"""
+        try:
+            doc_id, payload = _prepare_save(item)
+            response = await self._get_http().patch(_doc_url(collection_name, doc_id), json=payload, params=_params())
+            return _parse_save(collection_name, response)
+        except Exception as e:
+            print(f"Error saving to {collection_name}: {e}")
+            traceback.print_exc()
+            return False
+
+    async def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+                     update_time: Optional[str] = None) -> bool:
+        """Обновить только указанные поля документа (update_time - предусловие; пустой fields - ничего не делает)"""
+        if not fields:
+            return True
+        try:
+            payload = {'fields': encode_fields(fields)}
+            response = await self._get_http().patch(_doc_url(collection_name, doc_id), json=payload,
+                                                    params=_update_params(fields, update_time))
+            return _parse_update(collection_name, doc_id, response)
+        except Exception as e:
+            print(f"Error updating {doc_id} in {collection_name}: {e}")
             traceback.print_exc()
-            return []
+            return False
+
+    async def commit(self, writes: List[Write]) -> bool:
+        """Атомарно выполнить список записей (по MAX_BATCH_WRITES операций на запрос)"""
+        for chunk in chunk_writes(writes):
+            try:
+                payload = {'writes': [_build_write(w) for w in chunk]}
+                response = await self._get_http().post(FIREBASE_COMMIT_URL, json=payload, params=_params())
+                if not _parse_commit(response, len(chunk)):
+                    return False
+            except Exception as e:
+                print(f"Error committing {len(chunk)} writes: {e}")
+                traceback.print_exc()
+                return False
+        return True
+
+    def batch(self) -> AsyncBatch:
+        """Пакет записей: async with async_firebase.batch() as batch: ..."""
+        return AsyncBatch(self)
+
+    async def delete(self, collection_name: str, doc_id: str) -> bool:
+        """Удалить документ"""
+        try:
+            response = await self._get_http().delete(_doc_url(collection_name, doc_id), params=_params())
+            return _parse_delete(collection_name, doc_id, response)
+        except Exception as e:
+            print(f"Error deleting {doc_id} from {collection_name}: {e}")
+            traceback.print_exc()
+            return False
+
+    async def query(self, collection_name: str, filters: List[tuple], order_by: OrderBy = None,
+                    limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                    start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        """Выполнить запрос с фильтрами на стороне Firestore (structuredQuery); ошибки - исключением"""
+        try:
+            payload = _build_run_query(collection_name, filters, order_by, limit, fields, start_after)
+            response = await self._get_http().post(FIREBASE_RUN_QUERY_URL, json=payload, params=_params())
+            return _parse_run_query(collection_name, response)
+        except Exception as e:
+            # Ошибку обрабатывает вызывающий код (пустой список - только "документов нет")
+            print(f"Error querying {collection_name}: {e}")
+            raise
+
+    async def get_changed_since(self, collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                                limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                                after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Документы, измененные после watermark (или после документа (watermark, after_id)), по возрастанию (field, id)"""
+        filters, order_by, start_after, fields = changed_since_args(watermark, field, fields, after_id)
+        return await self.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                start_after=start_after)
 
-# Создаем экземпляр клиента
+# Создаем экземпляры клиентов
 firebase = FirebaseClient()
+async_firebase = AsyncFirebaseClient()
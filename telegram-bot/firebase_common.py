@@ -0,0 +1,302 @@
+"""
+Общие части клиентов Firestore (REST и Admin SDK)
+
+Пакетная запись: операции накапливаются в Batch и отправляются одним commit.
+Операция записи - кортеж (op, collection_name, doc_id, data):
+    ('set', коллекция, id, поля)     - создать или обновить документ (merge, как save)
+    ('update', коллекция, id, поля)  - обновить только указанные поля существующего документа
+    ('delete', коллекция, id, None)  - удалить документ
+
+query_documents - query с семантикой Firestore по локальной копии коллекции
+(зеркало в памяти, SQLite зеркало).
+"""
+import copy
+import os
+import random
+import string
+import threading
+import time
+from typing import List, Dict, Any, Optional, Iterator, Iterable, Tuple, Union
+
+# Максимальное количество записей в одном commit (ограничение Firestore)
+MAX_BATCH_WRITES = 500
+
+# Размер страницы при постраничном чтении коллекций (максимум Firestore - 300)
+DEFAULT_PAGE_SIZE = 300
+
+# Тип параметра order_by: 'field' или [('field', 'ASCENDING' | 'DESCENDING'), ...]
+OrderBy = Union[str, List[Union[str, Tuple[str, str]]], None]
+
+Write = Tuple[str, str, str, Optional[Dict[str, Any]]]
+
+class IncompleteReadError(Exception):
+    """
+    Постраничное чтение коллекции (iter_all, get_all) оборвалось после первой страницы
+
+    Часть документов уже получена; без исключения обрезанный список не отличить
+    от полной коллекции. Ошибка на первой странице по-прежнему дает пустой результат.
+    """
+
+    def __init__(self, collection_name: str, pages: int, error: Exception):
+        super().__init__(f"Reading {collection_name} failed after {pages} page(s): {error}")
+        self.collection_name = collection_name
+        self.pages = pages
+
+# Поле, по которому строится лента изменений (get_changed_since)
+CHANGE_FEED_FIELD = 'updatedAt'
+
+# Имя поля ID документа в order_by и start_after (как FieldPath.document_id() в Firestore)
+DOCUMENT_ID_FIELD = '__name__'
+
+def changed_since_args(watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                       fields: Optional[List[str]] = None, after_id: Optional[str] = None
+                       ) -> Tuple[List[tuple], List[Tuple[str, str]], Optional[list], Optional[List[str]]]:
+    """
+    Аргументы query для get_changed_since: (filters, order_by, start_after, fields)
+
+    Документы по возрастанию (field, id). Без after_id - документы с field > watermark;
+    с after_id - курсор после документа (watermark, after_id): документы с тем же
+    значением field и большим ID не теряются на границе страницы. Поле водяного
+    знака всегда входит в проекцию, чтобы по последнему документу сдвинуть курсор.
+    """
+    filters: List[tuple] = []
+    start_after = None
+    if watermark and after_id:
+        start_after = [watermark, after_id]
+    elif watermark:
+        filters = [(field, '>', watermark)]
+    if fields is not None and field not in fields:
+        fields = list(fields) + [field]
+    return filters, [(field, 'ASCENDING'), (DOCUMENT_ID_FIELD, 'ASCENDING')], start_after, fields
+
+def new_document_id() -> str:
+    """Случайный ID нового документа"""
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+# Алфавит Crockford base32 (ULID): порядок символов совпадает с порядком строк
+_ULID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_ulid_lock = threading.Lock()
+_ulid_last = (0, 0)
+
+def _base32(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 32)
+        chars.append(_ULID_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+def new_sortable_id() -> str:
+    """
+    Уникальный ID, упорядоченный по времени создания (ULID, 26 символов)
+
+    48 бит - миллисекунды Unix, 80 бит - случайная часть. ID, созданные позже,
+    больше при сравнении строк; в пределах одной миллисекунды процесс увеличивает
+    случайную часть предыдущего ID, поэтому порядок сохраняется и внутри нее.
+    """
+    global _ulid_last
+    with _ulid_lock:
+        millis = int(time.time() * 1000)
+        last_millis, last_random = _ulid_last
+        if millis <= last_millis:
+            millis, randomness = last_millis, last_random + 1
+        else:
+            randomness = int.from_bytes(os.urandom(10), 'big')
+        _ulid_last = (millis, randomness)
+    return _base32(millis, 10) + _base32(randomness % (1 << 80), 16)
+
+def chunk_writes(writes: List[Write], size: int = MAX_BATCH_WRITES) -> Iterator[List[Write]]:
+    """Разбить список записей на части не больше size (каждая часть - отдельный атомарный commit)"""
+    for start in range(0, len(writes), size):
+        yield writes[start:start + size]
+
+# ---------------------------------------------------------------------------
+# Выполнение query по локальной копии коллекции (зеркала)
+# ---------------------------------------------------------------------------
+
+# Порядок типов при сортировке (как в Firestore: null < bool < число < строка < прочее)
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, str(value))
+
+_MISSING = object()
+
+def _get_field(item: Dict[str, Any], field: str) -> Any:
+    """Значение поля по пути 'a.b' или _MISSING"""
+    if field == DOCUMENT_ID_FIELD:
+        return item['id']
+    value: Any = item
+    for part in field.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+def _compare(left: Any, right: Any, op: str) -> bool:
+    if _sort_key(left)[0] != _sort_key(right)[0]:
+        # Firestore сравнивает значения только одного типа
+        return False
+    if op == '<':
+        return left < right
+    if op == '<=':
+        return left <= right
+    if op == '>':
+        return left > right
+    return left >= right
+
+def matches_filter(item: Dict[str, Any], field: str, op: str, value: Any) -> bool:
+    """Проверить условие (field, op, value) так же, как это делает Firestore"""
+    current = _get_field(item, field)
+    if current is _MISSING:
+        # Документы без поля не попадают в результат ни одного фильтра
+        return False
+    if op == '==':
+        return current == value
+    if op == '!=':
+        return current is not None and current != value
+    if op in ('<', '<=', '>', '>='):
+        return _compare(current, value, op)
+    if op == 'array-contains':
+        return isinstance(current, list) and value in current
+    if op == 'array-contains-any':
+        return isinstance(current, list) and any(v in current for v in value)
+    if op == 'in':
+        return current in value
+    if op == 'not-in':
+        return current is not None and current not in value
+    raise ValueError(f"Unsupported query operator: {op}")
+
+def project_document(item: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """Копия документа (fields - только указанные поля верхнего уровня + id)"""
+    if fields is None:
+        return copy.deepcopy(item)
+    result = {f: copy.deepcopy(item[f]) for f in fields if f in item}
+    result['id'] = item['id']
+    return result
+
+def normalize_order_by(order_by: OrderBy) -> List[Tuple[str, str]]:
+    """Привести order_by к списку (поле, направление)"""
+    if not order_by:
+        return []
+    if isinstance(order_by, str):
+        order_by = [order_by]
+    result = []
+    for entry in order_by:
+        if isinstance(entry, str):
+            result.append((entry, 'ASCENDING'))
+        else:
+            field, direction = entry
+            result.append((field, direction.upper()))
+    return result
+
+def _is_after(item: Dict[str, Any], order: List[Tuple[str, str]], cursor: list) -> bool:
+    """Документ идет строго после курсора (значения полей order_by) в порядке сортировки"""
+    for (field, direction), value in zip(order, cursor):
+        current, bound = _sort_key(_get_field(item, field)), _sort_key(value)
+        if current != bound:
+            return current < bound if direction == 'DESCENDING' else current > bound
+    return False
+
+def query_documents(items: Iterable[Dict[str, Any]], filters: List[tuple], order_by: OrderBy = None,
+                    limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                    start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+    """
+    Выполнить query по документам в памяти (фильтры, сортировка, курсор и limit как в Firestore)
+
+    start_after - значения полей order_by (по порядку) документа, после которого
+    начинается выборка; для DOCUMENT_ID_FIELD - ID документа.
+    """
+    items = [item for item in items
+             if all(matches_filter(item, field, op, value) for field, op, value in filters)]
+    order = normalize_order_by(order_by)
+    if order:
+        # Как в Firestore: документы без поля сортировки не попадают в результат
+        items = [item for item in items if all(_get_field(item, f) is not _MISSING for f, _ in order)]
+        for field, direction in reversed(order):
+            items.sort(key=lambda it: _sort_key(_get_field(it, field)), reverse=direction == 'DESCENDING')
+        if start_after:
+            items = [item for item in items if _is_after(item, order, start_after)]
+    else:
+        items.sort(key=lambda it: it['id'])
+    if limit:
+        items = items[:limit]
+    return [project_document(item, fields) for item in items]
+
+class Batch:
+    """
+    Накопитель записей для FirebaseClient.commit
+
+    Использование:
+        with firebase.batch() as batch:
+            batch.update('notificationQueue', task_id, {'sent': True})
+            batch.delete('notificationQueue', old_id)
+
+    При выходе из блока без исключения записи отправляются одним запросом
+    на каждые MAX_BATCH_WRITES операций. Результат доступен в batch.committed.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.writes: List[Write] = []
+        self.committed: Optional[bool] = None
+
+    def __len__(self) -> int:
+        return len(self.writes)
+
+    def set(self, collection_name: str, item: Dict[str, Any]) -> str:
+        """Создать или обновить документ (если id нет - генерируется), возвращает ID"""
+        doc_id = item.get('id')
+        if not doc_id:
+            doc_id = new_document_id()
+            item['id'] = doc_id
+        data = {k: v for k, v in item.items() if k != 'id'}
+        self.writes.append(('set', collection_name, doc_id, data))
+        return doc_id
+
+    def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any]) -> None:
+        """Обновить указанные поля существующего документа"""
+        self.writes.append(('update', collection_name, doc_id, dict(fields)))
+
+    def delete(self, collection_name: str, doc_id: str) -> None:
+        """Удалить документ"""
+        self.writes.append(('delete', collection_name, doc_id, None))
+
+    def commit(self) -> bool:
+        """Отправить накопленные записи"""
+        writes, self.writes = self.writes, []
+        self.committed = self._client.commit(writes) if writes else True
+        return self.committed
+
+    def __enter__(self) -> 'Batch':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is None:
+            self.commit()
+        return False
+
+class AsyncBatch(Batch):
+    """Накопитель записей для AsyncFirebaseClient.commit (async with)"""
+
+    async def commit(self) -> bool:
+        """Отправить накопленные записи"""
+        writes, self.writes = self.writes, []
+        self.committed = await self._client.commit(writes) if writes else True
+        return self.committed
+
+    def __enter__(self):
+        raise TypeError("Use 'async with' for AsyncBatch")
+
+    async def __aenter__(self) -> 'AsyncBatch':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is None:
+            await self.commit()
+        return False
@@ -0,0 +1,522 @@
+"""
+Метрики обращений к Firestore
+
+InstrumentedFirebaseClient и AsyncInstrumentedFirebaseClient оборачивают
+клиента Firestore (REST или Admin SDK) непосредственно, под single-flight,
+кэшем и зеркалами, поэтому считаются только запросы, реально ушедшие в Firestore.
+Для каждой пары (операция, коллекция) накапливаются:
+    - число вызовов и ошибок (исключение или False у записи);
+    - число прочитанных/записанных документов;
+    - байты ответов (только REST API - через event hook httpx; Admin SDK
+      размер ответа не сообщает);
+    - гистограмма задержек с оценкой p50/p95/p99.
+
+Каждый вызов приписывается источнику - обработчику или задаче бота
+(periodic_check, send_daily_reminders, tasks_filter, ...). Источник берется
+из attribute(name), если он задан, иначе - ближайшая по стеку функция из
+bot.py / scheduler.py. Вызовы через data.py (пул потоков) получают источник
+вызвавшего их обработчика.
+
+Метрики доступны через metrics.snapshot(), HTTP (start_metrics_server:
+/metrics в формате Prometheus, /metrics.json) и команду /stats в боте.
+Другие компоненты добавляют свою статистику через add_source (snapshot)
+и add_prometheus_source (/metrics).
+"""
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Iterable, Callable, Tuple
+from firebase_common import Batch, AsyncBatch, Write, CHANGE_FEED_FIELD
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин гистограммы задержек (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Файлы, функции которых считаются источниками вызовов
+CALLER_FILES = ('bot.py', 'scheduler.py')
+
+# Источник вызовов, для которого не удалось определить обработчик
+UNKNOWN_CALLER = 'other'
+
+_caller = contextvars.ContextVar('firebase_caller', default=None)
+# Счетчик байт ответов текущего вызова (список из одного числа, общий для потоков через copy_context)
+_response_bytes = contextvars.ContextVar('firebase_response_bytes', default=None)
+
+@contextmanager
+def attribute(name: str) -> Iterator[None]:
+    """Приписать вызовы Firestore внутри блока источнику name"""
+    token = _caller.set(name)
+    try:
+        yield
+    finally:
+        _caller.reset(token)
+
+def current_caller() -> str:
+    """Источник текущего вызова: attribute(...) или ближайшая функция bot.py / scheduler.py в стеке"""
+    name = _caller.get()
+    if name:
+        return name
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if os.path.basename(code.co_filename) in CALLER_FILES and code.co_name not in ('wrapper', '<module>'):
+            return code.co_name
+        frame = frame.f_back
+    return UNKNOWN_CALLER
+
+def record_response_bytes(size: int) -> None:
+    """Учесть размер ответа Firestore в текущем вызове (вызывается из event hook HTTP клиента)"""
+    counter = _response_bytes.get()
+    if counter is not None:
+        counter[0] += size
+
+class LatencyHistogram:
+    """Гистограмма задержек с фиксированными корзинами"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q: float) -> float:
+        """Оценка перцентиля (линейная интерполяция внутри корзины)"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        lower = 0.0
+        for i, count in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.max
+            if count and cumulative + count >= rank:
+                return min(lower + (upper - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+            lower = upper
+        return self.max
+
+class _OpStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.docs = 0
+        self.bytes = 0
+        self.latency = LatencyHistogram()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'docs': self.docs,
+            'bytes': self.bytes,
+            'seconds': round(self.latency.total, 3),
+            'p50': round(self.latency.percentile(0.5), 4),
+            'p95': round(self.latency.percentile(0.95), 4),
+            'p99': round(self.latency.percentile(0.99), 4),
+        }
+
+class FirebaseMetrics:
+    """Потокобезопасный реестр метрик Firestore"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ops: Dict[Tuple[str, str], _OpStats] = {}
+        self._callers: Dict[Tuple[str, str], _OpStats] = {}
+        self._sources: Dict[str, Callable[[], Any]] = {}
+        self._exporters: List[Callable[[], str]] = []
+        self.started_at = time.time()
+
+    def record(self, op: str, collection_name: str, caller: str, seconds: float,
+               docs: int = 0, size: int = 0, error: bool = False) -> None:
+        with self._lock:
+            for registry, key in ((self._ops, (op, collection_name)), (self._callers, (caller, collection_name))):
+                stats = registry.get(key)
+                if stats is None:
+                    stats = registry[key] = _OpStats()
+                stats.calls += 1
+                stats.errors += int(error)
+                stats.docs += docs
+                stats.bytes += size
+                stats.latency.observe(seconds)
+
+    def add_source(self, name: str, func: Callable[[], Any]) -> None:
+        """Добавить в snapshot()['sources'] статистику другого компонента (кэш, пул потоков, ...)"""
+        self._sources[name] = func
+
+    def add_prometheus_source(self, func: Callable[[], str]) -> None:
+        """Добавить в prometheus() метрики другого компонента (func возвращает текст в формате Prometheus)"""
+        self._exporters.append(func)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._ops.clear()
+            self._callers.clear()
+            self.started_at = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            ops = [dict(op=op, collection=coll, **stats.as_dict()) for (op, coll), stats in self._ops.items()]
+            callers = [dict(caller=caller, collection=coll, **stats.as_dict())
+                       for (caller, coll), stats in self._callers.items()]
+        sources = {}
+        for name, func in self._sources.items():
+            try:
+                sources[name] = func()
+            except Exception as e:
+                sources[name] = {'error': str(e)}
+        return {
+            'since': self.started_at,
+            'operations': sorted(ops, key=lambda s: -s['docs']),
+            'callers': sorted(callers, key=lambda s: -s['docs']),
+            'sources': sources,
+        }
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        families: Dict[str, Tuple[str, List[str]]] = {
+            'firestore_calls_total': ('counter', []),
+            'firestore_errors_total': ('counter', []),
+            'firestore_documents_total': ('counter', []),
+            'firestore_response_bytes_total': ('counter', []),
+            'firestore_latency_seconds': ('histogram', []),
+            'firestore_caller_calls_total': ('counter', []),
+            'firestore_caller_documents_total': ('counter', []),
+        }
+
+        def add(family: str, labels: str, value: Any, suffix: str = '') -> None:
+            families[family][1].append(f'{family}{suffix}{{{labels}}} {value}')
+
+        with self._lock:
+            for (op, coll), stats in sorted(self._ops.items()):
+                labels = f'op="{op}",collection="{coll}"'
+                add('firestore_calls_total', labels, stats.calls)
+                add('firestore_errors_total', labels, stats.errors)
+                add('firestore_documents_total', labels, stats.docs)
+                add('firestore_response_bytes_total', labels, stats.bytes)
+                cumulative = 0
+                for bound, count in zip(stats.latency.buckets + (float('inf'),), stats.latency.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    add('firestore_latency_seconds', f'{labels},le="{le}"', cumulative, '_bucket')
+                add('firestore_latency_seconds', labels, f'{stats.latency.total:.6f}', '_sum')
+                add('firestore_latency_seconds', labels, stats.latency.count, '_count')
+            for (caller, coll), stats in sorted(self._callers.items()):
+                labels = f'caller="{caller}",collection="{coll}"'
+                add('firestore_caller_calls_total', labels, stats.calls)
+                add('firestore_caller_documents_total', labels, stats.docs)
+
+        lines = []
+        for family, (kind, samples) in families.items():
+            lines.append(f'# TYPE {family} {kind}')
+            lines.extend(samples)
+        for exporter in self._exporters:
+            try:
+                lines.append(exporter().rstrip('\n'))
+            except Exception as e:
+                logger.error(f"[METRICS] Prometheus source error: {e}", exc_info=True)
+        return '\n'.join(lines) + '\n'
+
+metrics = FirebaseMetrics()
+
+# ---------------------------------------------------------------------------
+# HTTP endpoint
+# ---------------------------------------------------------------------------
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = metrics.prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body = json.dumps(metrics.snapshot(), ensure_ascii=False, default=str).encode('utf-8')
+            content_type = 'application/json; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Опросы Prometheus не пишем в лог бота
+        pass
+
+def start_metrics_server(host: str, port: int) -> Optional[ThreadingHTTPServer]:
+    """Запустить HTTP сервер метрик в фоновом потоке (None, если порт занят)"""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        logger.error(f"[METRICS] Cannot listen on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"[METRICS] Serving http://{host}:{port}/metrics")
+    return server
+
+# ---------------------------------------------------------------------------
+# Обертки клиентов
+# ---------------------------------------------------------------------------
+
+def _count(result: Any) -> int:
+    if isinstance(result, (list, dict)):
+        # dict - результат get_many (id -> документ); документ get_by_id считается отдельно
+        return len(result)
+    return 0
+
+class _Measure:
+    """Замер одного вызова: время, байты ответа, источник"""
+
+    def __init__(self, op: str, collection_name: str):
+        self.op = op
+        self.collection_name = collection_name
+        self.caller = current_caller()
+        self.size = [0]
+        self.seconds = 0.0
+
+    @contextmanager
+    def step(self) -> Iterator[None]:
+        """Участок, во время которого идет обращение к Firestore (для итераторов - одна страница)"""
+        token = _response_bytes.set(self.size)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds += time.perf_counter() - started
+            _response_bytes.reset(token)
+
+    def done(self, docs: int = 0, error: bool = False) -> None:
+        metrics.record(self.op, self.collection_name, self.caller, self.seconds,
+                       docs=docs, size=self.size[0], error=error)
+
+def _measure_read(op: str, collection_name: str, call: Callable[[], Any], docs: Callable[[Any], int] = _count) -> Any:
+    measure = _Measure(op, collection_name)
+    try:
+        with measure.step():
+            result = call()
+    except Exception:
+        measure.done(error=True)
+        raise
+    measure.done(docs=docs(result))
+    return result
+
+def _measure_write(op: str, collection_name: str, call: Callable[[], bool], docs: int = 1) -> bool:
+    measure = _Measure(op, collection_name)
+    try:
+        with measure.step():
+            ok = call()
+    except Exception:
+        measure.done(docs=docs, error=True)
+        raise
+    measure.done(docs=docs, error=not ok)
+    return ok
+
+async def _ameasure_read(op: str, collection_name: str, call: Callable[[], Any], docs: Callable[[Any], int] = _count) -> Any:
+    measure = _Measure(op, collection_name)
+    try:
+        with measure.step():
+            result = await call()
+    except Exception:
+        measure.done(error=True)
+        raise
+    measure.done(docs=docs(result))
+    return result
+
+async def _ameasure_write(op: str, collection_name: str, call: Callable[[], Any], docs: int = 1) -> bool:
+    measure = _Measure(op, collection_name)
+    try:
+        with measure.step():
+            ok = await call()
+    except Exception:
+        measure.done(docs=docs, error=True)
+        raise
+    measure.done(docs=docs, error=not ok)
+    return ok
+
+def _one(result: Any) -> int:
+    return 1 if result else 0
+
+def _pair(result: Tuple[Any, Any]) -> int:
+    return 1 if result and result[0] else 0
+
+def _commit_collection(writes: List[Write]) -> str:
+    collections = {write[1] for write in writes}
+    return collections.pop() if len(collections) == 1 else '*'
+
+class InstrumentedFirebaseClient:
+    """Обертка над синхронным клиентом: метрики каждого вызова Firestore"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def iter_all(self, collection_name: str, page_size: Optional[int] = None,
+                 fields: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        if page_size is None:
+            items = self._client.iter_all(collection_name, fields=fields)
+        else:
+            items = self._client.iter_all(collection_name, page_size=page_size, fields=fields)
+        measure = _Measure('iter_all', collection_name)
+        docs = 0
+        try:
+            while True:
+                # Время считается только внутри next(): между документами работает вызывающий код
+                with measure.step():
+                    item = next(items, None)
+                if item is None:
+                    break
+                docs += 1
+                yield item
+        finally:
+            measure.done(docs=docs)
+
+    def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        return _measure_read('get_all', collection_name, lambda: self._client.get_all(collection_name, fields=fields))
+
+    def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        return _measure_read('get_by_id', collection_name,
+                             lambda: self._client.get_by_id(collection_name, doc_id, fields=fields), docs=_one)
+
+    def get_with_update_time(self, collection_name: str, doc_id: str,
+                             fields: Optional[List[str]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        return _measure_read('get_with_update_time', collection_name,
+                             lambda: self._client.get_with_update_time(collection_name, doc_id, fields=fields),
+                             docs=_pair)
+
+    def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                 fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        return _measure_read('get_many', collection_name,
+                             lambda: self._client.get_many(collection_name, doc_ids, fields=fields))
+
+    def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+              limit: Optional[int] = None, fields: Optional[List[str]] = None,
+              start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        return _measure_read('query', collection_name,
+                             lambda: self._client.query(collection_name, filters, order_by=order_by,
+                                                        limit=limit, fields=fields, start_after=start_after))
+
+    def get_changed_since(self, collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                          limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                          after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        return _measure_read('get_changed_since', collection_name,
+                             lambda: self._client.get_changed_since(collection_name, watermark, field=field,
+                                                                    limit=limit, fields=fields, after_id=after_id))
+
+    def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        return _measure_write('save', collection_name, lambda: self._client.save(collection_name, item))
+
+    def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+               update_time: Optional[str] = None) -> bool:
+        return _measure_write('update', collection_name,
+                              lambda: self._client.update(collection_name, doc_id, fields, update_time=update_time))
+
+    def delete(self, collection_name: str, doc_id: str) -> bool:
+        return _measure_write('delete', collection_name, lambda: self._client.delete(collection_name, doc_id))
+
+    def commit(self, writes: List[Write]) -> bool:
+        return _measure_write('commit', _commit_collection(writes), lambda: self._client.commit(writes),
+                              docs=len(writes))
+
+    def batch(self) -> Batch:
+        return Batch(self)
+
+class AsyncInstrumentedFirebaseClient:
+    """Обертка над асинхронным клиентом: метрики каждого вызова Firestore"""
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def iter_all(self, collection_name: str, page_size: Optional[int] = None,
+                       fields: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        if page_size is None:
+            items = self._client.iter_all(collection_name, fields=fields)
+        else:
+            items = self._client.iter_all(collection_name, page_size=page_size, fields=fields)
+        measure = _Measure('iter_all', collection_name)
+        docs = 0
+        try:
+            while True:
+                with measure.step():
+                    try:
+                        item = await items.__anext__()
+                    except StopAsyncIteration:
+                        break
+                docs += 1
+                yield item
+        finally:
+            measure.done(docs=docs)
+
+    async def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        return await _ameasure_read('get_all', collection_name,
+                                    lambda: self._client.get_all(collection_name, fields=fields))
+
+    async def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        return await _ameasure_read('get_by_id', collection_name,
+                                    lambda: self._client.get_by_id(collection_name, doc_id, fields=fields), docs=_one)
+
+    async def get_with_update_time(self, collection_name: str, doc_id: str,
+                                   fields: Optional[List[str]] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        return await _ameasure_read('get_with_update_time', collection_name,
+                                    lambda: self._client.get_with_update_time(collection_name, doc_id, fields=fields),
+                                    docs=_pair)
+
+    async def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                       fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        return await _ameasure_read('get_many', collection_name,
+                                    lambda: self._client.get_many(collection_name, doc_ids, fields=fields))
+
+    async def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+                    limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                    start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        return await _ameasure_read('query', collection_name,
+                                    lambda: self._client.query(collection_name, filters, order_by=order_by,
+                                                               limit=limit, fields=fields, start_after=start_after))
+
+    async def get_changed_since(self, collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                                limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                                after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await _ameasure_read('get_changed_since', collection_name,
+                                    lambda: self._client.get_changed_since(collection_name, watermark, field=field,
+                                                                           limit=limit, fields=fields, after_id=after_id))
+
+    async def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        return await _ameasure_write('save', collection_name, lambda: self._client.save(collection_name, item))
+
+    async def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+                     update_time: Optional[str] = None) -> bool:
+        return await _ameasure_write('update', collection_name,
+                                     lambda: self._client.update(collection_name, doc_id, fields, update_time=update_time))
+
+    async def delete(self, collection_name: str, doc_id: str) -> bool:
+        return await _ameasure_write('delete', collection_name, lambda: self._client.delete(collection_name, doc_id))
+
+    async def commit(self, writes: List[Write]) -> bool:
+        return await _ameasure_write('commit', _commit_collection(writes), lambda: self._client.commit(writes),
+                                     docs=len(writes))
+
+    def batch(self) -> AsyncBatch:
+        return AsyncBatch(self)
@@ -0,0 +1,425 @@
+"""
+Локальное зеркало коллекций Firestore на snapshot listener'ах (только Admin SDK)
+
+FirebaseMirror подписывается через on_snapshot на коллекции из
+config.FIREBASE_MIRROR_COLLECTIONS и держит в памяти словарь id -> документ
+для каждой из них. Изменения приходят от Firestore в течение ~секунды.
+
+MirroredFirebaseClient и AsyncMirroredFirebaseClient оборачивают клиента:
+пока зеркало коллекции синхронизировано, get_all / iter_all / get_by_id /
+get_many / query выполняются по данным в памяти, иначе (и для остальных
+коллекций) запрос уходит в Firestore. Записи через обертку сразу применяются
+и к зеркалу, чтобы бот видел свои изменения, не дожидаясь события listener'а.
+Поэтому get_changed_since всегда идет в Firestore: по зеркалу лента могла бы
+сдвинуть watermark за свою запись раньше, чем пришло более раннее чужое изменение.
+
+Изменения можно получать через add_listener(коллекция, callback):
+callback(change_type, item) вызывается в потоке listener'а Firestore,
+change_type - 'ADDED' | 'MODIFIED' | 'REMOVED'.
+
+Оборвавшаяся подписка (Watch закрыт после неустранимой ошибки) или подписка,
+от которой дольше config.FIREBASE_MIRROR_MAX_SILENCE секунд нет ни снимков, ни
+ответов сервера без изменений (resume_token), считается устаревшей: чтение
+коллекции снова идет в Firestore, а FirebaseMirror.ensure_started() (периодически
+из bot.py) переподписывается. Документы прежней подписки при этом сбрасываются -
+новая начинает с полного снимка.
+"""
+import copy
+import functools
+import logging
+import threading
+import time
+from typing import List, Dict, Any, Optional, Iterator, AsyncIterator, Iterable, Callable
+from firebase_common import Batch, AsyncBatch, Write, CHANGE_FEED_FIELD, query_documents, project_document
+
+logger = logging.getLogger(__name__)
+
+ChangeListener = Callable[[str, Dict[str, Any]], None]
+
+class CollectionMirror:
+    """Копия одной коллекции в памяти, обновляемая snapshot listener'ом"""
+
+    def __init__(self, collection_name: str, max_silence: float = 0):
+        self.collection_name = collection_name
+        self.max_silence = max_silence
+        self._docs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._listeners: List[ChangeListener] = []
+        self._watch = None
+        # Номер подписки: события от уже отмененной подписки игнорируются
+        self._generation = 0
+        self._last_event = 0.0
+        self._resume_token = None
+
+    @property
+    def ready(self) -> bool:
+        """Получен ли первый снимок коллекции"""
+        return self._ready.is_set()
+
+    @property
+    def active(self) -> bool:
+        """Подписка работает (Watch закрывается при неустранимой ошибке)"""
+        watch = self._watch
+        return watch is not None and getattr(watch, 'is_active', True)
+
+    def silence(self) -> float:
+        """Сколько секунд от Firestore не было вестей"""
+        # resume_token Watch обновляется и ответами сервера без изменений - поток жив
+        token = getattr(self._watch, 'resume_token', None)
+        if token is not None and token != self._resume_token:
+            self._resume_token = token
+            self._last_event = time.monotonic()
+        return time.monotonic() - self._last_event
+
+    @property
+    def stale(self) -> bool:
+        """Подписка оборвалась или молчит дольше max_silence - данным в памяти верить нельзя"""
+        if not self.active:
+            return True
+        return self.max_silence > 0 and self.silence() > self.max_silence
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add_listener(self, callback: ChangeListener) -> None:
+        self._listeners.append(callback)
+
+    def start(self) -> None:
+        from firebase_client_admin import db
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+        self._last_event = time.monotonic()
+        self._resume_token = None
+        self._watch = db.collection(self.collection_name).on_snapshot(
+            functools.partial(self._on_snapshot, generation))
+
+    def stop(self) -> None:
+        watch, self._watch = self._watch, None
+        if watch is not None:
+            watch.unsubscribe()
+        with self._lock:
+            self._generation += 1
+            # Удаления, пропущенные без подписки, не попадут в следующий снимок - начинаем с нуля
+            self._docs.clear()
+            self._ready.clear()
+
+    def _on_snapshot(self, generation: int, col_snapshot, changes, read_time) -> None:
+        from firebase_client_admin import prepare_data_from_firestore
+        events = []
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._last_event = time.monotonic()
+            for change in changes:
+                doc = change.document
+                change_type = change.type.name
+                if change_type == 'REMOVED':
+                    item = self._docs.pop(doc.id, None) or {'id': doc.id}
+                else:
+                    item = prepare_data_from_firestore(doc.to_dict() or {})
+                    item['id'] = doc.id
+                    self._docs[doc.id] = item
+                events.append((change_type, item))
+        if not self._ready.is_set():
+            self._ready.set()
+            logger.info(f"[MIRROR] {self.collection_name}: initial snapshot with {len(self._docs)} documents")
+            # Первый снимок - это загрузка всей коллекции, а не изменения
+            return
+        for change_type, item in events:
+            for callback in self._listeners:
+                try:
+                    callback(change_type, copy.deepcopy(item))
+                except Exception as e:
+                    logger.error(f"[MIRROR] Listener error for {self.collection_name}: {e}", exc_info=True)
+
+    def apply_local_write(self, op: str, doc_id: str, data: Optional[Dict[str, Any]]) -> None:
+        """Применить запись бота к зеркалу до прихода события от Firestore"""
+        with self._lock:
+            if op == 'delete':
+                self._docs.pop(doc_id, None)
+                return
+            current = self._docs.get(doc_id)
+            if current is None:
+                if op == 'update':
+                    # update несуществующего документа не проходит
+                    return
+                current = {'id': doc_id}
+            updated = dict(current)
+            updated.update(copy.deepcopy(data))
+            self._docs[doc_id] = updated
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Текущие документы (без копирования - только для чтения внутри модуля)"""
+        with self._lock:
+            return list(self._docs.values())
+
+    def get(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._docs.get(doc_id)
+
+    def query(self, filters: List[tuple], order_by: Any = None, limit: Optional[int] = None,
+              fields: Optional[List[str]] = None, start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        return query_documents(self.snapshot(), filters, order_by=order_by, limit=limit, fields=fields,
+                               start_after=start_after)
+
+class FirebaseMirror:
+    """Набор зеркал коллекций"""
+
+    def __init__(self, collections: List[str], max_silence: float = 0):
+        self.collections: Dict[str, CollectionMirror] = {
+            name: CollectionMirror(name, max_silence=max_silence) for name in collections
+        }
+        self.started = False
+        self._restarts = 0
+
+    def start(self) -> None:
+        """Подписаться на все коллекции (первые снимки приходят асинхронно)"""
+        if self.started:
+            return
+        for name, collection in self.collections.items():
+            try:
+                collection.start()
+                logger.info(f"[MIRROR] Subscribed to {name}")
+            except Exception as e:
+                logger.error(f"[MIRROR] Error subscribing to {name}: {e}", exc_info=True)
+        self.started = True
+
+    def stop(self) -> None:
+        for collection in self.collections.values():
+            try:
+                collection.stop()
+            except Exception as e:
+                logger.error(f"[MIRROR] Error unsubscribing from {collection.collection_name}: {e}")
+        self.started = False
+
+    def ensure_started(self) -> None:
+        """Переподписаться на коллекции, подписка которых оборвалась или замолчала"""
+        if not self.started:
+            return
+        for name, collection in self.collections.items():
+            if not collection.stale:
+                continue
+            logger.warning(f"[MIRROR] {name}: listener is not active or silent for "
+                           f"{collection.silence():.0f}s, resubscribing")
+            self._restarts += 1
+            try:
+                collection.stop()
+            except Exception as e:
+                logger.error(f"[MIRROR] Error unsubscribing from {name}: {e}")
+            try:
+                collection.start()
+            except Exception as e:
+                logger.error(f"[MIRROR] Error resubscribing to {name}: {e}", exc_info=True)
+
+    def get(self, collection_name: str) -> Optional[CollectionMirror]:
+        """Зеркало коллекции, если оно синхронизировано и подписка жива, иначе None"""
+        collection = self.collections.get(collection_name)
+        if collection is not None and collection.ready and not collection.stale:
+            return collection
+        return None
+
+    def add_listener(self, collection_name: str, callback: ChangeListener) -> None:
+        self.collections[collection_name].add_listener(callback)
+
+    def apply_writes(self, writes: List[Write]) -> None:
+        for op, collection_name, doc_id, data in writes:
+            collection = self.collections.get(collection_name)
+            if collection is not None:
+                collection.apply_local_write(op, doc_id, data)
+
+    def stats(self) -> Dict[str, Any]:
+        result: Dict[str, Any] = {
+            name: {'ready': c.ready, 'stale': c.stale, 'documents': len(c), 'silence': round(c.silence(), 1)}
+            for name, c in self.collections.items()
+        }
+        result['restarts'] = self._restarts
+        return result
+
+def _save_write(collection_name: str, item: Dict[str, Any]) -> Write:
+    return ('set', collection_name, item['id'], {k: v for k, v in item.items() if k != 'id'})
+
+class MirroredFirebaseClient:
+    """Обертка над синхронным клиентом: чтение зеркалируемых коллекций из памяти"""
+
+    def __init__(self, client, mirror: FirebaseMirror):
+        self._client = client
+        self.mirror = mirror
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return self._client.get_all(collection_name, fields=fields)
+        return collection.query([], fields=fields)
+
+    def iter_all(self, collection_name: str, page_size: Optional[int] = None,
+                 fields: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is not None:
+            return iter(collection.query([], fields=fields))
+        if page_size is None:
+            return self._client.iter_all(collection_name, fields=fields)
+        return self._client.iter_all(collection_name, page_size=page_size, fields=fields)
+
+    def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return self._client.get_by_id(collection_name, doc_id, fields=fields)
+        item = collection.get(doc_id)
+        return project_document(item, fields) if item is not None else None
+
+    def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                 fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return self._client.get_many(collection_name, doc_ids, fields=fields)
+        result = {}
+        for doc_id in doc_ids:
+            item = collection.get(doc_id) if doc_id else None
+            if item is not None:
+                result[doc_id] = project_document(item, fields)
+        return result
+
+    def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+              limit: Optional[int] = None, fields: Optional[List[str]] = None,
+              start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return self._client.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                      start_after=start_after)
+        return collection.query(filters, order_by=order_by, limit=limit, fields=fields, start_after=start_after)
+
+    def get_changed_since(self, collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                          limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                          after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        # Ленте изменений нужен Firestore: свои записи бот применяет к зеркалу сразу, а чужие
+        # приходят позже через listener - watermark ушел бы вперед еще не полученных изменений
+        return self._client.get_changed_since(collection_name, watermark, field=field, limit=limit, fields=fields,
+                                              after_id=after_id)
+
+    def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        ok = self._client.save(collection_name, item)
+        if ok:
+            self.mirror.apply_writes([_save_write(collection_name, item)])
+        return ok
+
+    def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+               update_time: Optional[str] = None) -> bool:
+        ok = self._client.update(collection_name, doc_id, fields, update_time=update_time)
+        if ok:
+            self.mirror.apply_writes([('update', collection_name, doc_id, fields)])
+        return ok
+
+    def delete(self, collection_name: str, doc_id: str) -> bool:
+        ok = self._client.delete(collection_name, doc_id)
+        if ok:
+            self.mirror.apply_writes([('delete', collection_name, doc_id, None)])
+        return ok
+
+    def commit(self, writes: List[Write]) -> bool:
+        ok = self._client.commit(writes)
+        if ok:
+            self.mirror.apply_writes(writes)
+        return ok
+
+    def batch(self) -> Batch:
+        return Batch(self)
+
+class AsyncMirroredFirebaseClient:
+    """Обертка над асинхронным клиентом: чтение зеркалируемых коллекций из памяти"""
+
+    def __init__(self, client, mirror: FirebaseMirror):
+        self._client = client
+        self.mirror = mirror
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return await self._client.get_all(collection_name, fields=fields)
+        return collection.query([], fields=fields)
+
+    async def iter_all(self, collection_name: str, page_size: Optional[int] = None,
+                       fields: Optional[List[str]] = None) -> AsyncIterator[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is not None:
+            for item in collection.query([], fields=fields):
+                yield item
+            return
+        if page_size is None:
+            pages = self._client.iter_all(collection_name, fields=fields)
+        else:
+            pages = self._client.iter_all(collection_name, page_size=page_size, fields=fields)
+        async for item in pages:
+            yield item
+
+    async def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return await self._client.get_by_id(collection_name, doc_id, fields=fields)
+        item = collection.get(doc_id)
+        return project_document(item, fields) if item is not None else None
+
+    async def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                       fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return await self._client.get_many(collection_name, doc_ids, fields=fields)
+        result = {}
+        for doc_id in doc_ids:
+            item = collection.get(doc_id) if doc_id else None
+            if item is not None:
+                result[doc_id] = project_document(item, fields)
+        return result
+
+    async def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+                    limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                    start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        collection = self.mirror.get(collection_name)
+        if collection is None:
+            return await self._client.query(collection_name, filters, order_by=order_by, limit=limit, fields=fields,
+                                            start_after=start_after)
+        return collection.query(filters, order_by=order_by, limit=limit, fields=fields, start_after=start_after)
+
+    async def get_changed_since(self, collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                                limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                                after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await self._client.get_changed_since(collection_name, watermark, field=field, limit=limit, fields=fields,
+                                                    after_id=after_id)
+
+    async def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        ok = await self._client.save(collection_name, item)
+        if ok:
+            self.mirror.apply_writes([_save_write(collection_name, item)])
+        return ok
+
+    async def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+                     update_time: Optional[str] = None) -> bool:
+        ok = await self._client.update(collection_name, doc_id, fields, update_time=update_time)
+        if ok:
+            self.mirror.apply_writes([('update', collection_name, doc_id, fields)])
+        return ok
+
+    async def delete(self, collection_name: str, doc_id: str) -> bool:
+        ok = await self._client.delete(collection_name, doc_id)
+        if ok:
+            self.mirror.apply_writes([('delete', collection_name, doc_id, None)])
+        return ok
+
+    async def commit(self, writes: List[Write]) -> bool:
+        ok = await self._client.commit(writes)
+        if ok:
+            self.mirror.apply_writes(writes)
+        return ok
+
+    def batch(self) -> AsyncBatch:
+        return AsyncBatch(self)
@@ -0,0 +1,266 @@
+"""
+Объединение одновременных одинаковых запросов чтения к Firestore (single-flight)
+
+Когда несколько пользователей одновременно открывают список задач, каждый
+обработчик вызывает firebase.get_all('tasks'), и все эти запросы уходят в
+Firestore параллельно. SingleFlightFirebaseClient и AsyncSingleFlightFirebaseClient
+оборачивают клиента: пока запрос с тем же методом, коллекцией и аргументами
+(фильтры, сортировка, limit, fields) выполняется, новые вызовы не отправляют
+свой запрос, а ждут результата уже идущего. Каждый получает свою копию результата.
+
+Устаревших данных это не добавляет: результат не хранится после завершения
+запроса, а после записи в коллекцию через обертку новые вызовы не присоединяются
+к запросам, начатым до этой записи (у каждой коллекции есть счетчик записей,
+он входит в ключ запроса).
+
+Объединяются get_all, get_by_id, get_many, query и get_changed_since;
+iter_all (постраничный перебор) и записи передаются клиенту без изменений.
+"""
+import asyncio
+import copy
+import threading
+from typing import List, Dict, Any, Optional, Iterable, Callable, Awaitable, Tuple
+from firebase_common import Batch, AsyncBatch, Write, CHANGE_FEED_FIELD
+from firebase_metrics import attribute, current_caller
+
+class _Call:
+    """Выполняющийся запрос синхронного клиента"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+class _AsyncCall:
+    """Выполняющийся запрос асинхронного клиента"""
+
+    def __init__(self, task: 'asyncio.Future'):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """Реестр выполняющихся запросов (общий для sync и async клиента) и счетчики"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Tuple, _Call] = {}
+        self._tasks: Dict[Tuple, _AsyncCall] = {}
+        self._generations: Dict[str, int] = {}
+        self._requests: Dict[str, int] = {}
+        self._shared: Dict[str, int] = {}
+
+    def key(self, collection_name: str, *parts: Any) -> Tuple:
+        """Ключ запроса; включает счетчик записей коллекции"""
+        # Аргументы могут содержать списки (fields, значения in) - берем repr
+        return (collection_name, self._generations.get(collection_name, 0), repr(parts))
+
+    def written(self, collection_name: str) -> None:
+        """Запись в коллекцию завершена: следующие чтения не присоединяются к уже начатым"""
+        with self._lock:
+            self._generations[collection_name] = self._generations.get(collection_name, 0) + 1
+
+    def _count(self, collection_name: str, shared: bool) -> None:
+        self._requests[collection_name] = self._requests.get(collection_name, 0) + 1
+        if shared:
+            self._shared[collection_name] = self._shared.get(collection_name, 0) + 1
+
+    def do(self, key: Tuple, func: Callable[[], Any]) -> Any:
+        """Выполнить func или дождаться результата такого же выполняющегося запроса"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                call.waiters += 1
+            self._count(key[0], not leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            call.done.set()
+        # Ожидающие копируют call.result параллельно - вызывающему отдаем отдельную копию
+        return copy.deepcopy(call.result) if waiters else call.result
+
+    async def ado(self, key: Tuple, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Асинхронный вариант do (запросы объединяются в пределах одного event loop)"""
+        key = key + (id(asyncio.get_running_loop()),)
+        call = self._tasks.get(key)
+        leader = call is None
+        if leader:
+            # Запрос выполняется в отдельной задаче - источник для метрик передаем через контекст
+            with attribute(current_caller()):
+                call = self._tasks[key] = _AsyncCall(asyncio.ensure_future(func()))
+            # Удаляем из реестра сразу по завершении - до того, как ожидающие получат результат
+            call.task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        else:
+            call.waiters += 1
+        with self._lock:
+            self._count(key[0], not leader)
+
+        # shield: отмена одного из ожидающих не отменяет общий запрос
+        result = await asyncio.shield(call.task)
+        return copy.deepcopy(result) if not leader or call.waiters else result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'in_flight': len(self._calls) + len(self._tasks),
+                'collections': {
+                    name: {'requests': count, 'shared': self._shared.get(name, 0)}
+                    for name, count in self._requests.items()
+                },
+            }
+
+def _ids_key(doc_ids: List[Optional[str]]) -> Tuple[str, ...]:
+    return tuple(sorted({doc_id for doc_id in doc_ids if doc_id}))
+
+class SingleFlightFirebaseClient:
+    """Обертка над синхронным клиентом: одновременные одинаковые чтения - один запрос"""
+
+    def __init__(self, client, flights: SingleFlight):
+        self._client = client
+        self.flights = flights
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'all', fields)
+        return self.flights.do(key, lambda: self._client.get_all(collection_name, fields=fields))
+
+    def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'doc', doc_id, fields)
+        return self.flights.do(key, lambda: self._client.get_by_id(collection_name, doc_id, fields=fields))
+
+    def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                 fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        doc_ids = list(doc_ids)
+        key = self.flights.key(collection_name, 'many', _ids_key(doc_ids), fields)
+        return self.flights.do(key, lambda: self._client.get_many(collection_name, doc_ids, fields=fields))
+
+    def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+              limit: Optional[int] = None, fields: Optional[List[str]] = None,
+              start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'query', filters, order_by, limit, fields, start_after)
+        return self.flights.do(key, lambda: self._client.query(collection_name, filters, order_by=order_by,
+                                                               limit=limit, fields=fields, start_after=start_after))
+
+    def get_changed_since(self, collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                          limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                          after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'changed', watermark, after_id, field, limit, fields)
+        return self.flights.do(key, lambda: self._client.get_changed_since(collection_name, watermark, field=field,
+                                                                           limit=limit, fields=fields,
+                                                                           after_id=after_id))
+
+    def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        try:
+            return self._client.save(collection_name, item)
+        finally:
+            self.flights.written(collection_name)
+
+    def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+               update_time: Optional[str] = None) -> bool:
+        try:
+            return self._client.update(collection_name, doc_id, fields, update_time=update_time)
+        finally:
+            self.flights.written(collection_name)
+
+    def delete(self, collection_name: str, doc_id: str) -> bool:
+        try:
+            return self._client.delete(collection_name, doc_id)
+        finally:
+            self.flights.written(collection_name)
+
+    def commit(self, writes: List[Write]) -> bool:
+        try:
+            return self._client.commit(writes)
+        finally:
+            for collection_name in dict.fromkeys(write[1] for write in writes):
+                self.flights.written(collection_name)
+
+    def batch(self) -> Batch:
+        return Batch(self)
+
+class AsyncSingleFlightFirebaseClient:
+    """Обертка над асинхронным клиентом: одновременные одинаковые чтения - один запрос"""
+
+    def __init__(self, client, flights: SingleFlight):
+        self._client = client
+        self.flights = flights
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def get_all(self, collection_name: str, fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'all', fields)
+        return await self.flights.ado(key, lambda: self._client.get_all(collection_name, fields=fields))
+
+    async def get_by_id(self, collection_name: str, doc_id: str, fields: Optional[List[str]] = None) -> Optional[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'doc', doc_id, fields)
+        return await self.flights.ado(key, lambda: self._client.get_by_id(collection_name, doc_id, fields=fields))
+
+    async def get_many(self, collection_name: str, doc_ids: Iterable[Optional[str]],
+                       fields: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        doc_ids = list(doc_ids)
+        key = self.flights.key(collection_name, 'many', _ids_key(doc_ids), fields)
+        return await self.flights.ado(key, lambda: self._client.get_many(collection_name, doc_ids, fields=fields))
+
+    async def query(self, collection_name: str, filters: List[tuple], order_by: Any = None,
+                    limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                    start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'query', filters, order_by, limit, fields, start_after)
+        return await self.flights.ado(key, lambda: self._client.query(collection_name, filters, order_by=order_by,
+                                                                      limit=limit, fields=fields,
+                                                                      start_after=start_after))
+
+    async def get_changed_since(self, collection_name: str, watermark: Optional[str], field: str = CHANGE_FEED_FIELD,
+                                limit: Optional[int] = None, fields: Optional[List[str]] = None,
+                                after_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        key = self.flights.key(collection_name, 'changed', watermark, after_id, field, limit, fields)
+        return await self.flights.ado(key, lambda: self._client.get_changed_since(collection_name, watermark, field=field,
+                                                                                  limit=limit, fields=fields,
+                                                                                  after_id=after_id))
+
+    async def save(self, collection_name: str, item: Dict[str, Any]) -> bool:
+        try:
+            return await self._client.save(collection_name, item)
+        finally:
+            self.flights.written(collection_name)
+
+    async def update(self, collection_name: str, doc_id: str, fields: Dict[str, Any],
+                     update_time: Optional[str] = None) -> bool:
+        try:
+            return await self._client.update(collection_name, doc_id, fields, update_time=update_time)
+        finally:
+            self.flights.written(collection_name)
+
+    async def delete(self, collection_name: str, doc_id: str) -> bool:
+        try:
+            return await self._client.delete(collection_name, doc_id)
+        finally:
+            self.flights.written(collection_name)
+
+    async def commit(self, writes: List[Write]) -> bool:
+        try:
+            return await self._client.commit(writes)
+        finally:
+            for collection_name in dict.fromkeys(write[1] for write in writes):
+                self.flights.written(collection_name)
+
+    def batch(self) -> AsyncBatch:
+        return AsyncBatch(self)
@@ -0,0 +1,399 @@
+"""
+Постоянное локальное зеркало коллекций Firestore в SQLite
+
+SqliteMirror хранит документы коллекций из config.FIREBASE_SQLITE_COLLECTIONS
+в файле config.FIREBASE_SQLITE_PATH: таблица documents(collection, id, data),
+data - JSON документа. По часто фильтруемым полям (config.FIREBASE_SQLITE_INDEXED_FIELDS:
+assigneeId, endDate, status, ...) построены индексы по выражению json_extract.
+
+Синхронизация (SqliteMirror.sync, вызывается периодически в фоне):
+    - первая загрузка и раз в FIREBASE_SQLITE_FULL_SYNC_INTERVAL - полная загрузка
+      коллекции;
+    - в остальное время - только документы после курсора (updatedAt, id) последнего
+      полученного документа (get_changed_since с after_id): документы с одинаковым
+      updatedAt на границе страницы не теряются;
+    - раз в FIREBASE_SQLITE_RECONCILE_INTERVAL - сверка списка ID с Firestore:
+      удаление документа не меняет updatedAt, и лента изменений его не видит.
+
+Зеркалируются только коллекции, где updatedAt ставится при каждой записи
+(config.FIREBASE_SQLITE_COLLECTIONS): без него изменение видно только после
+полной загрузки. Строки коллекций, убранных из списка, удаляются при открытии файла.
+
+Файл переживает перезапуск: коллекция, хотя бы раз загруженная полностью, сразу
+готова к чтению, и бот стартует с данными, а не с пустым кэшем. Чтение идет из
+SQLite и тогда, когда Firestore медленный или недоступен.
+
+Для чтения используется та же обертка, что и для зеркала в памяти
+(firebase_mirror.MirroredFirebaseClient): SqliteMirror.get(коллекция) возвращает
+объект с тем же интерфейсом, что и CollectionMirror. Фильтры query, которые
+можно выразить в SQL (==, in, array-contains, сравнения), сужают выборку по
+индексам, окончательная проверка и сортировка - query_documents с семантикой Firestore.
+"""
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+from firebase_common import Write, CHANGE_FEED_FIELD, query_documents
+from firebase_mirror import MirroredFirebaseClient, AsyncMirroredFirebaseClient
+from firestore_codec import loads
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sync_state (
+    collection TEXT PRIMARY KEY,
+    watermark TEXT,
+    full_sync_at REAL NOT NULL,
+    watermark_id TEXT
+);
+"""
+
+# Курсор синхронизации: (updatedAt, id) последнего полученного документа
+Cursor = Tuple[Optional[str], Optional[str]]
+
+# Документов за один запрос инкрементальной синхронизации
+SQLITE_SYNC_PAGE_SIZE = 500
+
+# Если полная загрузка вернула меньше этой доли локальных документов, считаем ее
+# неполной (ошибка посреди постраничной загрузки) и не удаляем отсутствующие документы
+FULL_SYNC_MIN_RATIO = 0.5
+
+# Поля, путь к которым можно подставить в json_extract без экранирования
+SQL_FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$')
+
+_RANGE_OPS = ('<', '<=', '>', '>=')
+
+def _json_path(field: str) -> Optional[str]:
+    if not SQL_FIELD_NAME.match(field):
+        return None
+    return f"$.{field}"
+
+def _field_expr(field: str) -> Optional[str]:
+    """SQL выражение значения поля (текст должен совпадать с выражением индекса)"""
+    path = _json_path(field)
+    return f"json_extract(data, '{path}')" if path else None
+
+def _is_sql_scalar(value: Any) -> bool:
+    return isinstance(value, (str, int, float))
+
+def _where(filters: List[tuple]) -> Tuple[str, List[Any]]:
+    """
+    Условия SQL для предварительного отбора по фильтрам query
+
+    Отбирается надмножество результата; фильтры, которые нельзя выразить
+    в SQL, пропускаются и проверяются потом в query_documents.
+    """
+    clauses: List[str] = []
+    params: List[Any] = []
+    for field, op, value in filters:
+        expr = _field_expr(field)
+        if expr is None:
+            continue
+        if op == '==' and _is_sql_scalar(value):
+            clauses.append(f"{expr} = ?")
+            params.append(value)
+        elif op == 'in' and value and all(_is_sql_scalar(v) for v in value):
+            clauses.append(f"{expr} IN ({', '.join('?' * len(value))})")
+            params.extend(value)
+        elif op == 'array-contains' and _is_sql_scalar(value):
+            clauses.append(f"EXISTS (SELECT 1 FROM json_each(data, '{_json_path(field)}') WHERE json_each.value = ?)")
+            params.append(value)
+        elif op in _RANGE_OPS and _is_sql_scalar(value) and not isinstance(value, bool):
+            # В SQLite число < строка, как и в порядке типов Firestore
+            clauses.append(f"{expr} {op} ?")
+            params.append(value)
+    return ''.join(f" AND {clause}" for clause in clauses), params
+
+def _dumps(item: Dict[str, Any]) -> str:
+    # default=str - на случай типов Admin SDK без JSON представления (GeoPoint, DocumentReference)
+    return json.dumps(item, ensure_ascii=False, default=str)
+
+class SqliteCollection:
+    """Коллекция в SQLite зеркале (интерфейс как у firebase_mirror.CollectionMirror)"""
+
+    def __init__(self, store: 'SqliteMirror', collection_name: str):
+        self._store = store
+        self.collection_name = collection_name
+
+    @property
+    def ready(self) -> bool:
+        return self._store.is_synced(self.collection_name)
+
+    def __len__(self) -> int:
+        return self._store.count(self.collection_name)
+
+    def get(self, doc_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._store.select(self.collection_name, " AND id = ?", [doc_id])
+        return rows[0] if rows else None
+
+    def query(self, filters: List[tuple], order_by: Any = None, limit: Optional[int] = None,
+              fields: Optional[List[str]] = None, start_after: Optional[list] = None) -> List[Dict[str, Any]]:
+        where, params = _where(filters)
+        items = self._store.select(self.collection_name, where, params)
+        return query_documents(items, filters, order_by=order_by, limit=limit, fields=fields,
+                               start_after=start_after)
+
+class SqliteMirror:
+    """
+    Зеркало коллекций в файле SQLite
+
+    Args:
+        path: Путь к файлу базы
+        collections: Зеркалируемые коллекции
+        client: Синхронный клиент Firestore без оберток (источник данных для sync)
+        indexed_fields: Поля, по которым строятся индексы json_extract
+        full_sync_interval: Период полной пересинхронизации коллекции (секунды)
+        reconcile_interval: Период сверки ID с Firestore для удаленных документов (секунды)
+    """
+
+    def __init__(self, path: str, collections: List[str], client, indexed_fields: Iterable[str] = (),
+                 full_sync_interval: float = 3600, reconcile_interval: float = 300):
+        self.path = path
+        self.collections: Dict[str, SqliteCollection] = {name: SqliteCollection(self, name) for name in collections}
+        self._client = client
+        self.full_sync_interval = full_sync_interval
+        self.reconcile_interval = reconcile_interval
+        # Время последней сверки ID (после перезапуска сверка выполняется сразу)
+        self._reconciled_at: Dict[str, float] = {}
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(sync_state)')}
+            if 'watermark_id' not in columns:
+                # Файл прежней версии: курсор без id, первая синхронизация идет по updatedAt > watermark
+                self._conn.execute('ALTER TABLE sync_state ADD COLUMN watermark_id TEXT')
+            # Коллекции, убранные из списка, больше не синхронизируются - их данные устарели бы
+            placeholders = ', '.join('?' * len(self.collections))
+            for table in ('documents', 'sync_state'):
+                self._conn.execute(f'DELETE FROM {table} WHERE collection NOT IN ({placeholders})',
+                                   list(self.collections))
+            for field in indexed_fields:
+                expr = _field_expr(field)
+                if expr is None:
+                    logger.warning(f"[SQLITE] Cannot index field {field!r}")
+                    continue
+                self._conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_documents_{field.replace('.', '_')} ON documents(collection, {expr})"
+                )
+        # Коллекции, загруженные полностью хотя бы раз (в том числе до перезапуска)
+        self._synced = {row[0] for row in self._conn.execute('SELECT collection FROM sync_state')}
+        if self._synced:
+            logger.info(f"[SQLITE] Warm start from {path}: {', '.join(sorted(self._synced))}")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    # ------------------------------------------------------------------
+    # Чтение
+    # ------------------------------------------------------------------
+
+    def is_synced(self, collection_name: str) -> bool:
+        return collection_name in self._synced
+
+    def get(self, collection_name: str) -> Optional[SqliteCollection]:
+        """Коллекция, если она загружена, иначе None (интерфейс как у FirebaseMirror.get)"""
+        if collection_name in self._synced:
+            return self.collections.get(collection_name)
+        return None
+
+    def select(self, collection_name: str, where: str = '', params: Optional[List[Any]] = None) -> List[Dict[str, Any]]:
+        """Документы коллекции, удовлетворяющие условию SQL where ("AND ..." по столбцу data)"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT data FROM documents WHERE collection = ?{where}", [collection_name] + list(params or [])
+            ).fetchall()
+        return [loads(row[0]) for row in rows]
+
+    def count(self, collection_name: str) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM documents WHERE collection = ?',
+                                      (collection_name,)).fetchone()[0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT collection, COUNT(*) FROM documents GROUP BY collection'))
+            states = {row[0]: row[1:] for row in self._conn.execute(
+                'SELECT collection, watermark, watermark_id, full_sync_at FROM sync_state')}
+        result = {}
+        for name in self.collections:
+            watermark, watermark_id, full_sync_at = states.get(name, (None, None, None))
+            result[name] = {
+                'ready': name in self._synced,
+                'documents': counts.get(name, 0),
+                'watermark': watermark,
+                'watermark_id': watermark_id,
+                'full_sync_at': full_sync_at,
+                'reconciled_at': self._reconciled_at.get(name),
+            }
+        return result
+
+    # ------------------------------------------------------------------
+    # Записи бота
+    # ------------------------------------------------------------------
+
+    def apply_writes(self, writes: List[Write]) -> None:
+        """Применить записи бота, чтобы он видел свои изменения до следующей синхронизации"""
+        with self._lock, self._conn:
+            for op, collection_name, doc_id, data in writes:
+                if collection_name not in self._synced:
+                    continue
+                if op == 'delete':
+                    self._conn.execute('DELETE FROM documents WHERE collection = ? AND id = ?', (collection_name, doc_id))
+                    continue
+                row = self._conn.execute('SELECT data FROM documents WHERE collection = ? AND id = ?',
+                                         (collection_name, doc_id)).fetchone()
+                if row is None:
+                    if op == 'update':
+                        # update несуществующего документа не проходит
+                        continue
+                    current = {'id': doc_id}
+                else:
+                    current = loads(row[0])
+                current.update(data)
+                self._upsert(collection_name, [current])
+
+    # ------------------------------------------------------------------
+    # Синхронизация с Firestore
+    # ------------------------------------------------------------------
+
+    def _upsert(self, collection_name: str, items: List[Dict[str, Any]]) -> None:
+        self._conn.executemany(
+            'INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)',
+            [(collection_name, item['id'], _dumps(item)) for item in items]
+        )
+
+    def _save_state(self, collection_name: str, cursor: Cursor, full_sync_at: float) -> None:
+        self._conn.execute(
+            'INSERT OR REPLACE INTO sync_state (collection, watermark, watermark_id, full_sync_at) VALUES (?, ?, ?, ?)',
+            (collection_name, cursor[0], cursor[1], full_sync_at)
+        )
+
+    def _state(self, collection_name: str) -> Optional[Tuple[Cursor, float]]:
+        with self._lock:
+            row = self._conn.execute('SELECT watermark, watermark_id, full_sync_at FROM sync_state WHERE collection = ?',
+                                     (collection_name,)).fetchone()
+        return ((row[0], row[1]), row[2]) if row else None
+
+    @staticmethod
+    def _max_cursor(items: List[Dict[str, Any]], cursor: Cursor) -> Cursor:
+        """Наибольший (updatedAt, id) среди документов и текущего курсора"""
+        for item in items:
+            value = item.get(CHANGE_FEED_FIELD)
+            if isinstance(value, str) and (cursor[0] is None or (value, item['id']) > (cursor[0], cursor[1] or '')):
+                cursor = (value, item['id'])
+        return cursor
+
+    def _full_sync(self, collection_name: str, state: Optional[Tuple[Cursor, float]]) -> None:
+        started = time.time()
+        # Загрузка из сети - без блокировки базы, читатели продолжают работать
+        items = list(self._client.iter_all(collection_name))
+        local_count = self.count(collection_name)
+        if not items and local_count:
+            logger.warning(f"[SQLITE] {collection_name}: full sync returned no documents, keeping {local_count} local")
+            return
+        cursor = self._max_cursor(items, state[0] if state else (None, None))
+        with self._lock, self._conn:
+            if len(items) >= local_count * FULL_SYNC_MIN_RATIO:
+                self._conn.execute('DELETE FROM documents WHERE collection = ?', (collection_name,))
+            else:
+                logger.warning(f"[SQLITE] {collection_name}: full sync returned {len(items)} of {local_count} "
+                               f"local documents, deletions are not applied")
+            self._upsert(collection_name, items)
+            self._save_state(collection_name, cursor, started)
+            self._synced.add(collection_name)
+        self._reconciled_at[collection_name] = started
+        with self._lock:
+            # Без статистики планировщик выбирает первичный ключ вместо индексов json_extract
+            self._conn.execute('ANALYZE')
+        logger.info(f"[SQLITE] {collection_name}: full sync, {len(items)} documents in {time.time() - started:.1f}s")
+
+    def _incremental_sync(self, collection_name: str, state: Tuple[Cursor, float]) -> int:
+        cursor, full_sync_at = state
+        if cursor[0] is None:
+            # В коллекции нет updatedAt - обновляется только полной синхронизацией
+            return 0
+        changed = 0
+        while True:
+            # Страница упорядочена по (updatedAt, id): следующая начинается строго после
+            # последнего документа, даже если у соседних документов одинаковый updatedAt
+            page = self._client.get_changed_since(collection_name, cursor[0], after_id=cursor[1],
+                                                  limit=SQLITE_SYNC_PAGE_SIZE)
+            if not page:
+                break
+            cursor = self._max_cursor(page, cursor)
+            with self._lock, self._conn:
+                self._upsert(collection_name, page)
+                self._save_state(collection_name, cursor, full_sync_at)
+            changed += len(page)
+            if len(page) < SQLITE_SYNC_PAGE_SIZE:
+                break
+        return changed
+
+    def _reconcile(self, collection_name: str) -> int:
+        """Удалить документы, которых больше нет в Firestore; возвращает число удаленных"""
+        started = time.time()
+        with self._lock:
+            # Только документы, известные до запроса: созданные во время сверки не удаляются
+            local_ids = {row[0] for row in self._conn.execute('SELECT id FROM documents WHERE collection = ?',
+                                                              (collection_name,))}
+        # Только поле курсора - список ID без содержимого документов
+        remote_ids = {item['id'] for item in self._client.iter_all(collection_name, fields=[CHANGE_FEED_FIELD])}
+        if len(remote_ids) < len(local_ids) * FULL_SYNC_MIN_RATIO:
+            logger.warning(f"[SQLITE] {collection_name}: reconcile returned {len(remote_ids)} of {len(local_ids)} "
+                           f"local documents, deletions are not applied")
+            return 0
+        deleted = local_ids - remote_ids
+        if deleted:
+            with self._lock, self._conn:
+                self._conn.executemany('DELETE FROM documents WHERE collection = ? AND id = ?',
+                                       [(collection_name, doc_id) for doc_id in deleted])
+            logger.info(f"[SQLITE] {collection_name}: removed {len(deleted)} deleted documents")
+        self._reconciled_at[collection_name] = started
+        return len(deleted)
+
+    def sync(self) -> None:
+        """Синхронизировать все коллекции (блокирующий вызов, выполнять вне event loop)"""
+        if not self._sync_lock.acquire(blocking=False):
+            # Предыдущая синхронизация еще идет
+            return
+        try:
+            for collection_name in self.collections:
+                try:
+                    state = self._state(collection_name)
+                    if state is None or time.time() - state[1] >= self.full_sync_interval:
+                        self._full_sync(collection_name, state)
+                    else:
+                        changed = self._incremental_sync(collection_name, state)
+                        if changed:
+                            logger.debug(f"[SQLITE] {collection_name}: {changed} changed documents")
+                        if time.time() - self._reconciled_at.get(collection_name, 0) >= self.reconcile_interval:
+                            self._reconcile(collection_name)
+                except Exception as e:
+                    logger.error(f"[SQLITE] Error syncing {collection_name}: {e}", exc_info=True)
+        finally:
+            self._sync_lock.release()
+
+class SqliteMirroredFirebaseClient(MirroredFirebaseClient):
+    """
+    Обертка над синхронным клиентом: чтение коллекций SQLite зеркала из файла
+
+    get_changed_since, как и в базовой обертке, идет в Firestore: SQLite отстает на
+    период синхронизации, а свои записи бот применяет к нему сразу.
+    """
+
+class AsyncSqliteMirroredFirebaseClient(AsyncMirroredFirebaseClient):
+    """Обертка над асинхронным клиентом: чтение коллекций SQLite зеркала из файла"""
@@ -0,0 +1,166 @@
+"""
+Преобразование значений Firestore <-> Python
+
+decode_value / decode_fields - значения Firestore REST API ({'stringValue': ...}) в Python
+encode_value / encode_fields - обратно, для записи через REST API
+normalize_sdk_value / normalize_sdk_fields - значения Admin SDK (Timestamp -> ISO строка)
+loads - разбор JSON ответа (через orjson, если он установлен)
+
+Кодирование и Admin SDK используют таблицы обработчиков по type(value); для
+Admin SDK проверка, является ли тип Timestamp, выполняется один раз на тип,
+а не на каждое поле. Результат совпадает с прежними функциями клиентов.
+Декодирование REST осталось цепочкой if: она уже начинается с самого частого
+stringValue, и таблица обработчиков выигрыша не дает.
+Сравнение со старой реализацией: benchmarks/bench_firestore_codec.py
+"""
+import json
+from typing import Any, Callable, Dict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ---------------------------------------------------------------------------
+# REST API -> Python
+# ---------------------------------------------------------------------------
+
+def decode_value(value: Any) -> Any:
+    """Конвертировать значение из формата Firestore REST API в обычный Python тип"""
+    if isinstance(value, dict):
+        if 'stringValue' in value:
+            return value['stringValue']
+        elif 'integerValue' in value:
+            return int(value['integerValue'])
+        elif 'doubleValue' in value:
+            return float(value['doubleValue'])
+        elif 'booleanValue' in value:
+            return value['booleanValue']
+        elif 'timestampValue' in value:
+            return value['timestampValue']
+        elif 'arrayValue' in value:
+            return [decode_value(v) for v in value['arrayValue'].get('values', [])]
+        elif 'mapValue' in value:
+            return decode_fields(value['mapValue'].get('fields', {}))
+        elif 'nullValue' in value:
+            return None
+    # Неизвестные типы (referenceValue, geoPointValue, ...) возвращаются как есть
+    return value
+
+def decode_fields(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Поля документа REST API -> словарь Python"""
+    return {k: decode_value(v) for k, v in fields.items()}
+
+# ---------------------------------------------------------------------------
+# Python -> REST API
+# ---------------------------------------------------------------------------
+
+def _encode_list(value: list) -> Dict[str, Any]:
+    return {'arrayValue': {'values': [encode_value(v) for v in value]}}
+
+def _encode_dict(value: dict) -> Dict[str, Any]:
+    return {'mapValue': {'fields': encode_fields(value)}}
+
+# Точный тип значения -> функция кодирования (bool проверяется раньше int за счет точного типа)
+_ENCODERS: Dict[type, Callable[[Any], Dict[str, Any]]] = {
+    type(None): lambda value: {'nullValue': None},
+    bool: lambda value: {'booleanValue': value},
+    int: lambda value: {'integerValue': str(value)},
+    float: lambda value: {'doubleValue': value},
+    str: lambda value: {'stringValue': value},
+    list: _encode_list,
+    dict: _encode_dict,
+}
+
+def _encode_subclass(value: Any) -> Dict[str, Any]:
+    """Подклассы базовых типов (IntEnum, OrderedDict, ...) и прочие значения"""
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    elif isinstance(value, int):
+        return {'integerValue': str(value)}
+    elif isinstance(value, float):
+        return {'doubleValue': value}
+    elif isinstance(value, str):
+        return {'stringValue': value}
+    elif isinstance(value, list):
+        return _encode_list(value)
+    elif isinstance(value, dict):
+        return _encode_dict(value)
+    return {'stringValue': str(value)}
+
+def encode_value(value: Any) -> Dict[str, Any]:
+    """Конвертировать значение в формат Firestore REST API"""
+    return _ENCODERS.get(type(value), _encode_subclass)(value)
+
+def encode_fields(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Словарь Python -> поля документа REST API"""
+    return {k: encode_value(v) for k, v in data.items()}
+
+# ---------------------------------------------------------------------------
+# Admin SDK -> Python
+# ---------------------------------------------------------------------------
+
+def _timestamp_to_str(value: Any) -> str:
+    try:
+        return value.isoformat()
+    except Exception:
+        # Если isoformat не работает, конвертируем в строку
+        return str(value)
+
+def _identity(value: Any) -> Any:
+    return value
+
+def _normalize_list(value: list) -> list:
+    # Как прежде: в массивах преобразуются только вложенные словари
+    return [normalize_sdk_fields(v) if isinstance(v, dict) else v for v in value]
+
+# Типы, которые возвращаются без изменений
+_SDK_PASSTHROUGH = (str, int, float, bool, type(None), bytes)
+_SDK_PLAIN_TYPES = frozenset(_SDK_PASSTHROUGH)
+
+# type(value) -> функция преобразования; заполняется при первой встрече типа
+_SDK_CONVERTERS: Dict[type, Callable[[Any], Any]] = {t: _identity for t in _SDK_PASSTHROUGH}
+
+def _classify_sdk_type(value: Any) -> Callable[[Any], Any]:
+    """Выбрать преобразование для нового типа (проверки выполняются один раз на тип)"""
+    if (hasattr(value, 'seconds') and hasattr(value, 'nanoseconds')) or \
+       (hasattr(value, 'isoformat') and 'Timestamp' in str(type(value))):
+        # Timestamp Firestore
+        return _timestamp_to_str
+    if isinstance(value, dict):
+        return normalize_sdk_fields
+    if isinstance(value, list):
+        return _normalize_list
+    return _identity
+
+def normalize_sdk_value(value: Any) -> Any:
+    """Значение из Admin SDK -> значение для бота (Timestamp -> ISO строка)"""
+    converter = _SDK_CONVERTERS.get(type(value))
+    if converter is None:
+        converter = _classify_sdk_type(value)
+        _SDK_CONVERTERS[type(value)] = converter
+    return converter(value)
+
+def normalize_sdk_fields(doc_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Словарь документа Admin SDK -> словарь для бота"""
+    result = {}
+    for key, value in doc_data.items():
+        # Большинство полей - строки/числа/bool, их копируем без вызова преобразования
+        if type(value) in _SDK_PLAIN_TYPES:
+            result[key] = value
+        else:
+            result[key] = normalize_sdk_value(value)
+    return result
+
+_SDK_CONVERTERS[dict] = normalize_sdk_fields
+_SDK_CONVERTERS[list] = _normalize_list
+
+# ---------------------------------------------------------------------------
+# JSON
+# ---------------------------------------------------------------------------
+
+def loads(data: bytes) -> Any:
+    """Разобрать JSON (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
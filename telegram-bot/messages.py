@@ -362,3 +362,92 @@ def format_document_message(document: Dict[str, Any], users: List[Dict[str, Any]
                 message += "..."
     
     return message
+
+def _format_bytes(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size / 1024 / 1024:.1f} МБ"
+    if size >= 1024:
+        return f"{size / 1024:.0f} КБ"
+    return f"{size} Б"
+
+def format_firestore_stats(snapshot: Dict[str, Any], top: int = 10) -> str:
+    """Форматировать метрики Firestore (firebase_metrics.metrics.snapshot()) для команды /stats"""
+    since = datetime.fromtimestamp(snapshot['since']).strftime('%d.%m.%Y %H:%M')
+    operations = snapshot.get('operations', [])
+    total_docs = sum(op['docs'] for op in operations if op['op'] not in ('save', 'update', 'delete', 'commit'))
+    total_calls = sum(op['calls'] for op in operations)
+
+    message = f"📊 <b>Firestore с {since}</b>\n"
+    message += f"Запросов: {total_calls}, прочитано документов: {total_docs}\n\n"
+
+    message += "<b>Операции</b> (документы, вызовы, p50/p95/p99 мс):\n"
+    for op in operations[:top]:
+        message += (f"• {op['op']} {op['collection']}: {op['docs']} док., {op['calls']} выз., "
+                    f"{op['p50'] * 1000:.0f}/{op['p95'] * 1000:.0f}/{op['p99'] * 1000:.0f}")
+        if op['bytes']:
+            message += f", {_format_bytes(op['bytes'])}"
+        if op['errors']:
+            message += f", ошибок: {op['errors']}"
+        message += "\n"
+
+    message += "\n<b>Источники</b> (документы, вызовы):\n"
+    for caller in snapshot.get('callers', [])[:top]:
+        message += f"• {caller['caller']} → {caller['collection']}: {caller['docs']} док., {caller['calls']} выз.\n"
+
+    sources = snapshot.get('sources', {})
+    cache = sources.get('cache')
+    if cache and cache.get('collections'):
+        hits = sum(c['hits'] for c in cache['collections'].values())
+        misses = sum(c['misses'] for c in cache['collections'].values())
+        message += f"\n<b>Кэш:</b> попаданий {hits}, промахов {misses}\n"
+    flights = sources.get('single_flight')
+    if flights and flights.get('collections'):
+        shared = sum(c['shared'] for c in flights['collections'].values())
+        message += f"<b>Single-flight:</b> объединено запросов {shared}\n"
+    executor = sources.get('executor')
+    if executor:
+        message += (f"<b>Пул потоков:</b> {executor['running']}/{executor['workers']} заняты, "
+                    f"в очереди {executor['queued']} (макс. {executor['max_queued']}), "
+                    f"ожидание p95 {executor['wait_time']['p95'] * 1000:.0f} мс\n")
+    dispatcher = sources.get('dispatcher')
+    if dispatcher:
+        message += (f"<b>Отправка уведомлений:</b> отправлено {dispatcher['sent']} "
+                    f"({dispatcher['messages']} сообщений), ошибок {dispatcher['failed']}, "
+                    f"RetryAfter {dispatcher['pauses']}\n")
+    return message
+
+def _format_age(seconds: float) -> str:
+    if seconds >= 3600:
+        return f"{seconds / 3600:.1f} ч"
+    if seconds >= 60:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds:.0f} с"
+
+def format_queue_stats(snapshot: Dict[str, Any]) -> str:
+    """Форматировать метрики очереди уведомлений (notification_metrics.queue_metrics.snapshot()) для команды /queue"""
+    message = "📬 <b>Очередь уведомлений</b>\n\n"
+    backlog = snapshot.get('backlog')
+    if backlog:
+        pending = f"{backlog['pending']}+" if backlog.get('capped') else str(backlog['pending'])
+        message += (f"Ожидают отправки: {pending} (ждут повтора {backlog['waiting_retry']}, "
+                    f"захвачены {backlog['leased']})\n")
+        message += f"Самое старое: {_format_age(backlog['oldest_age'])}\n"
+    else:
+        message += "Ожидают отправки: нет данных\n"
+
+    latency = snapshot['delivery_latency']
+    message += (f"\nОтправлено: {snapshot['sent']}, сейчас {snapshot['sends_per_second']:.2f}/с\n"
+                f"Задержка доставки p50/p95/p99: {_format_age(latency['p50'])} / "
+                f"{_format_age(latency['p95'])} / {_format_age(latency['p99'])}\n")
+
+    message += (f"\nЗахвачено: {snapshot['claimed']}, конфликтов захвата: {snapshot['claim_conflicts']}\n"
+                f"Повторов запланировано: {snapshot['retries']}\n")
+    dead_letters = snapshot.get('dead_letters') or {}
+    if dead_letters:
+        message += "В notificationDeadLetter: " + ", ".join(f"{reason} {count}" for reason, count in sorted(dead_letters.items())) + "\n"
+    failures = snapshot.get('failures') or {}
+    if failures:
+        message += "\n<b>Ошибки отправки:</b>\n"
+        for name, count in sorted(failures.items(), key=lambda item: -item[1]):
+            message += f"• {name}: {count}\n"
+    return message
@@ -0,0 +1,359 @@
+"""
+Отправка уведомлений из очереди с учетом лимитов Telegram
+
+Раньше periodic_check отправлял уведомления по одному: пачка из 20 сообщений -
+20 последовательных запросов к Telegram, а большие пачки упирались во flood limit.
+NotificationDispatcher отправляет уведомления параллельно, но:
+
+- сообщения в один чат уходят по очереди, в порядке очереди уведомлений;
+- общая скорость не выше config.NOTIFICATION_GLOBAL_RATE сообщений в секунду
+  (Telegram допускает около 30);
+- в один чат - не чаще раза в config.NOTIFICATION_CHAT_INTERVAL секунд, в группу
+  (отрицательный chat_id) - раза в config.NOTIFICATION_GROUP_INTERVAL секунд
+  (Telegram допускает около 20 сообщений в минуту в группу);
+- одновременно выполняется не больше config.NOTIFICATION_DISPATCH_CONCURRENCY запросов;
+- при RetryAfter (429) отправка во все чаты приостанавливается на указанное
+  Telegram время, после чего сообщение отправляется повторно;
+- сообщения не отправляются после deadline (конец аренды захваченных уведомлений
+  минус config.NOTIFICATION_LEASE_MARGIN): иначе истекшую аренду захватит другой
+  обработчик и отправит то же уведомление;
+- несколько уведомлений в один чат, созданных в пределах
+  config.NOTIFICATION_DIGEST_WINDOW секунд (массовые изменения в веб-приложении),
+  отправляются одним сообщением-сводкой; сводка делится на сообщения не длиннее
+  4096 символов (лимит Telegram) только между уведомлениями; если Telegram отклонил
+  сводку (BadRequest), ее уведомления отправляются по одному;
+- если в чат уже отправлялось сообщение в последние config.NOTIFICATION_DIGEST_WINDOW
+  секунд (идет серия изменений), последняя сводка чата не отправляется, пока не пройдет
+  окно от ее первого уведомления (DigestHeld): за это время в нее попадут остальные
+  уведомления серии. Первое уведомление серии уходит сразу.
+
+Результат dispatch - список (уведомление, ошибка или None) для каждого уведомления,
+в том числе вошедшего в сводку; отметки об отправке записывает вызывающий код. is_permanent_error отличает ошибки, при которых повтор
+не поможет (бот заблокирован, чат не найден), от временных (сеть, RetryAfter, ошибка в тексте).
+DeadlineExceeded и DigestHeld - отправка не начиналась, уведомление нужно освободить
+(для DigestHeld - до DigestHeld.until), а не считать ошибкой.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter
+import config
+from notification_metrics import queue_metrics
+from utils import parse_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Результат отправки: уведомление и исключение (None - отправлено)
+DispatchResult = Tuple[Dict[str, Any], Optional[Exception]]
+
+# Очищать устаревшие записи per-chat лимитов, когда их становится больше
+RATE_LIMITER_MAX_CHATS = 1000
+
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+DIGEST_SEPARATOR = '\n\n'
+
+class DeadlineExceeded(Exception):
+    """Уведомление не отправлялось: до конца аренды не осталось времени"""
+
+class DigestHeld(Exception):
+    """Уведомление отложено до until (time.time()): сводка чата ждет остальные уведомления серии"""
+
+    def __init__(self, until: float):
+        super().__init__(f"Held for digest until {until:.0f}")
+        self.until = until
+
+def is_group_chat(chat_id: Any) -> bool:
+    """Группы, супергруппы и каналы в Telegram имеют отрицательный chat_id"""
+    return str(chat_id).startswith('-')
+
+# BadRequest с такими текстами относится к чату, а не к сообщению: повтор не поможет
+PERMANENT_BAD_REQUEST_MARKERS = (
+    'chat not found',
+    'user not found',
+    'peer_id_invalid',
+    'chat_write_forbidden',
+    'group chat was deactivated',
+    'user is deactivated',
+    'not enough rights to send',
+    'have no rights to send',
+)
+
+def is_permanent_error(error: Exception) -> bool:
+    """
+    Повторная отправка не поможет: бот заблокирован или исключен из чата (Forbidden),
+    чат не найден или закрыт для бота (BadRequest из PERMANENT_BAD_REQUEST_MARKERS),
+    группа стала супергруппой (ChatMigrated), в уведомлении нет chatId или текста (ValueError)
+
+    Остальные BadRequest (например, некорректный HTML в сообщении) считаются временными:
+    уведомление повторяется до NOTIFICATION_MAX_ATTEMPTS попыток.
+    """
+    if isinstance(error, (Forbidden, ChatMigrated, ValueError)):
+        return True
+    if isinstance(error, BadRequest):
+        message = str(error).lower()
+        return any(marker in message for marker in PERMANENT_BAD_REQUEST_MARKERS)
+    return False
+
+def _created_at(notification: Dict[str, Any]) -> Optional[float]:
+    """createdAt уведомления в секундах (ISO строка веб-приложения или бота)"""
+    return parse_timestamp(notification.get('createdAt'))
+
+def _digest_header(count: int) -> str:
+    return f"📬 <b>Уведомления ({count})</b>{DIGEST_SEPARATOR}"
+
+def _digest_length(notifications: List[Dict[str, Any]]) -> int:
+    return (len(_digest_header(len(notifications)))
+            + sum(len(n['message']) for n in notifications)
+            + len(DIGEST_SEPARATOR) * (len(notifications) - 1))
+
+def build_digests(notifications: List[Dict[str, Any]], window: float,
+                  max_length: int = TELEGRAM_MESSAGE_LIMIT) -> List[List[Dict[str, Any]]]:
+    """
+    Разбить уведомления одного чата на сообщения
+
+    В одно сообщение попадают подряд идущие уведомления, созданные не позже
+    window секунд после первого из них, пока сводка не длиннее max_length.
+    Уведомление без createdAt или слишком длинное для сводки отправляется отдельно.
+    """
+    digests: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    first_at: Optional[float] = None
+    for notification in notifications:
+        created_at = _created_at(notification)
+        if (current and window > 0 and created_at is not None and first_at is not None
+                and created_at - first_at <= window
+                and _digest_length(current + [notification]) <= max_length):
+            current.append(notification)
+            continue
+        if current:
+            digests.append(current)
+        current, first_at = [notification], created_at
+    if current:
+        digests.append(current)
+    return digests
+
+def format_digest(notifications: List[Dict[str, Any]]) -> str:
+    """Текст сообщения: одно уведомление - как есть, несколько - сводка с заголовком"""
+    if len(notifications) == 1:
+        return notifications[0]['message']
+    return _digest_header(len(notifications)) + DIGEST_SEPARATOR.join(n['message'] for n in notifications)
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    # В python-telegram-bot 20.x retry_after - секунды, в новых версиях - timedelta
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+class RateLimiter:
+    """
+    Общий лимит скорости и минимальный интервал между сообщениями в один чат
+
+    Каждое сообщение получает время отправки (слот) не раньше следующего свободного
+    общего слота и следующего свободного слота своего чата. Работает в одном event loop.
+    """
+
+    def __init__(self, global_rate: float, chat_interval: float, group_interval: float):
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self._next_global = 0.0
+        self._next_chat: Dict[str, float] = {}
+        self._paused_until = 0.0
+        self._waited = 0.0
+        self._pauses = 0
+
+    def _reserve(self, chat_id: str) -> float:
+        """Занять ближайший слот для чата; возвращает задержку до него"""
+        now = time.monotonic()
+        if len(self._next_chat) > RATE_LIMITER_MAX_CHATS:
+            self._next_chat = {chat: at for chat, at in self._next_chat.items() if at > now}
+        start = max(now, self._next_global, self._next_chat.get(chat_id, 0.0), self._paused_until)
+        interval = self.group_interval if is_group_chat(chat_id) else self.chat_interval
+        self._next_global = start + self.global_interval
+        self._next_chat[chat_id] = start + interval
+        return start - now
+
+    async def acquire(self, chat_id: str) -> None:
+        """Дождаться слота для отправки сообщения в чат"""
+        while True:
+            delay = self._reserve(chat_id)
+            if delay > 0:
+                self._waited += delay
+                await asyncio.sleep(delay)
+            # Пока ждали, Telegram мог вернуть RetryAfter - занимаем слот после паузы
+            if time.monotonic() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float) -> None:
+        """Приостановить все отправки на seconds секунд (ответ RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._pauses += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'chats': len(self._next_chat),
+            'waited': round(self._waited, 3),
+            'pauses': self._pauses,
+            'paused_for': round(max(0.0, self._paused_until - time.monotonic()), 3),
+        }
+
+class NotificationDispatcher:
+    """Параллельная отправка уведомлений с сохранением порядка внутри чата"""
+
+    def __init__(self, limiter: RateLimiter, concurrency: int = 8, max_retries: int = 3,
+                 digest_window: float = 0):
+        self.limiter = limiter
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.digest_window = digest_window
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._messages = 0
+        self._deferred = 0
+        self._split = 0
+        self._held = 0
+        # Время (time.time()) последнего сообщения в чат - по нему видно, что идет серия
+        self._last_message: Dict[str, float] = {}
+
+    async def _send(self, bot, semaphore: asyncio.Semaphore, chat_id: Any, text: str,
+                    deadline: Optional[float]) -> None:
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(str(chat_id))
+            try:
+                async with semaphore:
+                    # Ожидание слота, паузы RetryAfter или свободного запроса могло выйти за аренду
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise DeadlineExceeded("Lease deadline passed before sending")
+                    await bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
+                self._messages += 1
+                self._remember_message(str(chat_id))
+                return
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                seconds = _retry_after_seconds(e)
+                logger.warning(f"[DISPATCHER] Flood control for chat {chat_id}: retry after {seconds:.0f}s")
+                self.limiter.pause(seconds)
+                self._retries += 1
+
+    def _remember_message(self, chat_id: str) -> None:
+        now = time.time()
+        if len(self._last_message) > RATE_LIMITER_MAX_CHATS:
+            self._last_message = {chat: at for chat, at in self._last_message.items()
+                                  if now - at < self.digest_window}
+        self._last_message[chat_id] = now
+
+    def _hold_until(self, digest: List[Dict[str, Any]]) -> Optional[float]:
+        """До какого времени отложить последнюю сводку чата (None - отправлять сейчас)"""
+        if self.digest_window <= 0:
+            return None
+        created_at = _created_at(digest[0])
+        last_message = self._last_message.get(str(digest[0]['chatId']))
+        now = time.time()
+        if created_at is None or last_message is None or now - last_message >= self.digest_window:
+            return None
+        # createdAt из будущего (часы веб-приложения) не откладывает сводку дольше окна
+        until = min(created_at, now) + self.digest_window
+        return until if until > now else None
+
+    async def _send_digest(self, bot, semaphore: asyncio.Semaphore, digest: List[Dict[str, Any]],
+                           results: Dict[int, Optional[Exception]], deadline: Optional[float]) -> None:
+        try:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise DeadlineExceeded("Lease deadline passed")
+            await self._send(bot, semaphore, digest[0]['chatId'], format_digest(digest), deadline)
+            error = None
+            self._sent += len(digest)
+        except DeadlineExceeded as e:
+            error = e
+            self._deferred += len(digest)
+        except BadRequest as e:
+            if len(digest) > 1:
+                # Ошибка может быть в одном уведомлении сводки (например, некорректный HTML) -
+                # отправляем по одному, чтобы она не досталась остальным
+                logger.warning(f"[DISPATCHER] Digest of {len(digest)} for chat {digest[0]['chatId']} "
+                               f"rejected ({e}), sending one by one")
+                self._split += 1
+                for notification in digest:
+                    await self._send_digest(bot, semaphore, [notification], results, deadline)
+                return
+            error = e
+            self._failed += 1
+        except Exception as e:
+            error = e
+            self._failed += len(digest)
+        for notification in digest:
+            results[id(notification)] = error
+            if error is None:
+                queue_metrics.record_sent(_created_at(notification))
+            elif not isinstance(error, DeadlineExceeded):
+                queue_metrics.record_failed(type(error).__name__)
+
+    async def _send_chat(self, bot, semaphore: asyncio.Semaphore, notifications: List[Dict[str, Any]],
+                         results: Dict[int, Optional[Exception]], deadline: Optional[float]) -> None:
+        digests = build_digests(notifications, self.digest_window)
+        # Дополнить сводку могут только уведомления после последней - ее и откладываем
+        until = self._hold_until(digests[-1])
+        if until is not None:
+            held = digests.pop()
+            for notification in held:
+                results[id(notification)] = DigestHeld(until)
+            self._held += len(held)
+        # Сообщения одного чата - строго по очереди
+        for digest in digests:
+            await self._send_digest(bot, semaphore, digest, results, deadline)
+
+    async def dispatch(self, bot, notifications: List[Dict[str, Any]],
+                       deadline: Optional[float] = None) -> List[DispatchResult]:
+        """
+        Отправить уведомления
+
+        Args:
+            bot: telegram.Bot
+            notifications: Уведомления из очереди (старые первыми)
+            deadline: time.monotonic(), после которого сообщения не отправляются
+                      (уведомления получают DeadlineExceeded)
+
+        Отложенные до конца окна сводки уведомления получают DigestHeld.
+
+        Returns:
+            Список (уведомление, исключение или None) в порядке notifications
+        """
+        results: Dict[int, Optional[Exception]] = {}
+        chats: Dict[str, List[Dict[str, Any]]] = {}
+        for notification in notifications:
+            if not notification.get('chatId') or not notification.get('message'):
+                results[id(notification)] = ValueError("Missing chatId or message")
+                queue_metrics.record_failed('ValueError')
+                continue
+            chats.setdefault(str(notification['chatId']), []).append(notification)
+
+        if chats:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(*(
+                self._send_chat(bot, semaphore, chat_notifications, results, deadline)
+                for chat_notifications in chats.values()
+            ))
+        return [(notification, results[id(notification)]) for notification in notifications]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'sent': self._sent,
+            'failed': self._failed,
+            'messages': self._messages,
+            'retries': self._retries,
+            'deferred': self._deferred,
+            'split': self._split,
+            'held': self._held,
+            **self.limiter.stats(),
+        }
+
+dispatcher = NotificationDispatcher(
+    RateLimiter(config.NOTIFICATION_GLOBAL_RATE, config.NOTIFICATION_CHAT_INTERVAL, config.NOTIFICATION_GROUP_INTERVAL),
+    concurrency=config.NOTIFICATION_DISPATCH_CONCURRENCY,
+    max_retries=config.NOTIFICATION_RETRY_AFTER_RETRIES,
+    digest_window=config.NOTIFICATION_DIGEST_WINDOW,
+)
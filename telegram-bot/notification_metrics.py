@@ -0,0 +1,174 @@
+"""
+Метрики очереди уведомлений
+
+queue_metrics накапливает показатели, по которым видно, успевает ли бот
+разбирать notificationQueue:
+    - backlog: сколько уведомлений ждут отправки, возраст самого старого,
+      сколько из них ждут повтора (nextAttemptAt) и захвачены (leaseUntil);
+    - задержка от создания уведомления (createdAt) до отправки - гистограмма
+      с оценкой p50/p95/p99;
+    - отправки в секунду за последнюю минуту;
+    - ошибки отправки по классу исключения (Forbidden, TimedOut, ...);
+    - захваты, конфликты захвата, запланированные повторы и переносы в
+      notificationDeadLetter.
+
+Счетчики пишут notification_queue.py и notification_dispatcher.py. Backlog
+получает функция из set_backlog_source (bot.py: данные listener'а очереди или
+запрос к Firestore); результат хранится config.NOTIFICATION_QUEUE_HEALTH_TTL секунд.
+Обновляют его фоновая задача bot.py (queue_backlog_refresh) и команда /queue;
+/metrics отдает сохраненное значение, чтобы частота опроса Prometheus не задавала
+число чтений Firestore.
+
+Метрики доступны в /metrics (Prometheus), /metrics.json и команде /queue.
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional
+import config
+from firebase_metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+# Корзины гистограммы задержки доставки (секунды): от мгновенной до часа
+DELIVERY_LATENCY_BUCKETS = (1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+# Окно для расчета отправок в секунду
+SEND_RATE_WINDOW = 60
+
+class QueueMetrics:
+    """Потокобезопасные счетчики очереди уведомлений"""
+
+    def __init__(self, backlog_ttl: float = 60):
+        self.backlog_ttl = backlog_ttl
+        self._lock = threading.Lock()
+        self.latency = LatencyHistogram(DELIVERY_LATENCY_BUCKETS)
+        self._send_times: deque = deque()
+        self._sent = 0
+        self._failures: Dict[str, int] = {}
+        self._claimed = 0
+        self._claim_conflicts = 0
+        self._retries = 0
+        self._dead_letters: Dict[str, int] = {}
+        self._backlog_source: Optional[Callable[[], Dict[str, Any]]] = None
+        self._backlog: Optional[Dict[str, Any]] = None
+        self._backlog_at = 0.0
+
+    def set_backlog_source(self, func: Callable[[], Dict[str, Any]]) -> None:
+        self._backlog_source = func
+
+    def record_sent(self, created_at: Optional[float]) -> None:
+        """Уведомление отправлено; created_at - время создания (секунды Unix)"""
+        now = time.time()
+        with self._lock:
+            self._sent += 1
+            self._send_times.append(now)
+            if created_at is not None:
+                self.latency.observe(max(0.0, now - created_at))
+
+    def record_failed(self, error_class: str) -> None:
+        with self._lock:
+            self._failures[error_class] = self._failures.get(error_class, 0) + 1
+
+    def record_claimed(self, count: int) -> None:
+        with self._lock:
+            self._claimed += count
+
+    def record_claim_conflict(self) -> None:
+        with self._lock:
+            self._claim_conflicts += 1
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self._retries += 1
+
+    def record_dead_letter(self, reason: str) -> None:
+        with self._lock:
+            self._dead_letters[reason] = self._dead_letters.get(reason, 0) + 1
+
+    def _sends_per_second(self) -> float:
+        cutoff = time.time() - SEND_RATE_WINDOW
+        while self._send_times and self._send_times[0] < cutoff:
+            self._send_times.popleft()
+        return len(self._send_times) / SEND_RATE_WINDOW
+
+    def refresh_backlog(self) -> Optional[Dict[str, Any]]:
+        """Прочитать состояние очереди из источника (без учета backlog_ttl)"""
+        if self._backlog_source is None:
+            return self._backlog
+        try:
+            backlog = self._backlog_source()
+        except Exception as e:
+            # Показываем прежнее значение; следующая попытка - через backlog_ttl
+            logger.error(f"[QUEUE_METRICS] Error reading queue backlog: {e}", exc_info=True)
+            self._backlog_at = time.monotonic()
+            return self._backlog
+        with self._lock:
+            self._backlog = backlog
+            self._backlog_at = time.monotonic()
+        return backlog
+
+    def backlog(self, refresh: bool = True) -> Optional[Dict[str, Any]]:
+        """Состояние очереди; refresh=False - только сохраненное значение (без запросов)"""
+        if refresh and time.monotonic() - self._backlog_at >= self.backlog_ttl:
+            return self.refresh_backlog()
+        return self._backlog
+
+    def snapshot(self, refresh_backlog: bool = True) -> Dict[str, Any]:
+        backlog = self.backlog(refresh_backlog)
+        with self._lock:
+            return {
+                'backlog': backlog,
+                'sent': self._sent,
+                'sends_per_second': round(self._sends_per_second(), 3),
+                'delivery_latency': {
+                    'count': self.latency.count,
+                    'p50': round(self.latency.percentile(0.5), 1),
+                    'p95': round(self.latency.percentile(0.95), 1),
+                    'p99': round(self.latency.percentile(0.99), 1),
+                    'max': round(self.latency.max, 1),
+                },
+                'failures': dict(self._failures),
+                'claimed': self._claimed,
+                'claim_conflicts': self._claim_conflicts,
+                'retries': self._retries,
+                'dead_letters': dict(self._dead_letters),
+            }
+
+    def prometheus(self) -> str:
+        """Метрики в текстовом формате Prometheus (для firebase_metrics.metrics.add_prometheus_source)"""
+        # Без запросов к Firestore: вызывается в потоке HTTP сервера метрик при каждом опросе
+        backlog = self.backlog(refresh=False) or {}
+        lines = []
+
+        def family(name: str, kind: str, samples) -> None:
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{suffix} {value}' for suffix, value in samples)
+
+        with self._lock:
+            family('notification_queue_pending', 'gauge', [('', backlog.get('pending', 0))])
+            family('notification_queue_waiting_retry', 'gauge', [('', backlog.get('waiting_retry', 0))])
+            family('notification_queue_leased', 'gauge', [('', backlog.get('leased', 0))])
+            family('notification_queue_oldest_age_seconds', 'gauge', [('', backlog.get('oldest_age', 0.0))])
+            family('notification_queue_sent_total', 'counter', [('', self._sent)])
+            family('notification_queue_sends_per_second', 'gauge', [('', round(self._sends_per_second(), 3))])
+            family('notification_queue_failures_total', 'counter',
+                   [(f'{{error="{name}"}}', count) for name, count in sorted(self._failures.items())])
+            family('notification_queue_claimed_total', 'counter', [('', self._claimed)])
+            family('notification_queue_claim_conflicts_total', 'counter', [('', self._claim_conflicts)])
+            family('notification_queue_retries_total', 'counter', [('', self._retries)])
+            family('notification_queue_dead_letters_total', 'counter',
+                   [(f'{{reason="{reason}"}}', count) for reason, count in sorted(self._dead_letters.items())])
+            buckets = []
+            cumulative = 0
+            for bound, count in zip(self.latency.buckets + (float('inf'),), self.latency.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                buckets.append((f'_bucket{{le="{le}"}}', cumulative))
+            buckets.append(('_sum', f'{self.latency.total:.3f}'))
+            buckets.append(('_count', self.latency.count))
+            family('notification_delivery_latency_seconds', 'histogram', buckets)
+        return '\n'.join(lines) + '\n'
+
+queue_metrics = QueueMetrics(config.NOTIFICATION_QUEUE_HEALTH_TTL)
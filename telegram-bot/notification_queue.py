@@ -2,15 +2,98 @@
 Модуль для обработки очереди уведомлений из Firebase
 Веб-приложение сохраняет задачи на отправку уведомлений в Firebase,
 бот периодически проверяет и отправляет их
+
+Неотправленные уведомления выбираются запросом sent == false с сортировкой по
+createdAt и limit - Firestore читает только первые limit документов очереди, а не
+всю коллекцию за срок хранения. Для запроса нужен составной индекс
+(sent ASC, createdAt ASC), он описан в firestore.indexes.json в корне репозитория.
+Без индекса Firestore отвечает FAILED_PRECONDITION со ссылкой на создание индекса.
+Для очистки (cleanup_old_notifications) нужен индекс (sent ASC, sentAt ASC).
+
+createdAt и sentAt записываются в UTC в формате веб-приложения (toISOString),
+чтобы уведомления бота и веб-приложения сортировались вместе.
+
+Захват уведомлений (claim_pending_notifications): перед отправкой обработчик
+записывает в уведомление claimedBy (свой WORKER_ID), leaseUntil (до какого времени
+уведомление за ним) и attempts + 1. Запись выполняется с предусловием на время
+изменения документа (get_with_update_time + update(update_time=...)): если другой
+обработчик успел захватить уведомление, запись отклоняется и уведомление пропускается.
+Поэтому очередь могут разбирать несколько процессов без двойной отправки, а уведомления
+упавшего процесса снова доступны после истечения leaseUntil.
+
+Отправка пачки заканчивается до конца аренды (notification_dispatcher, deadline);
+уведомления, до которых очередь не дошла, освобождаются (release_notification)
+без траты попытки. Так же освобождаются уведомления, отложенные до конца окна
+сводки (notification_dispatcher.DigestHeld) - с delay, до которого их не захватят.
+
+Повторы (mark_notification_failed): после временной ошибки уведомление не захватывается
+до nextAttemptAt - задержка растет экспоненциально с числом попыток attempts.
+После постоянной ошибки (бот заблокирован, чат не найден) или
+config.NOTIFICATION_MAX_ATTEMPTS попыток уведомление переносится в коллекцию
+notificationDeadLetter и больше не отправляется.
+
+add_notification_tasks добавляет уведомления для нескольких получателей одним
+commit; ID уведомлений бота - notif_<ULID> (firebase_common.new_sortable_id).
+
+Захваты, повторы и переносы учитываются в notification_metrics.queue_metrics;
+get_queue_backlog - размер очереди и возраст самого старого уведомления.
 """
 import logging
-from typing import Dict, Any, Optional, List
-from datetime import datetime
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Dict, Any, Optional, List, Tuple
+from datetime import datetime, timedelta, timezone
 from firebase_client import firebase
+from firebase_common import Batch, Write, DOCUMENT_ID_FIELD, MAX_BATCH_WRITES, new_sortable_id
+from notification_metrics import queue_metrics
+from utils import get_utc_timestamp, parse_timestamp
+import config
 
 logger = logging.getLogger(__name__)
 
 NOTIFICATION_QUEUE_COLLECTION = 'notificationQueue'
+NOTIFICATION_DEAD_LETTER_COLLECTION = 'notificationDeadLetter'
+
+# Запрос очереди: старые первыми (составной индекс sent + createdAt). ID документа -
+# второй ключ: курсор захвата (createdAt, id) не пропускает уведомления с одинаковым
+# createdAt (рассылка нескольким получателям); Firestore и так упорядочивает по ID
+# после полей индекса, отдельный индекс не нужен
+PENDING_FILTERS = [('sent', '==', False)]
+PENDING_ORDER_BY = [('createdAt', 'ASCENDING'), (DOCUMENT_ID_FIELD, 'ASCENDING')]
+
+# Очистка: самые старые отправленные первыми (составной индекс sent + sentAt)
+CLEANUP_ORDER_BY = [('sentAt', 'ASCENDING')]
+
+# Идентификатор этого процесса в поле claimedBy
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Сколько страниц очереди просматривать при захвате: первые уведомления могут быть
+# захвачены другими обработчиками или ждать повтора (nextAttemptAt)
+CLAIM_MAX_PAGES = 5
+
+def _utc_timestamp_after(seconds: float) -> str:
+    """Время через seconds секунд в формате get_utc_timestamp"""
+    moment = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    return moment.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+def _is_claimable(task: Dict[str, Any], now: str) -> bool:
+    """Не отправлено, не захвачено (или аренда истекла) и время повтора наступило"""
+    return (not task.get('sent', False)
+            and (task.get('leaseUntil') or '') <= now
+            and (task.get('nextAttemptAt') or '') <= now)
+
+def retry_delay(attempts: int) -> float:
+    """Задержка перед следующей попыткой (секунды) после attempts неудачных"""
+    delay = config.NOTIFICATION_RETRY_BASE_DELAY * 2 ** max(0, attempts - 1)
+    # Разброс +-20%, чтобы повторы уведомлений, упавших вместе, не совпадали
+    return min(config.NOTIFICATION_RETRY_MAX_DELAY, delay * random.uniform(0.8, 1.2))
+
+def _new_notification_id() -> str:
+    """ID уведомления: уникальный и упорядоченный по времени создания"""
+    return f"notif_{new_sortable_id()}"
 
 def add_notification_task(
     notification_type: str,
@@ -33,28 +116,57 @@ def add_notification_task(
     Returns:
         True если задача добавлена успешно
     """
+    return add_notification_tasks([{
+        'type': notification_type,
+        'userId': user_id,
+        'message': message,
+        'chatId': chat_id,
+        'metadata': metadata,
+    }]) == 1
+
+def add_notification_tasks(notifications: List[Dict[str, Any]]) -> int:
+    """
+    Добавляет в очередь несколько уведомлений одним commit
+    (по MAX_BATCH_WRITES уведомлений на commit)
+    
+    ID уведомлений - notif_<ULID>: уникальны без координации между процессами
+    и возрастают в порядке добавления, поэтому рассылка нескольким получателям
+    сохраняет порядок списка.
+    
+    Args:
+        notifications: Уведомления с полями type, userId, message, chatId
+                       и необязательным metadata
+    
+    Returns:
+        Количество добавленных уведомлений (0 при ошибке)
+    """
     try:
-        task = {
-            'id': f"notif_{datetime.now().isoformat()}_{user_id}",
-            'type': notification_type,
-            'userId': user_id,
-            'message': message,
-            'chatId': chat_id,
-            'metadata': metadata or {},
-            'createdAt': datetime.now().isoformat(),
-            'sent': False,
-            'error': None
-        }
-        firebase.save(NOTIFICATION_QUEUE_COLLECTION, task)
-        logger.info(f"[NOTIFICATION_QUEUE] Added task: {notification_type} for user {user_id}")
-        return True
+        batch = firebase.batch()
+        for notification in notifications:
+            batch.set(NOTIFICATION_QUEUE_COLLECTION, {
+                'id': _new_notification_id(),
+                'type': notification['type'],
+                'userId': notification['userId'],
+                'message': notification['message'],
+                'chatId': notification['chatId'],
+                'metadata': notification.get('metadata') or {},
+                'createdAt': get_utc_timestamp(),
+                'sent': False,
+                'error': None
+            })
+        count = len(batch)
+        if count and not batch.commit():
+            logger.error(f"[NOTIFICATION_QUEUE] Error adding {count} tasks")
+            return 0
+        logger.info(f"[NOTIFICATION_QUEUE] Added {count} tasks")
+        return count
     except Exception as e:
-        logger.error(f"[NOTIFICATION_QUEUE] Error adding task: {e}", exc_info=True)
-        return False
+        logger.error(f"[NOTIFICATION_QUEUE] Error adding tasks: {e}", exc_info=True)
+        return 0
 
 def get_pending_notifications(limit: int = 50) -> List[Dict[str, Any]]:
     """
-    Получает список неотправленных уведомлений
+    Получает список неотправленных уведомлений (старые первыми)
     
     Args:
         limit: Максимальное количество уведомлений для получения
@@ -63,65 +175,294 @@ def get_pending_notifications(limit: int = 50) -> List[Dict[str, Any]]:
         Список задач на отправку уведомлений
     """
     try:
-        all_tasks = firebase.get_all(NOTIFICATION_QUEUE_COLLECTION)
-        pending = [t for t in all_tasks if not t.get('sent', False)]
-        # Сортируем по дате создания (старые первыми)
-        pending.sort(key=lambda x: x.get('createdAt', ''))
-        return pending[:limit]
+        return firebase.query(NOTIFICATION_QUEUE_COLLECTION, PENDING_FILTERS,
+                              order_by=PENDING_ORDER_BY, limit=limit)
     except Exception as e:
         logger.error(f"[NOTIFICATION_QUEUE] Error getting pending notifications: {e}", exc_info=True)
         return []
 
-def mark_notification_sent(task_id: str, success: bool = True, error: Optional[str] = None) -> bool:
+def _claim(task_id: str, now: str, lease_seconds: float, claimed: List[Dict[str, Any]]) -> bool:
+    """Захватить уведомление (запись с предусловием); захваченное добавляется в claimed"""
+    # Перечитываем документ вместе со временем изменения - предусловие записи
+    task, update_time = firebase.get_with_update_time(NOTIFICATION_QUEUE_COLLECTION, task_id)
+    if not task or not _is_claimable(task, now):
+        return False
+    lease = {
+        'claimedBy': WORKER_ID,
+        'leaseUntil': _utc_timestamp_after(lease_seconds),
+        'attempts': (task.get('attempts') or 0) + 1,
+    }
+    if not firebase.update(NOTIFICATION_QUEUE_COLLECTION, task_id, lease, update_time=update_time):
+        # Документ изменен после чтения - его захватил другой обработчик
+        logger.info(f"[NOTIFICATION_QUEUE] Notification {task_id} claimed by another worker")
+        queue_metrics.record_claim_conflict()
+        return False
+    task.update(lease)
+    claimed.append(task)
+    return True
+
+def claim_pending_notifications(limit: int = 50,
+                                lease_seconds: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Захватывает неотправленные уведомления для отправки этим процессом
+    
+    Args:
+        limit: Максимальное количество уведомлений
+        lease_seconds: Срок аренды (по умолчанию config.NOTIFICATION_LEASE_SECONDS);
+                       после него незавершенные уведомления может захватить другой обработчик
+    
+    Returns:
+        Захваченные уведомления (старые первыми) с обновленными claimedBy, leaseUntil, attempts
+    """
+    if lease_seconds is None:
+        lease_seconds = config.NOTIFICATION_LEASE_SECONDS
+    claimed: List[Dict[str, Any]] = []
+    try:
+        now = get_utc_timestamp()
+        after = None
+        for _ in range(CLAIM_MAX_PAGES):
+            # Следующая страница начинается после последнего просмотренного уведомления
+            candidates = firebase.query(NOTIFICATION_QUEUE_COLLECTION, PENDING_FILTERS,
+                                        order_by=PENDING_ORDER_BY, limit=limit, start_after=after)
+            for candidate in candidates:
+                if _is_claimable(candidate, now) and _claim(candidate['id'], now, lease_seconds, claimed):
+                    if len(claimed) >= limit:
+                        break
+            if len(claimed) >= limit or len(candidates) < limit:
+                break
+            after = [candidates[-1].get('createdAt'), candidates[-1]['id']]
+    except Exception as e:
+        # Например, нет составного индекса (sent, createdAt): очередь не разбирается
+        logger.error(f"[NOTIFICATION_QUEUE] Error claiming notifications: {e}", exc_info=True)
+    # Уже захваченные до ошибки уведомления отправляем, а не держим до конца аренды
+    queue_metrics.record_claimed(len(claimed))
+    return claimed
+
+def mark_notification_sent(task_id: str, success: bool = True, error: Optional[str] = None,
+                           batch: Optional[Batch] = None) -> bool:
     """
-    Помечает уведомление как отправленное
+    Помечает уведомление как отправленное и освобождает аренду
     
     Args:
         task_id: ID задачи
         success: Успешно ли отправлено
         error: Сообщение об ошибке (если есть)
+        batch: Пакет записей - если передан, обновление только добавляется в него
+               и будет отправлено вместе с остальными при commit
     
     Returns:
-        True если обновлено успешно
+        True если обновлено успешно (или добавлено в пакет)
     """
     try:
-        task = firebase.get_by_id(NOTIFICATION_QUEUE_COLLECTION, task_id)
-        if task:
-            task['sent'] = success
-            task['sentAt'] = datetime.now().isoformat()
-            if error:
-                task['error'] = error
-            firebase.save(NOTIFICATION_QUEUE_COLLECTION, task)
+        fields = {
+            'sent': success,
+            'sentAt': get_utc_timestamp(),
+            # Неотправленное уведомление снова доступно для захвата в следующем тике
+            'leaseUntil': None,
+        }
+        if error:
+            fields['error'] = error
+        if batch is not None:
+            batch.update(NOTIFICATION_QUEUE_COLLECTION, task_id, fields)
             return True
-        return False
+        # Обновляем только изменившиеся поля (документ должен существовать)
+        return firebase.commit([('update', NOTIFICATION_QUEUE_COLLECTION, task_id, fields)])
     except Exception as e:
         logger.error(f"[NOTIFICATION_QUEUE] Error marking notification sent: {e}", exc_info=True)
         return False
 
-def cleanup_old_notifications(days: int = 7) -> int:
+def mark_notification_failed(task: Dict[str, Any], error: str, permanent: bool = False,
+                             batch: Optional[Batch] = None) -> bool:
+    """
+    Записывает неудачную попытку отправки
+    
+    Временная ошибка - повтор не раньше nextAttemptAt (экспоненциальная задержка).
+    Постоянная ошибка или исчерпанные попытки - перенос в notificationDeadLetter.
+    
+    Args:
+        task: Захваченное уведомление (с полем attempts)
+        error: Текст ошибки
+        permanent: Повтор не поможет (см. notification_dispatcher.is_permanent_error)
+        batch: Пакет записей - если передан, записи только добавляются в него
+    
+    Returns:
+        True если записано успешно (или добавлено в пакет)
+    """
+    try:
+        task_id = task['id']
+        attempts = task.get('attempts') or 0
+        target = batch if batch is not None else firebase.batch()
+        if permanent or attempts >= config.NOTIFICATION_MAX_ATTEMPTS:
+            reason = 'permanent' if permanent else 'max_attempts'
+            target.set(NOTIFICATION_DEAD_LETTER_COLLECTION, {
+                **task,
+                'error': error,
+                'failedAt': get_utc_timestamp(),
+                'deadLetterReason': reason,
+            })
+            target.delete(NOTIFICATION_QUEUE_COLLECTION, task_id)
+            queue_metrics.record_dead_letter(reason)
+            logger.warning(f"[NOTIFICATION_QUEUE] Notification {task_id} moved to dead letter "
+                           f"({reason}, attempts={attempts}): {error}")
+        else:
+            target.update(NOTIFICATION_QUEUE_COLLECTION, task_id, {
+                'sent': False,
+                'error': error,
+                'nextAttemptAt': _utc_timestamp_after(retry_delay(attempts)),
+                'leaseUntil': None,
+            })
+            queue_metrics.record_retry()
+        return True if batch is not None else target.commit()
+    except Exception as e:
+        logger.error(f"[NOTIFICATION_QUEUE] Error marking notification failed: {e}", exc_info=True)
+        return False
+
+def release_notification(task: Dict[str, Any], batch: Optional[Batch] = None, delay: float = 0) -> bool:
+    """
+    Освобождает захваченное уведомление, отправка которого не начиналась
+    
+    Аренда снимается, попытка, засчитанная при захвате, возвращается: уведомление
+    снова доступно для захвата (через delay секунд) и не приближается к NOTIFICATION_MAX_ATTEMPTS.
+    
+    Args:
+        task: Захваченное уведомление (с полем attempts)
+        batch: Пакет записей - если передан, обновление только добавляется в него
+        delay: Не захватывать уведомление еще delay секунд (nextAttemptAt)
+    
+    Returns:
+        True если обновлено успешно (или добавлено в пакет)
+    """
+    try:
+        fields = {
+            'leaseUntil': None,
+            'attempts': max(0, (task.get('attempts') or 0) - 1),
+        }
+        if delay > 0:
+            fields['nextAttemptAt'] = _utc_timestamp_after(delay)
+        if batch is not None:
+            batch.update(NOTIFICATION_QUEUE_COLLECTION, task['id'], fields)
+            return True
+        return firebase.commit([('update', NOTIFICATION_QUEUE_COLLECTION, task['id'], fields)])
+    except Exception as e:
+        logger.error(f"[NOTIFICATION_QUEUE] Error releasing notification: {e}", exc_info=True)
+        return False
+
+def _owned_marks(marks: List[Tuple[str, List[Write]]]) -> List[Tuple[str, List[Write]]]:
+    """Отметки уведомлений, которые все еще захвачены этим процессом (claimedBy == WORKER_ID)"""
+    tasks = firebase.get_many(NOTIFICATION_QUEUE_COLLECTION, [task_id for task_id, _ in marks], fields=['claimedBy'])
+    if not tasks:
+        # Пустой ответ не отличить от ошибки чтения - пишем отметки без проверки
+        logger.warning(f"[NOTIFICATION_QUEUE] Could not check claims of {len(marks)} notifications, marking anyway")
+        return marks
+    owned = []
+    for task_id, task_writes in marks:
+        task = tasks.get(task_id)
+        if task is None:
+            logger.warning(f"[NOTIFICATION_QUEUE] Notification {task_id} was deleted, marks skipped")
+        elif task.get('claimedBy') != WORKER_ID:
+            # Аренда истекла и уведомление захватил другой обработчик - его состояние не трогаем
+            logger.warning(f"[NOTIFICATION_QUEUE] Notification {task_id} is now claimed by "
+                           f"{task.get('claimedBy')}, marks skipped")
+        else:
+            owned.append((task_id, task_writes))
+    return owned
+
+def commit_marks(marks: List[Tuple[str, List[Write]]]) -> List[str]:
+    """
+    Записать отметки о результатах отправки одним commit
+    
+    Сначала проверяется, что уведомления все еще захвачены этим процессом: если
+    аренда истекла и уведомление захватил другой обработчик, отметки этого
+    процесса перезаписали бы его аренду и результат, и такие отметки пропускаются.
+    
+    Commit атомарный, а update требует существования документа: если одно
+    уведомление успели удалить (веб-приложение, очистка, перенос в
+    notificationDeadLetter другим обработчиком), не проходит весь commit. Тогда
+    отметки записываются по одному уведомлению, чтобы остальные не остались
+    неотмеченными и не были отправлены повторно после истечения аренды.
+    
+    Args:
+        marks: (ID уведомления, записи mark_notification_sent / mark_notification_failed)
+    
+    Returns:
+        ID уведомлений, отметки которых записать не удалось
+    """
+    if marks:
+        marks = _owned_marks(marks)
+    writes = [write for _, task_writes in marks for write in task_writes]
+    if not writes or firebase.commit(writes):
+        return []
+    logger.warning(f"[NOTIFICATION_QUEUE] Batch commit of {len(marks)} marks failed, writing them one by one")
+    failed = []
+    for task_id, task_writes in marks:
+        if not firebase.commit(task_writes):
+            logger.error(f"[NOTIFICATION_QUEUE] Error writing marks for notification {task_id}")
+            failed.append(task_id)
+    return failed
+
+def summarize_backlog(pending: List[Dict[str, Any]], capped: bool = False) -> Dict[str, Any]:
+    """
+    Состояние очереди по неотправленным уведомлениям
+    
+    Args:
+        pending: Неотправленные уведомления (нужны createdAt, nextAttemptAt, leaseUntil)
+        capped: Список неполный - уведомлений в очереди не меньше len(pending)
+    """
+    now = get_utc_timestamp()
+    created = [ts for ts in (parse_timestamp(task.get('createdAt')) for task in pending) if ts is not None]
+    return {
+        'pending': len(pending),
+        'capped': capped,
+        'waiting_retry': sum(1 for task in pending if (task.get('nextAttemptAt') or '') > now),
+        'leased': sum(1 for task in pending if (task.get('leaseUntil') or '') > now),
+        'oldest_age': round(max(0.0, time.time() - min(created)), 1) if created else 0.0,
+    }
+
+def get_queue_backlog(max_count: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Состояние очереди запросом к Firestore (не больше max_count документов,
+    по умолчанию config.NOTIFICATION_QUEUE_HEALTH_MAX_SCAN)
+    """
+    if max_count is None:
+        max_count = config.NOTIFICATION_QUEUE_HEALTH_MAX_SCAN
+    pending = firebase.query(NOTIFICATION_QUEUE_COLLECTION, PENDING_FILTERS, order_by=PENDING_ORDER_BY,
+                             limit=max_count, fields=['createdAt', 'nextAttemptAt', 'leaseUntil'])
+    return summarize_backlog(pending, capped=len(pending) >= max_count)
+
+def cleanup_old_notifications(days: int = 7, limit: Optional[int] = None) -> int:
     """
     Удаляет старые отправленные уведомления
     
+    Уведомления выбираются запросом sent == true AND sentAt < граница (составной
+    индекс sent + sentAt), страницами по MAX_BATCH_WRITES - каждая страница удаляется
+    одним commit. За вызов удаляется не больше limit уведомлений; остаток удалит
+    следующий вызов (запрос снова начинает с самых старых).
+    
     Args:
         days: Количество дней для хранения
+        limit: Максимум удалений за вызов (по умолчанию config.NOTIFICATION_CLEANUP_LIMIT)
     
     Returns:
         Количество удаленных уведомлений
     """
+    if limit is None:
+        limit = config.NOTIFICATION_CLEANUP_LIMIT
+    deleted_count = 0
     try:
-        from datetime import timedelta
-        cutoff_date = (datetime.now() - timedelta(days=days)).isoformat()
-        
-        all_tasks = firebase.get_all(NOTIFICATION_QUEUE_COLLECTION)
-        deleted_count = 0
-        
-        for task in all_tasks:
-            if task.get('sent') and task.get('sentAt', '') < cutoff_date:
-                try:
-                    firebase.delete(NOTIFICATION_QUEUE_COLLECTION, task['id'])
-                    deleted_count += 1
-                except:
-                    pass
+        cutoff_date = _utc_timestamp_after(-days * 24 * 3600)
+        while deleted_count < limit:
+            page_size = min(MAX_BATCH_WRITES, limit - deleted_count)
+            expired = firebase.query(NOTIFICATION_QUEUE_COLLECTION, [('sent', '==', True), ('sentAt', '<', cutoff_date)],
+                                     order_by=CLEANUP_ORDER_BY, limit=page_size, fields=['sentAt'])
+            if not expired:
+                break
+            writes = [('delete', NOTIFICATION_QUEUE_COLLECTION, task['id'], None) for task in expired]
+            if not firebase.commit(writes):
+                logger.error(f"[NOTIFICATION_QUEUE] Error deleting {len(writes)} old notifications")
+                break
+            deleted_count += len(writes)
+            if len(expired) < page_size:
+                break
         
         if deleted_count > 0:
             logger.info(f"[NOTIFICATION_QUEUE] Cleaned up {deleted_count} old notifications")
@@ -129,4 +470,4 @@ def cleanup_old_notifications(days: int = 7) -> int:
         return deleted_count
     except Exception as e:
         logger.error(f"[NOTIFICATION_QUEUE] Error cleaning up: {e}", exc_info=True)
-        return 0
+        return deleted_count
@@ -0,0 +1,122 @@
+"""
+Подписка на новые уведомления в очереди (snapshot listener, только Admin SDK)
+
+Без подписки бот узнает о новом уведомлении только при следующем опросе
+очереди (раз в config.NOTIFICATION_QUEUE_POLL_INTERVAL секунд). NotificationQueueWatcher
+подписывается через on_snapshot на запрос sent == false и вызывает on_pending,
+как только в запрос попадает новый документ (изменение ADDED) - уведомление
+отправляется сразу после записи веб-приложением.
+
+Изменения уже известных документов (захват, nextAttemptAt) обработку не запускают:
+их пишет сам бот. Повторы после задержки и уведомления с истекшей арендой
+подбирает медленный опрос (config.NOTIFICATION_QUEUE_FALLBACK_INTERVAL).
+Если подписка оборвалась, bot.py опрашивает очередь с обычным интервалом,
+а ensure_started() переподписывается.
+
+Watcher хранит поля неотправленных уведомлений, нужные для метрик очереди
+(backlog() - без запросов к Firestore).
+
+on_pending вызывается в потоке listener'а Firestore.
+"""
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional
+from notification_queue import NOTIFICATION_QUEUE_COLLECTION, summarize_backlog
+
+logger = logging.getLogger(__name__)
+
+# Поля уведомлений для метрик очереди
+BACKLOG_FIELDS = ('createdAt', 'nextAttemptAt', 'leaseUntil')
+
+class NotificationQueueWatcher:
+    """Snapshot listener на неотправленные уведомления"""
+
+    def __init__(self, collection_name: str = NOTIFICATION_QUEUE_COLLECTION):
+        self.collection_name = collection_name
+        self._on_pending: Optional[Callable[[], None]] = None
+        self._watch = None
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._ready = False
+        self._snapshots = 0
+        self._added = 0
+        self._restarts = 0
+
+    @property
+    def active(self) -> bool:
+        """Подписка работает (Watch закрывается при неустранимой ошибке)"""
+        watch = self._watch
+        return watch is not None and getattr(watch, 'is_active', True)
+
+    @property
+    def ready(self) -> bool:
+        """Подписка работает и первый снимок получен - backlog() актуален"""
+        return self._ready and self.active
+
+    def start(self, on_pending: Callable[[], None]) -> None:
+        """Подписаться на очередь; on_pending() - в очереди появились новые уведомления"""
+        from firebase_client_admin import db
+        self._on_pending = on_pending
+        query = db.collection(self.collection_name).where('sent', '==', False)
+        self._watch = query.on_snapshot(self._on_snapshot)
+        logger.info(f"[QUEUE_WATCHER] Subscribed to pending notifications in {self.collection_name}")
+
+    def ensure_started(self) -> None:
+        """Переподписаться, если подписка оборвалась"""
+        if self._on_pending is None or self.active:
+            return
+        logger.warning("[QUEUE_WATCHER] Listener is not active, resubscribing")
+        self.stop()
+        self._restarts += 1
+        try:
+            self.start(self._on_pending)
+        except Exception as e:
+            logger.error(f"[QUEUE_WATCHER] Error resubscribing: {e}", exc_info=True)
+
+    def stop(self) -> None:
+        if self._watch is not None:
+            try:
+                self._watch.unsubscribe()
+            except Exception as e:
+                logger.error(f"[QUEUE_WATCHER] Error unsubscribing: {e}")
+            self._watch = None
+        with self._lock:
+            self._pending.clear()
+            self._ready = False
+
+    def _on_snapshot(self, query_snapshot, changes, read_time) -> None:
+        added = 0
+        with self._lock:
+            for change in changes:
+                doc_id = change.document.id
+                if change.type.name == 'REMOVED':
+                    self._pending.pop(doc_id, None)
+                    continue
+                if change.type.name == 'ADDED':
+                    added += 1
+                data = change.document.to_dict() or {}
+                self._pending[doc_id] = {field: data.get(field) for field in BACKLOG_FIELDS}
+            self._snapshots += 1
+            self._added += added
+            self._ready = True
+        # Первый снимок - все уже ожидающие уведомления (ADDED): их тоже отправляем сразу
+        if added and self._on_pending is not None:
+            try:
+                self._on_pending()
+            except Exception as e:
+                logger.error(f"[QUEUE_WATCHER] on_pending error: {e}", exc_info=True)
+
+    def backlog(self) -> Dict[str, Any]:
+        """Состояние очереди по данным подписки (см. notification_queue.summarize_backlog)"""
+        with self._lock:
+            pending = list(self._pending.values())
+        return summarize_backlog(pending)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'active': self.active,
+                'snapshots': self._snapshots,
+                'added': self._added,
+                'restarts': self._restarts,
+            }
@@ -1,53 +1,82 @@
 """
 Модуль уведомлений
 """
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Iterable, Tuple
 from datetime import datetime, timedelta
 from firebase_client import firebase
-from tasks import get_today_tasks, get_overdue_tasks, get_yesterday_tasks, get_all_today_tasks, get_all_overdue_tasks
+from tasks import get_today_tasks, get_overdue_tasks, get_yesterday_tasks, get_all_today_tasks, get_all_overdue_tasks, TASK_LIST_FIELDS
 from deals import get_won_deals_today
 from messages import format_daily_reminder, format_weekly_report, format_successful_deal
 from utils import get_week_range, format_date
+from change_feed import ChangeFeed
 import pytz
 
-def check_new_tasks(user_id: str, last_check_time: datetime) -> List[Dict[str, Any]]:
-    """Проверить новые задачи для пользователя"""
+# Для уведомления о новой задаче достаточно полей списка + автор и дата создания
+NEW_TASK_FIELDS = TASK_LIST_FIELDS + ['createdAt', 'createdByUserId']
+
+# Лента изменений задач: periodic_check опрашивает ее один раз за тик
+task_changes = ChangeFeed('tasks', name='newTasks', fields=NEW_TASK_FIELDS)
+
+def _task_created_at(task: Dict[str, Any]) -> Optional[datetime]:
+    """Время создания задачи как локальное время сервера без зоны (как last_check сессий)"""
+    created_at = task.get('createdAt')
+    if not created_at:
+        return None
     try:
-        all_tasks = firebase.get_all('tasks')
-        new_tasks = []
-        
-        for task in all_tasks:
+        task_time = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
+    except (AttributeError, ValueError) as date_error:
+        print(f"Error parsing task date: {date_error}")
+        return None
+    if task_time.tzinfo is not None:
+        # Веб-приложение пишет время в UTC, last_check_time - локальное время сервера
+        task_time = task_time.astimezone().replace(tzinfo=None)
+    return task_time
+
+class NewTaskIndex:
+    """
+    Индекс задач тика: пользователь -> задачи, где он исполнитель или автор
+
+    Строится один раз за тик по измененным задачам (task_changes.poll());
+    for_user выбирает задачи пользователя без перебора всех задач, поэтому
+    тик стоит O(задачи + сессии), а не O(задачи × сессии).
+    """
+
+    def __init__(self, tasks: Iterable[Dict[str, Any]]):
+        self._by_user: Dict[str, List[Tuple[datetime, Dict[str, Any]]]] = {}
+        for task in tasks:
             if task.get('isArchived'):
                 continue
-            
-            created_at = task.get('createdAt')
-            if not created_at:
-                continue
-            
-            try:
-                task_time = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                
-                # Проверяем, новая ли задача (создана после last_check_time)
-                if task_time <= last_check_time:
-                    continue
-                
-                # Проверяем, назначена ли задача на пользователя ИЛИ создана пользователем
-                assignee_id = task.get('assigneeId')
-                assignee_ids = task.get('assigneeIds', [])
-                created_by = task.get('createdByUserId')
-                
-                is_assigned = (assignee_id and str(assignee_id) == str(user_id)) or \
-                             (isinstance(assignee_ids, list) and user_id in [str(uid) for uid in assignee_ids if uid])
-                is_created_by = created_by and str(created_by) == str(user_id)
-                
-                # Добавляем задачу если она назначена на пользователя ИЛИ создана пользователем
-                if is_assigned or is_created_by:
-                    new_tasks.append(task)
-            except Exception as date_error:
-                print(f"Error parsing task date: {date_error}")
+            task_time = _task_created_at(task)
+            if task_time is None:
                 continue
-        
-        return new_tasks
+            assignee_ids = task.get('assigneeIds', [])
+            users = {str(task['assigneeId'])} if task.get('assigneeId') else set()
+            if isinstance(assignee_ids, list):
+                users.update(str(uid) for uid in assignee_ids if uid)
+            if task.get('createdByUserId'):
+                users.add(str(task['createdByUserId']))
+            for user in users:
+                self._by_user.setdefault(user, []).append((task_time, task))
+
+    def __len__(self) -> int:
+        return len(self._by_user)
+
+    def for_user(self, user_id: str, last_check_time: datetime) -> List[Dict[str, Any]]:
+        """Задачи пользователя (исполнитель или автор), созданные после last_check_time"""
+        return [task for task_time, task in self._by_user.get(str(user_id), ()) if task_time > last_check_time]
+
+def check_new_tasks(user_id: str, last_check_time: datetime,
+                    changed_tasks: Optional[List[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+    """
+    Проверить новые задачи для пользователя
+    
+    changed_tasks - задачи, измененные за текущий тик (task_changes.poll());
+    если не переданы, перебирается вся коллекция. Для всех сессий сразу -
+    NewTaskIndex(changed_tasks).for_user(...).
+    """
+    try:
+        source = changed_tasks if changed_tasks is not None else firebase.iter_all('tasks', fields=NEW_TASK_FIELDS)
+        return NewTaskIndex(source).for_user(user_id, last_check_time)
     except Exception as e:
         print(f"Error checking new tasks: {e}")
         import traceback
@@ -65,10 +94,9 @@ def check_new_deals(user_id: str, last_check_time: datetime) -> List[Dict[str, A
         if user_id not in telegram_users:
             return []
         
-        all_deals = firebase.get_all('deals')
         new_deals = []
         
-        for deal in all_deals:
+        for deal in firebase.iter_all('deals'):
             if deal.get('isArchived'):
                 continue
             
@@ -152,12 +180,11 @@ def get_weekly_report_message() -> Optional[str]:
         week_start, week_end = get_week_range()
         
         # Получаем все задачи за неделю
-        all_tasks = firebase.get_all('tasks')
         all_users = firebase.get_all('users')
         
         # Фильтруем задачи за неделю
         week_tasks = []
-        for task in all_tasks:
+        for task in firebase.iter_all('tasks', fields=['isArchived', 'createdAt', 'assigneeId', 'status']):
             if task.get('isArchived'):
                 continue
             
@@ -239,16 +266,8 @@ def get_group_daily_summary() -> Optional[str]:
 def get_successful_deal_message(deal: Dict[str, Any]) -> Optional[str]:
     """Получить сообщение об успешной сделке"""
     try:
-        clients = firebase.get_all('clients')
-        users = firebase.get_all('users')
-        
-        client = None
-        if deal.get('clientId'):
-            client = next((c for c in clients if c.get('id') == deal.get('clientId')), None)
-        
-        user = None
-        if deal.get('assigneeId'):
-            user = next((u for u in users if u.get('id') == deal.get('assigneeId')), None)
+        client = firebase.get_many('clients', [deal.get('clientId')]).get(deal.get('clientId'))
+        user = firebase.get_many('users', [deal.get('assigneeId')]).get(deal.get('assigneeId'))
         
         return format_successful_deal(deal, client, user)
     except Exception as e:
@@ -12,9 +12,8 @@ from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime
 import pytz
 import config
-from firebase_client import firebase
-from notifications import get_daily_reminder_message, get_weekly_report_message, get_successful_deal_message, get_group_daily_summary
-from deals import get_won_deals_today
+from firebase_client import async_firebase
+import data
 
 class TaskScheduler:
     """Планировщик задач для бота"""
@@ -53,7 +52,7 @@ class TaskScheduler:
     async def send_daily_reminders(self):
         """Отправить ежедневные напоминания всем пользователям"""
         try:
-            users = firebase.get_all('users')
+            users = await async_firebase.get_all('users')
             for user in users:
                 if user.get('isArchived'):
                     continue
@@ -63,7 +62,7 @@ class TaskScheduler:
                 if not telegram_user_id:
                     continue
                 
-                message = get_daily_reminder_message(user.get('id'))
+                message = await data.get_daily_reminder_message(user.get('id'))
                 if message:
                     try:
                         await self.bot.send_message(
@@ -79,7 +78,7 @@ class TaskScheduler:
         """Отправить ежедневную сводку в групповой чат"""
         try:
             # Получаем настройки уведомлений
-            notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+            notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
             if not notification_prefs:
                 return
             
@@ -94,7 +93,7 @@ class TaskScheduler:
                 print("No telegramGroupChatId in notification preferences")
                 return
             
-            message = get_group_daily_summary()
+            message = await data.get_group_daily_summary()
             if message:
                 try:
                     await self.bot.send_message(
@@ -114,7 +113,7 @@ class TaskScheduler:
         """Отправить еженедельный отчет в групповой чат"""
         try:
             # Получаем настройки уведомлений
-            notification_prefs = firebase.get_by_id('notificationPrefs', 'default')
+            notification_prefs = await async_firebase.get_by_id('notificationPrefs', 'default')
             if not notification_prefs:
                 return
             
@@ -122,7 +121,7 @@ class TaskScheduler:
             if not telegram_chat_id:
                 return
             
-            message = get_weekly_report_message()
+            message = await data.get_weekly_report_message()
             if message:
                 try:
                     await self.bot.send_message(
@@ -5,22 +5,32 @@ from typing import List, Dict, Any, Optional
 from datetime import datetime
 import logging
 from firebase_client import firebase
-from utils import get_today_date, is_overdue
+from utils import get_today_date, is_overdue, get_utc_timestamp
 
 logger = logging.getLogger(__name__)
 
+# Поля задачи, достаточные для списков, фильтров и напоминаний
+# (без описания и прочих тяжелых полей - их читаем только для карточки задачи)
+TASK_LIST_FIELDS = [
+    'title', 'endDate', 'status', 'priority', 'assigneeId', 'assigneeIds',
+    'isArchived', 'entityType'
+]
+
 def get_user_tasks(user_id: str, include_archived: bool = False) -> List[Dict[str, Any]]:
     """Получить задачи пользователя"""
     try:
-        all_tasks = firebase.get_all('tasks')
-        logger.info(f"[TASKS] Total tasks in Firebase: {len(all_tasks) if all_tasks else 0}")
         user_tasks = []
         
-        if not all_tasks:
-            logger.warning(f"[TASKS] No tasks found in Firebase")
-            return []
+        # Выбираем задачи пользователя на стороне Firestore: по assigneeId и по массиву
+        # assigneeIds (OR в одном запросе недоступен, поэтому два запроса + объединение по ID)
+        candidates = {}
+        for task in firebase.query('tasks', [('assigneeId', '==', user_id)], fields=TASK_LIST_FIELDS):
+            candidates[task['id']] = task
+        for task in firebase.query('tasks', [('assigneeIds', 'array-contains', user_id)], fields=TASK_LIST_FIELDS):
+            candidates.setdefault(task['id'], task)
         
-        for task in all_tasks:
+        # Сохраняем прежний порядок (по ID документа)
+        for task in sorted(candidates.values(), key=lambda t: t['id']):
             # Пропускаем архивные задачи
             if task.get('isArchived') and not include_archived:
                 continue
@@ -49,7 +59,9 @@ def get_user_tasks(user_id: str, include_archived: bool = False) -> List[Dict[st
                 user_tasks.append(task)
                 logger.debug(f"[TASKS] Task {task.get('id')} assigned via assigneeIds")
         
-        logger.info(f"[TASKS] Found {len(user_tasks)} tasks for user {user_id}")
+        if not candidates:
+            logger.warning(f"[TASKS] No tasks assigned to user {user_id} in Firebase")
+        logger.info(f"[TASKS] Found {len(user_tasks)} tasks for user {user_id} (candidates {len(candidates)})")
         return user_tasks
     except Exception as e:
         logger.error(f"[TASKS] Error getting user tasks: {e}", exc_info=True)
@@ -234,10 +246,9 @@ def get_yesterday_tasks() -> List[Dict[str, Any]]:
         yesterday = today - timedelta(days=1)
         yesterday_str = yesterday.isoformat()
         
-        all_tasks = firebase.get_all('tasks')
         yesterday_tasks = []
         
-        for task in all_tasks:
+        for task in firebase.iter_all('tasks', fields=TASK_LIST_FIELDS):
             if task.get('isArchived'):
                 continue
             
@@ -261,10 +272,8 @@ def get_all_today_tasks() -> List[Dict[str, Any]]:
         from utils import get_today_date
         
         today = get_today_date()
-        all_tasks = firebase.get_all('tasks')
-        
         today_tasks = []
-        for task in all_tasks:
+        for task in firebase.iter_all('tasks', fields=TASK_LIST_FIELDS):
             if task.get('isArchived'):
                 continue
             
@@ -284,10 +293,8 @@ def get_all_today_tasks() -> List[Dict[str, Any]]:
 def get_all_overdue_tasks() -> List[Dict[str, Any]]:
     """Получить все просроченные задачи (не только для конкретного пользователя)"""
     try:
-        all_tasks = firebase.get_all('tasks')
-        
         overdue_tasks = []
-        for task in all_tasks:
+        for task in firebase.iter_all('tasks', fields=TASK_LIST_FIELDS):
             if task.get('isArchived'):
                 continue
             
@@ -311,14 +318,10 @@ def get_task_by_id(task_id: str) -> Optional[Dict[str, Any]]:
 def update_task_status(task_id: str, new_status: str) -> bool:
     """Обновить статус задачи"""
     try:
-        task = firebase.get_by_id('tasks', task_id)
-        if not task:
-            return False
-        
-        task['status'] = new_status
-        task['updatedAt'] = datetime.now().isoformat()
-        firebase.save('tasks', task)
-        return True
+        return firebase.update('tasks', task_id, {
+            'status': new_status,
+            'updatedAt': get_utc_timestamp()
+        })
     except Exception as e:
         print(f"Error updating task status: {e}")
         return False
@@ -326,7 +329,7 @@ def update_task_status(task_id: str, new_status: str) -> bool:
 def create_task(task_data: Dict[str, Any]) -> Optional[str]:
     """Создать новую задачу"""
     try:
-        now = datetime.now().isoformat()
+        now = get_utc_timestamp()
         task_data['createdAt'] = task_data.get('createdAt', now)
         task_data['updatedAt'] = now
         task_data['isArchived'] = False
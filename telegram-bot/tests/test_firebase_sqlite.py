@@ -0,0 +1,67 @@
+"""
+Чтение через SqliteMirroredFirebaseClient из загруженного SQLite зеркала
+
+Источник данных - клиент в памяти; сеть и Firestore не нужны.
+"""
+import asyncio
+import pytest
+from firebase_common import query_documents
+from firebase_sqlite import SqliteMirror, SqliteMirroredFirebaseClient, AsyncSqliteMirroredFirebaseClient
+
+TASKS = [
+    {'id': 't1', 'assigneeId': 'u1', 'status': 'В работе', 'updatedAt': '2026-01-01T00:00:00.000Z'},
+    {'id': 't2', 'assigneeId': 'u1', 'status': 'Выполнено', 'updatedAt': '2026-01-02T00:00:00.000Z'},
+    {'id': 't3', 'assigneeId': 'u2', 'status': 'В работе', 'updatedAt': '2026-01-02T00:00:00.000Z'},
+]
+
+class MemoryClient:
+    """Клиент с интерфейсом FirebaseClient поверх списка документов"""
+
+    def __init__(self, items):
+        self.items = items
+        self.queries = 0
+
+    def iter_all(self, collection_name, fields=None):
+        return iter(query_documents(self.items, [], fields=fields))
+
+    def query(self, collection_name, filters, order_by=None, limit=None, fields=None, start_after=None):
+        self.queries += 1
+        return query_documents(self.items, filters, order_by=order_by, limit=limit, fields=fields,
+                               start_after=start_after)
+
+class AsyncMemoryClient(MemoryClient):
+    async def query(self, *args, **kwargs):
+        return MemoryClient.query(self, *args, **kwargs)
+
+@pytest.fixture
+def store():
+    mirror = SqliteMirror(':memory:', ['tasks'], MemoryClient(TASKS), indexed_fields=['assigneeId', 'status'])
+    mirror.sync()
+    yield mirror
+    mirror.close()
+
+def test_query_reads_from_sqlite(store):
+    backend = MemoryClient([])
+    client = SqliteMirroredFirebaseClient(backend, store)
+    items = client.query('tasks', [('assigneeId', '==', 'u1')], order_by='updatedAt')
+    assert [item['id'] for item in items] == ['t1', 't2']
+    assert backend.queries == 0
+
+def test_query_start_after(store):
+    client = SqliteMirroredFirebaseClient(MemoryClient([]), store)
+    items = client.query('tasks', [], order_by=[('updatedAt', 'ASCENDING'), ('__name__', 'ASCENDING')],
+                         start_after=['2026-01-02T00:00:00.000Z', 't2'])
+    assert [item['id'] for item in items] == ['t3']
+
+def test_async_query_reads_from_sqlite(store):
+    backend = AsyncMemoryClient([])
+    client = AsyncSqliteMirroredFirebaseClient(backend, store)
+    items = asyncio.run(client.query('tasks', [('status', '==', 'В работе')], fields=['status']))
+    assert sorted(item['id'] for item in items) == ['t1', 't3']
+    assert backend.queries == 0
+
+def test_unsynced_collection_goes_to_client(store):
+    backend = MemoryClient([{'id': 'd1', 'stage': 'won'}])
+    client = SqliteMirroredFirebaseClient(backend, store)
+    assert [item['id'] for item in client.query('deals', [('stage', '==', 'won')])] == ['d1']
+    assert backend.queries == 1
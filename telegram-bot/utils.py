@@ -1,8 +1,8 @@
 """
 Вспомогательные функции
 """
-from datetime import datetime, timedelta
-from typing import List, Dict, Any
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import List, Dict, Any, Optional
 import pytz
 
 def get_today_date(timezone: str = 'Asia/Tashkent') -> str:
@@ -11,6 +11,17 @@ def get_today_date(timezone: str = 'Asia/Tashkent') -> str:
     today = datetime.now(tz).date()
     return today.isoformat()
 
+def get_utc_timestamp() -> str:
+    """Текущее время в UTC в формате веб-приложения (new Date().toISOString()): 2026-01-24T10:00:00.000Z"""
+    return datetime.now(dt_timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+def parse_timestamp(value: Any) -> Optional[float]:
+    """Время из ISO строки (UTC с Z или локальное без зоны) в секундах Unix; None если не разобрать"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return None
+
 def is_overdue(end_date: str, timezone: str = 'Asia/Tashkent') -> bool:
     """Проверить, просрочена ли задача"""
     if not end_date: